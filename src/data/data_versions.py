@@ -0,0 +1,24 @@
+"""
+Versions of the generation data of each (region, generation type), bumped by the ingestion path so that readers can
+tell when their cached results are out of date.
+"""
+from typing import List
+
+import sqlalchemy as sqla
+from sqlalchemy.dialects.postgresql import insert
+
+from src.orm.base import GenerationDataVersions
+
+
+def bump_data_versions(connection, region_id: int, generation_type_ids: List[int]):
+    """Increment the data version of a region's generation types. Runs in the transaction of `connection`, so the
+    new version becomes visible together with the data"""
+    rows = [{'RegionId': int(region_id), 'GenerationTypeId': int(generation_type_id), 'Version': 1}
+            for generation_type_id in set(generation_type_ids)]
+    if len(rows) == 0:
+        return
+    statement = insert(GenerationDataVersions).values(rows)
+    statement = statement.on_conflict_do_update(
+        index_elements=['RegionId', 'GenerationTypeId'],
+        set_={'Version': GenerationDataVersions.Version + 1, 'UpdatedAt': sqla.func.now()})
+    connection.execute(statement)
@@ -1,9 +1,16 @@
 import datetime
 from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Hashable, List, Mapping, Protocol
 
 import pandas as pd
 import sqlalchemy
 
+from src.data.parquet_store import read_table
+from src.microservice.impact_engine import ImpactFactors, build_impact_factors
+
+ENTSOE_DATA_SOURCE_NAME = 'ENTSO-E'  # DataSourceName of the ENTSO-E rows in ElectricityGenerationTypesMapping
+
 
 @dataclass
 class BasicDataCache:
@@ -11,14 +18,79 @@ class BasicDataCache:
     generation_types: pd.DataFrame
     generation_type_mappings: pd.DataFrame
     regions: pd.DataFrame
+    impact_categories: pd.DataFrame
+    environmental_impacts: pd.DataFrame
+    impact_factors: ImpactFactors  # Dense factor arrays indexed by generation type id, with PerUnit conversion applied
     retrieved_timestamp: datetime.datetime
 
+    # Read-only lookup indexes built from the tables above
+    region_id_by_code: Mapping[str, int]
+    region_code_by_id: Mapping[int, str]
+    generation_type_id_by_name: Mapping[str, int]
+    generation_type_name_by_id: Mapping[int, str]
+    generation_type_id_by_external_name: Mapping[tuple, int]  # {(DataSourceName, ExternalName): ElectricityGenerationTypeId}
+
+    def get_region_id(self, region_code: str) -> int:
+        """Return the internal id of a region code. Raises ValueError if the region code is unknown"""
+        try:
+            return self.region_id_by_code[region_code]
+        except KeyError:
+            raise ValueError(f'Region Code `{region_code}` could not be found in database') from None
+
+
+class GenerationMappings(Protocol):
+    """The lookups needed to convert ENTSO-E data to rows of the ElectricityGeneration table. A BasicDataCache, or
+    plain dicts that can be sent to worker processes (see src.pipelines.bulk_load_csv.CsvMappings)"""
+    region_id_by_code: Mapping[str, int]
+    generation_type_id_by_external_name: Mapping[tuple, int]
+
+
+def build_index(df: pd.DataFrame, key_columns: str | List[str], value_column: str) -> Mapping[Hashable, Hashable]:
+    """Build a read-only dict from the key column(s) to the value column of a dataframe.
+    Keys of several columns are tuples. Integer columns are returned as python ints"""
+    def to_python(series: pd.Series) -> list:
+        if pd.api.types.is_integer_dtype(series):
+            return [int(x) for x in series]
+        return series.to_list()
+
+    if isinstance(key_columns, str):
+        keys = to_python(df[key_columns])
+    else:
+        keys = list(zip(*[to_python(df[column]) for column in key_columns]))
+    return MappingProxyType(dict(zip(keys, to_python(df[value_column]))))
+
 
 def load_common_data_from_db(sql_engine) -> BasicDataCache:
     """Load common data from the database and return as a BasicDataCache object"""
     generation_types = pd.read_sql(sqlalchemy.text('SELECT * FROM public."ElectricityGenerationTypes"'), sql_engine)
     generation_type_mappings = pd.read_sql(sqlalchemy.text('SELECT * FROM public."ElectricityGenerationTypesMapping"'), sql_engine)
     regions = pd.read_sql(sqlalchemy.text('SELECT * FROM public."Regions"'), sql_engine)
+    impact_categories = pd.read_sql(sqlalchemy.text('SELECT * FROM public."ImpactCategories"'), sql_engine)
+    environmental_impacts = pd.read_sql(sqlalchemy.text('SELECT * FROM public."EnvironmentalImpacts"'), sql_engine)
+    return build_common_data(generation_types, generation_type_mappings, regions, impact_categories, environmental_impacts)
+
+
+def load_common_data_from_parquet(root) -> BasicDataCache:
+    """Load common data from a Parquet export of the database (see src.data.parquet_store)"""
+    return build_common_data(generation_types=read_table(root, 'ElectricityGenerationTypes'),
+                             generation_type_mappings=read_table(root, 'ElectricityGenerationTypesMapping'),
+                             regions=read_table(root, 'Regions'),
+                             impact_categories=read_table(root, 'ImpactCategories'),
+                             environmental_impacts=read_table(root, 'EnvironmentalImpacts'))
+
+
+def build_common_data(generation_types: pd.DataFrame, generation_type_mappings: pd.DataFrame, regions: pd.DataFrame,
+                      impact_categories: pd.DataFrame, environmental_impacts: pd.DataFrame) -> BasicDataCache:
+    """Build a BasicDataCache, with its lookup indexes and factor matrix, from the tables of common data"""
+    impact_factors = build_impact_factors(environmental_impacts)
     retrieved_timestamp = datetime.datetime.now(datetime.timezone.utc)
 
-    return BasicDataCache(generation_types=generation_types, regions=regions, retrieved_timestamp=retrieved_timestamp,generation_type_mappings=generation_type_mappings)
+    return BasicDataCache(generation_types=generation_types, regions=regions, retrieved_timestamp=retrieved_timestamp,generation_type_mappings=generation_type_mappings,
+                          impact_categories=impact_categories, environmental_impacts=environmental_impacts, impact_factors=impact_factors,
+                          region_id_by_code=build_index(regions, 'Code', 'Id'),
+                          region_code_by_id=build_index(regions, 'Id', 'Code'),
+                          generation_type_id_by_name=build_index(generation_types, 'Name', 'Id'),
+                          generation_type_name_by_id=build_index(generation_types, 'Id', 'Name'),
+                          generation_type_id_by_external_name=build_index(
+                              generation_type_mappings.dropna(subset=['ElectricityGenerationTypeId']).astype({'ElectricityGenerationTypeId': int}),
+                              ['DataSourceName', 'ExternalName'], 'ElectricityGenerationTypeId'))
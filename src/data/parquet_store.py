@@ -0,0 +1,126 @@
+"""
+Layout of the Parquet copy of the elc_lca database, read by the Parquet backend of the microservice
+(src.microservice.parquet_backend) and written by src.pipelines.export_parquet.
+
+    <root>/ElectricityGeneration/RegionId=<id>/Month=<YYYY-MM>/data.parquet
+    <root>/<table name>.parquet  for each table of COMMON_TABLES
+
+Generation data is partitioned by region and (UTC) month like the partitions of the ElectricityGeneration table, in
+hive style so that RegionId and Month are columns of the dataset. Within a file, rows are sorted by GenerationTypeId
+and DateStamp (naive UTC), so the statistics of the row groups let readers skip the other generation types.
+"""
+import datetime
+import os
+import re
+import shutil
+import threading
+from pathlib import Path
+from typing import List
+
+import pandas as pd
+
+from src.orm.base import ElectricityGeneration, ElectricityGenerationTypes, ElectricityGenerationTypesMapping, EnvironmentalImpacts, \
+    GenerationDataVersions, ImpactCategories, Regions
+
+GENERATION_DIRECTORY = ElectricityGeneration.__tablename__
+GENERATION_FILE_NAME = 'data.parquet'
+# RegionId and Month are in the path
+GENERATION_FILE_COLUMNS = ['Id', 'DateStamp', 'GenerationTypeId', 'AggregatedGeneration', 'ResolutionMinutes', 'Energy']
+GENERATION_ROW_GROUP_SIZE = 16_384
+COMMON_TABLES = [table.__tablename__ for table in (Regions, ElectricityGenerationTypes, ElectricityGenerationTypesMapping,
+                                                   ImpactCategories, EnvironmentalImpacts, GenerationDataVersions)]
+MONTH_DIRECTORY_PATTERN = re.compile(r'^Month=(?P<month>\d{4}-\d{2})$')
+REGION_DIRECTORY_PATTERN = re.compile(r'^RegionId=(?P<region_id>\d+)$')
+
+
+def month_key(value: datetime.datetime) -> str:
+    return f'{value.year:04d}-{value.month:02d}'
+
+
+def table_path(root, table_name: str) -> Path:
+    return Path(root) / f'{table_name}.parquet'
+
+
+def generation_path(root, region_id: int, month_start: datetime.datetime) -> Path:
+    return Path(root) / GENERATION_DIRECTORY / f'RegionId={int(region_id)}' / f'Month={month_key(month_start)}' / GENERATION_FILE_NAME
+
+
+def generation_files(root, region_ids: List[int], start: datetime.datetime | None = None,
+                     end: datetime.datetime | None = None) -> List[Path]:
+    """Files of the generation data of the regions that can hold rows in [start, end] (naive UTC, None for unbounded)"""
+    first = None if start is None else month_key(start)
+    last = None if end is None else month_key(end)
+    files = []
+    for region_id in region_ids:
+        region_directory = Path(root) / GENERATION_DIRECTORY / f'RegionId={int(region_id)}'
+        if not region_directory.is_dir():
+            continue
+        for entry in sorted(os.listdir(region_directory)):
+            match = MONTH_DIRECTORY_PATTERN.match(entry)
+            if match is None or (first is not None and match.group('month') < first) or (last is not None and match.group('month') > last):
+                continue
+            path = region_directory / entry / GENERATION_FILE_NAME
+            if path.exists():
+                files.append(path)
+    return files
+
+
+def generation_months(root, region_id: int, start: datetime.datetime | None = None) -> List[datetime.datetime]:
+    """Month starts of the generation files of a region, from the month of `start` on"""
+    return [datetime.datetime.strptime(MONTH_DIRECTORY_PATTERN.match(path.parent.name).group('month'), '%Y-%m')
+            for path in generation_files(root, [region_id], start)]
+
+
+def generation_region_ids(root) -> List[int]:
+    """Regions with a directory of generation files"""
+    directory = Path(root) / GENERATION_DIRECTORY
+    if not directory.is_dir():
+        return []
+    matches = (REGION_DIRECTORY_PATTERN.match(entry) for entry in os.listdir(directory))
+    return sorted(int(match.group('region_id')) for match in matches if match is not None)
+
+
+def remove_generation_month(root, region_id: int, month_start: datetime.datetime) -> bool:
+    """Remove the generation file of a region and month, and the directories left empty. Returns whether it existed"""
+    path = generation_path(root, region_id, month_start)
+    if not path.exists():
+        return False
+    path.unlink()
+    for directory in (path.parent, path.parent.parent):
+        try:
+            directory.rmdir()
+        except OSError:  # Not empty
+            break
+    return True
+
+
+def remove_generation_region(root, region_id: int):
+    """Remove all the generation files of a region"""
+    shutil.rmtree(Path(root) / GENERATION_DIRECTORY / f'RegionId={int(region_id)}', ignore_errors=True)
+
+
+def write_parquet(df: pd.DataFrame, path: Path, **kwargs):
+    """Write a dataframe to a Parquet file, replacing it atomically so that readers never see a partial file"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary_path = path.with_name(f'{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    df.to_parquet(temporary_path, index=False, coerce_timestamps='us', allow_truncated_timestamps=True, **kwargs)
+    os.replace(temporary_path, path)
+
+
+def write_generation_month(root, region_id: int, month_start: datetime.datetime, generation_df: pd.DataFrame) -> Path:
+    """Write the generation data of a region and month (columns of GENERATION_FILE_COLUMNS) to its file"""
+    generation_df = (generation_df[GENERATION_FILE_COLUMNS]
+                     .astype({'Id': 'int64', 'GenerationTypeId': 'int64', 'AggregatedGeneration': 'float64',
+                              'ResolutionMinutes': 'Int64', 'Energy': 'float64'})
+                     .sort_values(['GenerationTypeId', 'DateStamp'], ignore_index=True))
+    path = generation_path(root, region_id, month_start)
+    write_parquet(generation_df, path, row_group_size=GENERATION_ROW_GROUP_SIZE)
+    return path
+
+
+def read_table(root, table_name: str) -> pd.DataFrame:
+    path = table_path(root, table_name)
+    if not path.exists():
+        raise FileNotFoundError(f'{path} not found. Please export the database with src.pipelines.export_parquet')
+    return pd.read_parquet(path)
@@ -0,0 +1,112 @@
+"""
+Monthly partitions of the ElectricityGeneration table.
+
+ElectricityGeneration is range partitioned on DateStamp, with one partition per (UTC) month named
+ElectricityGeneration_YYYY_MM. Partitions are created ahead of ingestion by ensure_partitions, and old months can be
+detached from the table (and then archived or dropped) without rewriting any other data.
+"""
+import datetime
+import logging
+import re
+from typing import List
+
+import pandas as pd
+import sqlalchemy as sqla
+
+from src.data.rollups import to_naive_utc
+from src.orm.base import ElectricityGeneration
+from src.orm.bulk import quote_identifier
+
+TABLE_NAME = ElectricityGeneration.__tablename__
+# Serializes the creation of partitions by concurrent writers
+PARTITION_LOCK_ID = 802_001
+PARTITION_NAME_PATTERN = re.compile(rf'^{TABLE_NAME}_(?P<year>\d{{4}})_(?P<month>\d{{2}})$')
+
+
+def partition_name(month_start: datetime.datetime) -> str:
+    return f'{TABLE_NAME}_{month_start.year:04d}_{month_start.month:02d}'
+
+
+def month_starts(start: datetime.datetime, end: datetime.datetime) -> List[datetime.datetime]:
+    """Start of every month that overlaps [start, end]"""
+    first = pd.Timestamp(start).to_period('M').to_timestamp()
+    last = pd.Timestamp(end).to_period('M').to_timestamp()
+    return [month.to_pydatetime() for month in pd.date_range(first, last, freq='MS')]
+
+
+def is_partitioned(connection) -> bool:
+    return connection.execute(sqla.text('''
+        SELECT EXISTS (SELECT 1 FROM pg_partitioned_table
+                       WHERE partrelid = to_regclass(:table_name))'''),
+                              {'table_name': quote_identifier(TABLE_NAME)}).scalar()
+
+
+def existing_partitions(connection) -> List[str]:
+    return list(connection.execute(sqla.text('''
+        SELECT child.relname FROM pg_inherits
+        JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = to_regclass(:table_name)
+        ORDER BY child.relname'''), {'table_name': quote_identifier(TABLE_NAME)}).scalars())
+
+
+def create_partition(connection, month_start: datetime.datetime):
+    month_end = (pd.Timestamp(month_start) + pd.DateOffset(months=1)).to_pydatetime()
+    connection.execute(sqla.text(
+        f'CREATE TABLE IF NOT EXISTS {quote_identifier(partition_name(month_start))} '
+        f'PARTITION OF {quote_identifier(TABLE_NAME)} '
+        f"FOR VALUES FROM ('{month_start.isoformat(sep=' ')}') TO ('{month_end.isoformat(sep=' ')}')"))
+    logging.info(f'Created partition {partition_name(month_start)}')
+
+
+def ensure_partitions(sql_engine, start, end, months_ahead: int = 1) -> List[str]:
+    """Create the partitions of the months overlapping [start, end], and of `months_ahead` months after, that do not
+    exist yet. Runs in its own short transaction, so that the lock taken on ElectricityGeneration to create a partition
+    is not held for the duration of the ingestion. Does nothing if the table is not partitioned.
+
+    @param sql_engine: SQL engine to the elec_lca database
+    @param start: First DateStamp to be written (tz-aware or naive UTC)
+    @param end: Last DateStamp to be written (tz-aware or naive UTC)
+    @param months_ahead: Number of months after `end` to create partitions for
+    @return: Names of the partitions created
+    """
+    end = (pd.Timestamp(to_naive_utc(end)) + pd.DateOffset(months=months_ahead)).to_pydatetime()
+    months = month_starts(to_naive_utc(start), end)
+    with sql_engine.connect() as connection:
+        if not is_partitioned(connection):
+            return []
+        existing = set(existing_partitions(connection))
+    missing = [month for month in months if partition_name(month) not in existing]
+    if len(missing) == 0:
+        return []
+    with sql_engine.begin() as connection:
+        connection.execute(sqla.text('SELECT pg_advisory_xact_lock(:lock_id)'), {'lock_id': PARTITION_LOCK_ID})
+        for month in missing:
+            create_partition(connection, month)
+    return [partition_name(month) for month in missing]
+
+
+def detach_partitions_before(sql_engine, before, drop: bool = False) -> List[str]:
+    """Detach the partitions of the months that end before `before` from ElectricityGeneration. Detached partitions
+    are standalone tables that can be archived (e.g. with pg_dump) and then dropped; with `drop` they are dropped
+    right away. The rollups are left untouched, so monthly and daily totals remain available (as long as they are not
+    rebuilt from scratch with rebuild_rollups).
+
+    @return: Names of the partitions detached
+    """
+    before = to_naive_utc(before)
+    with sql_engine.begin() as connection:
+        detached = []
+        for name in existing_partitions(connection):
+            match = PARTITION_NAME_PATTERN.match(name)
+            if match is None:
+                continue
+            month_end = (pd.Timestamp(year=int(match.group('year')), month=int(match.group('month')), day=1)
+                         + pd.DateOffset(months=1)).to_pydatetime()
+            if month_end > before:
+                continue
+            connection.execute(sqla.text(f'ALTER TABLE {quote_identifier(TABLE_NAME)} DETACH PARTITION {quote_identifier(name)}'))
+            if drop:
+                connection.execute(sqla.text(f'DROP TABLE {quote_identifier(name)}'))
+            logging.info(f'{"Dropped" if drop else "Detached"} partition {name}')
+            detached.append(name)
+    return detached
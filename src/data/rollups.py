@@ -0,0 +1,173 @@
+"""
+Hourly, daily and monthly rollups of the ElectricityGeneration table.
+
+Each rollup row holds the mean power of the rows of its period (AggregatedGeneration, MW), the energy generated over
+them (Energy, MWh) and the number of rows with a value (SampleCount), which weights the mean when a coarser period is
+computed from finer ones. The rollups are kept up to date incrementally: after generation data is stored, only the
+periods of the (RegionId, GenerationTypeId) pairs that were written are recomputed. Queries at a coarse resolution read from the
+smallest rollup that can answer them (see choose_generation_source).
+"""
+import datetime
+import logging
+from typing import List
+
+import pandas as pd
+import sqlalchemy as sqla
+
+from src.microservice.constants import TIMEZONE
+from src.orm.base import ElectricityGeneration, ElectricityGenerationHourly, ElectricityGenerationDaily, ElectricityGenerationMonthly
+
+# Rollup tables by resolution, finest first. Each one is computed from the previous one
+ROLLUPS = {
+    'hour': ElectricityGenerationHourly,
+    'day': ElectricityGenerationDaily,
+    'month': ElectricityGenerationMonthly,
+}
+
+ROLLUP_COLUMNS = ['RegionId', 'GenerationTypeId', 'DateStamp', 'AggregatedGeneration', 'Energy', 'SampleCount']
+
+# Rollups whose periods nest into the periods of each resolution, coarsest (fewest rows) first
+ROLLUPS_FOR_RESOLUTION = {
+    'hour': ['hour'],
+    'day': ['day', 'hour'],
+    'week': ['day', 'hour'],
+    'month': ['month', 'day', 'hour'],
+    'year': ['month', 'day', 'hour'],
+}
+
+
+def period_start(resolution: str, date_stamp):
+    """SQL expression for the start of the `resolution` long period containing `date_stamp`.
+    DateStamp is naive UTC, periods are truncated in local time (TIMEZONE) and returned as naive UTC again"""
+    # Constants are rendered inline so that the expression in the GROUP BY matches the one in the SELECT
+    utc = sqla.literal('UTC', literal_execute=True)
+    local_period = sqla.func.date_trunc(sqla.literal(resolution, literal_execute=True),
+                                        sqla.func.timezone(utc, date_stamp),
+                                        sqla.literal(TIMEZONE, literal_execute=True))
+    return sqla.func.timezone(utc, local_period)
+
+
+def to_naive_utc(value) -> datetime.datetime:
+    """Convert a timestamp to naive UTC, the convention of the DateStamp columns. Naive values are returned as is"""
+    timestamp = pd.Timestamp(value)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.tz_convert('UTC').tz_localize(None)
+    return timestamp.to_pydatetime()
+
+
+def floor_to_period(value: datetime.datetime, resolution: str) -> datetime.datetime:
+    """Python equivalent of period_start for a naive UTC datetime"""
+    timestamp = pd.Timestamp(value)
+    if resolution == 'hour':
+        # Europe/Brussels is a whole number of hours from UTC, and this avoids ambiguous hours at the end of DST
+        return timestamp.floor('h').to_pydatetime()
+    local = timestamp.tz_localize('UTC').tz_convert(TIMEZONE).tz_localize(None).normalize()
+    if resolution == 'week':
+        local = local - pd.Timedelta(days=local.weekday())
+    elif resolution == 'month':
+        local = local.replace(day=1)
+    elif resolution == 'year':
+        local = local.replace(month=1, day=1)
+    elif resolution != 'day':
+        raise ValueError(f'Unknown resolution `{resolution}`')
+    return local.tz_localize(TIMEZONE).tz_convert('UTC').tz_localize(None).to_pydatetime()
+
+
+def next_period_start(value: datetime.datetime, resolution: str) -> datetime.datetime:
+    """Return the start of the period after the one containing the naive UTC datetime `value`"""
+    start = pd.Timestamp(floor_to_period(value, resolution))
+    if resolution == 'hour':
+        return (start + pd.Timedelta(hours=1)).to_pydatetime()
+    offsets = {'day': pd.DateOffset(days=1), 'week': pd.DateOffset(weeks=1),
+               'month': pd.DateOffset(months=1), 'year': pd.DateOffset(years=1)}
+    local = start.tz_localize('UTC').tz_convert(TIMEZONE).tz_localize(None) + offsets[resolution]
+    return local.tz_localize(TIMEZONE).tz_convert('UTC').tz_localize(None).to_pydatetime()
+
+
+def is_aligned(value: datetime.datetime | None, resolution: str) -> bool:
+    """True if `value` is None or the start of a period"""
+    return value is None or floor_to_period(value, resolution) == value
+
+
+def choose_generation_source(resolution: str | None, start: datetime.datetime | None, end: datetime.datetime | None):
+    """Return the smallest table that can answer a query for aggregates per `resolution` in [start, end): the coarsest
+    rollup that nests into the resolution and whose periods are aligned with the range. Falls back to
+    ElectricityGeneration"""
+    if resolution is None:
+        return ElectricityGeneration
+    for candidate in ROLLUPS_FOR_RESOLUTION[resolution]:
+        if is_aligned(start, candidate) and is_aligned(end, candidate):
+            return ROLLUPS[candidate]
+    return ElectricityGeneration
+
+
+def sample_count(source):
+    """SQL expression of the number of rows with a value of a group of rows of the table `source`"""
+    if source is ElectricityGeneration:
+        return sqla.func.count(source.AggregatedGeneration)
+    return sqla.func.sum(source.SampleCount)
+
+
+def mean_generation(source):
+    """SQL expression of the mean power (MW) of a group of rows of the table `source`. The means of rollup rows are
+    weighted by their SampleCount"""
+    if source is ElectricityGeneration:
+        return sqla.func.avg(source.AggregatedGeneration)
+    return sqla.func.sum(source.AggregatedGeneration * source.SampleCount) / sqla.func.nullif(sqla.func.sum(source.SampleCount), 0)
+
+
+def rollup_select(resolution: str, source):
+    """Select the mean power, energy and sample count per region, generation type and period of the table `source`"""
+    period = period_start(resolution, source.DateStamp)
+    return (sqla.select(source.RegionId,
+                        source.GenerationTypeId,
+                        period,
+                        mean_generation(source),
+                        sqla.func.sum(source.Energy),
+                        sample_count(source))
+            .group_by(source.RegionId, source.GenerationTypeId, period))
+
+
+def refresh_rollups(connection, region_id: int, generation_type_ids: List[int], start: datetime.datetime, end: datetime.datetime):
+    """Recompute the rollup periods that overlap [start, end] for a region and generation types, after the
+    generation data in that range was written. Runs in the transaction of `connection`.
+
+    @param connection: SQLAlchemy connection
+    @param region_id: Internal region id
+    @param generation_type_ids: Internal generation type ids that were written
+    @param start: First DateStamp written
+    @param end: Last DateStamp written
+    """
+    start = to_naive_utc(start)
+    end = to_naive_utc(end)
+    generation_type_ids = [int(i) for i in generation_type_ids]
+    source = ElectricityGeneration
+    for resolution, rollup in ROLLUPS.items():
+        period_from = floor_to_period(start, resolution)
+        period_to = next_period_start(end, resolution)
+        table = rollup.__table__
+        connection.execute(table.delete()
+                           .where(table.c.RegionId == int(region_id))
+                           .where(table.c.GenerationTypeId.in_(generation_type_ids))
+                           .where(table.c.DateStamp >= period_from)
+                           .where(table.c.DateStamp < period_to))
+        query = (rollup_select(resolution, source)
+                 .where(source.RegionId == int(region_id))
+                 .where(source.GenerationTypeId.in_(generation_type_ids))
+                 .where(source.DateStamp >= period_from)
+                 .where(source.DateStamp < period_to))
+        result = connection.execute(table.insert().from_select(ROLLUP_COLUMNS, query))
+        logging.debug(f'Refreshed {result.rowcount} rows of {rollup.__tablename__} for region={region_id}, '
+                      f'periods `{period_from}`-`{period_to}`')
+        source = rollup  # The next, coarser, rollup is computed from this one
+
+
+def rebuild_rollups(connection):
+    """Recompute all the rollups from scratch. Only needed to initialize the rollups of existing data"""
+    source = ElectricityGeneration
+    for resolution, rollup in ROLLUPS.items():
+        table = rollup.__table__
+        connection.execute(table.delete())
+        result = connection.execute(table.insert().from_select(ROLLUP_COLUMNS, rollup_select(resolution, source)))
+        logging.info(f'{result.rowcount} rows written to {rollup.__tablename__}')
+        source = rollup
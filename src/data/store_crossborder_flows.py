@@ -0,0 +1,85 @@
+import logging
+import time
+
+import pandas as pd
+import sqlalchemy
+
+from src.data.store_generation_data import infer_resolution_minutes
+from src.orm.bulk import copy_df_to_table
+
+FLOW_COLUMNS = ['FromRegionId', 'ToRegionId', 'DateStamp', 'Flow', 'ResolutionMinutes']
+BORDER_KEYS = ['FromRegionId', 'ToRegionId']
+STAGING_TABLE = 'staging_crossborder_flows'
+
+
+def entsoe_flows_to_long_df(flows: pd.Series, from_region_id: int, to_region_id: int) -> pd.DataFrame:
+    """
+    Reshape the series returned by EntsoePandasClient.query_crossborder_flows into the rows of the CrossBorderFlows
+        table. The resolution of each row is inferred from the index (see infer_resolution_minutes).
+
+    @param flows: Physical flow in MW from one region to the other, indexed by the timestamps of the beginning of each interval
+    @param from_region_id: Internal region id the flow leaves
+    @param to_region_id: Internal region id the flow enters
+    @return: Dataframe with the columns of FLOW_COLUMNS
+    """
+    long_df = pd.DataFrame({'FromRegionId': from_region_id,
+                            'ToRegionId': to_region_id,
+                            'DateStamp': flows.index,
+                            'Flow': flows.to_numpy(dtype=float)})
+    long_df['ResolutionMinutes'] = infer_resolution_minutes(long_df, keys=[])
+    return long_df[FLOW_COLUMNS]
+
+
+def store_crossborder_flow_frame_to_db(values_to_insert: pd.DataFrame, sql_engine: sqlalchemy.Engine) -> int:
+    """
+    Store cross-border flows to the CrossBorderFlows table in one transaction. For each border direction in the data,
+        existing rows between its first and last DateStamp are replaced. Like store_generation_frame_to_db, rows are
+        loaded into a staging table with COPY, then the interval is replaced with one DELETE and one INSERT ... SELECT,
+        which computes the energy of each interval.
+
+    @param values_to_insert: Dataframe with columns FromRegionId, ToRegionId, DateStamp (tz-aware, or naive UTC),
+        Flow (MW) and optionally ResolutionMinutes, inferred from the DateStamps of each border direction if missing
+    @param sql_engine: SQL engine to the elec_lca database
+    @return: Number of rows written
+    """
+    s = time.time()
+    if len(values_to_insert) == 0:
+        return 0
+    values_to_insert = values_to_insert.copy()
+    if 'ResolutionMinutes' not in values_to_insert.columns:
+        values_to_insert['ResolutionMinutes'] = infer_resolution_minutes(values_to_insert, keys=BORDER_KEYS)
+    values_to_insert = values_to_insert[FLOW_COLUMNS]
+    date_stamps = pd.to_datetime(values_to_insert['DateStamp'])
+    if date_stamps.dt.tz is not None:
+        date_stamps = date_stamps.dt.tz_convert('UTC').dt.tz_localize(None)
+    values_to_insert['DateStamp'] = date_stamps
+
+    with sql_engine.begin() as connection:
+        cursor = connection.connection.cursor()
+        cursor.execute(f'''
+            CREATE TEMP TABLE "{STAGING_TABLE}" (
+                "FromRegionId" integer,
+                "ToRegionId" integer,
+                "DateStamp" timestamp,
+                "Flow" double precision,
+                "ResolutionMinutes" integer
+            ) ON COMMIT DROP''')
+        copy_df_to_table(cursor, values_to_insert, STAGING_TABLE, FLOW_COLUMNS)
+
+        cursor.execute(f'''
+            DELETE FROM "CrossBorderFlows" AS f
+            USING (SELECT "FromRegionId", "ToRegionId", min("DateStamp") AS "Start", max("DateStamp") AS "End"
+                   FROM "{STAGING_TABLE}" GROUP BY "FromRegionId", "ToRegionId") AS s
+            WHERE f."FromRegionId" = s."FromRegionId"
+              AND f."ToRegionId" = s."ToRegionId"
+              AND f."DateStamp" BETWEEN s."Start" AND s."End"''')
+        logging.info(f'{cursor.rowcount} flows deleted, that already existed for the intervals written')
+
+        cursor.execute(f'''
+            INSERT INTO "CrossBorderFlows" ("FromRegionId", "ToRegionId", "DateStamp", "Flow", "ResolutionMinutes", "Energy")
+            SELECT "FromRegionId", "ToRegionId", "DateStamp", "Flow", "ResolutionMinutes", "Flow" * "ResolutionMinutes" / 60.0
+            FROM "{STAGING_TABLE}"''')
+        count_rows = cursor.rowcount
+
+    logging.info(f'Inserted {count_rows} cross-border flows in {time.time() - s:.2f} s')
+    return count_rows
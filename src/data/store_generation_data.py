@@ -1,11 +1,22 @@
+import datetime
 import logging
 import time
+from typing import Iterable, List, Tuple
 
+import numpy as np
 import pandas as pd
 import sqlalchemy
-from sqlalchemy.orm import sessionmaker
 
-from src.orm.base import sql_alchemy_base
+from src.data.data_versions import bump_data_versions
+from src.data.get_common_data import ENTSOE_DATA_SOURCE_NAME, GenerationMappings
+from src.data.partitions import ensure_partitions
+from src.data.rollups import refresh_rollups
+from src.orm.bulk import copy_df_to_table
+
+GENERATION_COLUMNS = ['RegionId', 'GenerationTypeId', 'DateStamp', 'AggregatedGeneration', 'ResolutionMinutes']
+SERIES_KEYS = ['RegionId', 'GenerationTypeId']
+STAGING_TABLE = 'staging_electricity_generation'
+REGION_LOCK_ID = 802_002  # With the region id, advisory lock of the writers of a region
 
 
 def store_generation_data_to_db(
@@ -23,16 +34,12 @@ def store_generation_data_to_db(
     @param sql_engine: SQL engine to the elec_lca database
     @return:
     """
-    s_1 = time.time()
-
     # Validate the Series provided:
     try:
         assert isinstance(generation_mw.index[0], pd.Timestamp)
         assert isinstance(generation_mw.values[0,0], float)
     except AssertionError as e:
         raise e
-    start = generation_mw.index.min()
-    end = generation_mw.index.max()
 
     # Create dataframe of values to insert
     values_to_insert = pd.DataFrame({'RegionId': region_id,
@@ -40,23 +47,216 @@ def store_generation_data_to_db(
                                      'GenerationTypeId': generation_type_id,
                                      'AggregatedGeneration': generation_mw['Actual Aggregated'].values}
                                     )
-    logging.info(values_to_insert)
-    session_obj = sessionmaker(bind=sql_engine)
-    with session_obj() as session:
-        elec_gen_table = sqlalchemy.Table('ElectricityGeneration', sql_alchemy_base.metadata, autoload=True)
-        delete_query = elec_gen_table.delete().where(
-            (elec_gen_table.c.DateStamp >= start) &
-            (elec_gen_table.c.DateStamp <= end) &
-            (elec_gen_table.c.RegionId == int(region_id)) &
-            (elec_gen_table.c.GenerationTypeId == int(generation_type_id))
-        )
-        deletion_result = session.execute(delete_query)
-        session.commit()
-        logging.info(f'{deletion_result.rowcount} rows deleted, that already existed for region={region_id}, date range=`{start}`-`{end}` and generation type={generation_type_id}')
-
-    time.sleep(1)
-    count_rows = values_to_insert.to_sql('ElectricityGeneration', sql_engine, if_exists='append', index=False)
-    logging.info(f'Inserted {count_rows} values for region with id = `{region_id}` to database')
-    e = time.time()
-    logging.info(f'{e - s_1:.2f} s to write to database')
+    store_generation_frame_to_db(values_to_insert, sql_engine)
     return True
+
+
+def infer_resolution_minutes(long_df: pd.DataFrame, keys: List[str] = SERIES_KEYS) -> pd.Series:
+    """
+    Length in minutes of the interval starting at each row's DateStamp, from the time steps of its series: the shorter
+        of the steps to the previous and to the next DateStamp, so that a hole in a series does not lengthen the
+        intervals next to it, and a change of resolution is picked up from the first interval at the new resolution.
+        The first and last rows of a series, which have a single step, get the resolution of the row next to them.
+
+    @param long_df: Dataframe with a DateStamp column and the `keys` columns identifying the series
+    @param keys: Columns identifying a series. With no keys, all rows are one series
+    @return: Series of minutes (Int64) aligned with `long_df`, NA for series of a single DateStamp
+    """
+    series = long_df[keys].assign(DateStamp=pd.to_datetime(long_df['DateStamp'])).sort_values([*keys, 'DateStamp'])
+
+    def by_series(values: pd.Series):
+        return values.groupby([series[key] for key in keys], sort=False) if len(keys) > 0 else values
+
+    backward = by_series(series['DateStamp']).diff()
+    forward = -by_series(series['DateStamp']).diff(-1)
+    backward, forward = backward.where(backward > pd.Timedelta(0)), forward.where(forward > pd.Timedelta(0))
+    steps = pd.concat([backward, forward], axis=1).min(axis=1)
+    steps = steps.mask(backward.isna(), by_series(steps).shift(-1)).mask(forward.isna(), by_series(steps).shift(1))
+    return (steps.dt.total_seconds() / 60).round().astype('Int64').reindex(long_df.index)
+
+
+def entsoe_generation_to_long_df(
+        generation: pd.DataFrame,
+        region_id: int,
+        cache: GenerationMappings,
+        generation_type_filter: List[Tuple] = None,
+        resolution_minutes=None) -> pd.DataFrame:
+    """
+    Reshape the wide frame returned by EntsoePandasClient.query_generation (one column per ENTSO-E generation type) into
+        long format, with the ENTSO-E generation types mapped to internal generation type ids. ENTSO-E generation types
+        that map to the same internal generation type are summed.
+
+    @param generation: Wide generation data in MW, indexed by the timestamps of the beginning of each interval. Columns
+        are either generation type names, or (generation type name, 'Actual Aggregated' / 'Actual Consumption') tuples
+    @param region_id: Internal region id (int)
+    @param cache: BasicDataCache, or other GenerationMappings, for the generation type mappings
+    @param generation_type_filter: If passed, only keep these generation types. Each element of the list should be a
+        tuple, like ('Fossil Hard coal', 'Actual Aggregated')
+    @param resolution_minutes: Length in minutes of the interval of each row of `generation`. By default, it is
+        inferred from the index
+    @return: Dataframe with columns RegionId, GenerationTypeId, DateStamp, AggregatedGeneration and ResolutionMinutes
+    """
+    if isinstance(generation.columns, pd.MultiIndex):
+        # Regions with storage also report consumption. Only the generation is stored
+        generation = generation.loc[:, generation.columns.get_level_values(1) == 'Actual Aggregated']
+        generation.columns = generation.columns.get_level_values(0)
+
+    if generation_type_filter is not None:
+        names_in_filter = {f[0] if isinstance(f, tuple) else f for f in generation_type_filter}
+        skipped = [name for name in generation.columns if name not in names_in_filter]
+        if len(skipped) > 0:
+            logging.debug(f'Skipping generation types `{skipped}` as not in the generation type filter')
+        generation = generation[[name for name in generation.columns if name in names_in_filter]]
+
+    generation_type_ids = generation.columns.map(
+        lambda name: cache.generation_type_id_by_external_name.get((ENTSOE_DATA_SOURCE_NAME, name)))
+    unmapped = generation.columns[generation_type_ids.isna()].to_list()
+    if len(unmapped) > 0:
+        logging.warning(f'No mapping for entsoepy generation types `{unmapped}` to an internal generation type id. Will skip these generation types')
+
+    long_df = (generation.set_axis(generation_type_ids, axis=1)
+               .loc[:, generation_type_ids.notna()]
+               .rename_axis(index='DateStamp', columns='GenerationTypeId')
+               .melt(ignore_index=False, value_name='AggregatedGeneration')
+               .reset_index())
+    long_df = (long_df.groupby(['GenerationTypeId', 'DateStamp'], as_index=False, sort=False)['AggregatedGeneration']
+               .sum(min_count=1))
+    long_df['GenerationTypeId'] = long_df['GenerationTypeId'].astype(int)
+    long_df['RegionId'] = region_id
+    # All the generation types share the index, so the resolution is that of each timestamp of the index
+    if resolution_minutes is None:
+        resolution_minutes = infer_resolution_minutes(pd.DataFrame({'DateStamp': generation.index}), keys=[])
+    resolution_by_date_stamp = pd.Series(np.asarray(resolution_minutes), index=generation.index, dtype='Int64')
+    long_df['ResolutionMinutes'] = resolution_by_date_stamp.reindex(long_df['DateStamp']).to_numpy()
+    return long_df[GENERATION_COLUMNS]
+
+
+def prepare_generation_frame(values_to_insert: pd.DataFrame) -> pd.DataFrame:
+    """Columns of GENERATION_COLUMNS of long format generation data, with naive UTC DateStamps and the missing
+    resolutions inferred from the DateStamps of each series"""
+    values_to_insert = values_to_insert.copy()
+    if 'ResolutionMinutes' not in values_to_insert.columns:
+        values_to_insert['ResolutionMinutes'] = infer_resolution_minutes(values_to_insert)
+    elif values_to_insert['ResolutionMinutes'].isna().any():
+        values_to_insert['ResolutionMinutes'] = values_to_insert['ResolutionMinutes'].astype('Int64').fillna(infer_resolution_minutes(values_to_insert))
+    values_to_insert = values_to_insert[GENERATION_COLUMNS]
+    date_stamps = pd.to_datetime(values_to_insert['DateStamp'])
+    if date_stamps.dt.tz is not None:
+        date_stamps = date_stamps.dt.tz_convert('UTC').dt.tz_localize(None)
+    values_to_insert['DateStamp'] = date_stamps
+    return values_to_insert
+
+
+def create_staging_table(cursor):
+    """Create the temporary table that generation data is copied to before it replaces the stored data. It is dropped
+    at the end of the transaction"""
+    cursor.execute(f'''
+        CREATE TEMP TABLE "{STAGING_TABLE}" (
+            "RegionId" integer,
+            "GenerationTypeId" integer,
+            "DateStamp" timestamp,
+            "AggregatedGeneration" double precision,
+            "ResolutionMinutes" integer
+        ) ON COMMIT DROP''')
+
+
+def merge_staging_table(connection, cursor, start: datetime.datetime, end: datetime.datetime) -> int:
+    """Replace the stored generation data by the staged data. For each (RegionId, GenerationTypeId) staged, existing
+    rows between its first and last DateStamp are replaced with one DELETE and one INSERT ... SELECT, which only touch
+    the monthly partitions of [start, end] (the first and last DateStamp staged). The energy of each interval is computed
+    by the INSERT from its resolution. The rollups and data versions of the written data are updated in the same
+    transaction. Writers of the same region wait for each other, so that its rollups are never refreshed concurrently.
+
+    @return: Number of rows written
+    """
+    cursor.execute(f'''
+        SELECT "RegionId", array_agg(DISTINCT "GenerationTypeId"), min("DateStamp"), max("DateStamp")
+        FROM "{STAGING_TABLE}" GROUP BY "RegionId" ORDER BY "RegionId"''')
+    regions = cursor.fetchall()
+    # In the order of the region ids, so that two writers of several regions cannot deadlock
+    for region_id, _, _, _ in regions:
+        cursor.execute('SELECT pg_advisory_xact_lock(%(lock_id)s, %(region_id)s)', {'lock_id': REGION_LOCK_ID, 'region_id': region_id})
+
+    cursor.execute(f'''
+        DELETE FROM "ElectricityGeneration" AS g
+        USING (SELECT "RegionId", "GenerationTypeId", min("DateStamp") AS "Start", max("DateStamp") AS "End"
+               FROM "{STAGING_TABLE}" GROUP BY "RegionId", "GenerationTypeId") AS s
+        WHERE g."RegionId" = s."RegionId"
+          AND g."GenerationTypeId" = s."GenerationTypeId"
+          AND g."DateStamp" BETWEEN s."Start" AND s."End"
+          AND g."DateStamp" BETWEEN %(start)s AND %(end)s''', {'start': start, 'end': end})
+    logging.info(f'{cursor.rowcount} rows deleted, that already existed for the intervals written')
+
+    # A series of a single interval, e.g. the last hour of an hourly region, has the resolution of the row before it
+    cursor.execute(f'''
+        INSERT INTO "ElectricityGeneration" ("RegionId", "GenerationTypeId", "DateStamp", "AggregatedGeneration", "ResolutionMinutes", "Energy")
+        SELECT s."RegionId", s."GenerationTypeId", s."DateStamp", s."AggregatedGeneration", r."ResolutionMinutes",
+               s."AggregatedGeneration" * r."ResolutionMinutes" / 60.0
+        FROM "{STAGING_TABLE}" AS s
+        CROSS JOIN LATERAL (
+            SELECT coalesce(s."ResolutionMinutes", (
+                SELECT g."ResolutionMinutes" FROM "ElectricityGeneration" AS g
+                WHERE g."RegionId" = s."RegionId" AND g."GenerationTypeId" = s."GenerationTypeId"
+                  AND g."DateStamp" < s."DateStamp" AND g."ResolutionMinutes" IS NOT NULL
+                ORDER BY g."DateStamp" DESC LIMIT 1)) AS "ResolutionMinutes") AS r''')
+    count_rows = cursor.rowcount
+
+    # Update only the rollup periods touched by this data, and let readers know it changed
+    for region_id, generation_type_ids, region_start, region_end in regions:
+        refresh_rollups(connection, region_id, generation_type_ids, region_start, region_end)
+        bump_data_versions(connection, region_id, generation_type_ids)
+    return count_rows
+
+
+def store_generation_frame_to_db(values_to_insert: pd.DataFrame, sql_engine: sqlalchemy.Engine) -> int:
+    """
+    Store long format generation data to the ElectricityGeneration table in one transaction. For each
+        (RegionId, GenerationTypeId) in the data, existing rows between its first and last DateStamp are replaced.
+        Rows are streamed into a temporary staging table with COPY, and then replace the stored data (see
+        merge_staging_table) in the monthly partitions of the written range, created beforehand if needed.
+
+    @param values_to_insert: Dataframe with columns RegionId, GenerationTypeId, DateStamp (tz-aware, or naive UTC),
+        AggregatedGeneration (MW) and optionally ResolutionMinutes. Missing resolutions are inferred from the DateStamps
+        of each series, or else taken from the last row stored before it
+    @param sql_engine: SQL engine to the elec_lca database
+    @return: Number of rows written
+    """
+    return store_generation_frames_to_db([values_to_insert], sql_engine)
+
+
+def store_generation_frames_to_db(frames: Iterable[pd.DataFrame], sql_engine: sqlalchemy.Engine) -> int:
+    """
+    Store several frames of long format generation data, e.g. the chunks of an export, in one transaction, like
+        store_generation_frame_to_db. The frames are copied to the staging table as they come, so only one of them is
+        in memory at a time, and the stored data is only locked and replaced once they are all staged. The resolutions
+        missing from a frame are inferred from its own DateStamps.
+
+    @param frames: Iterable of dataframes, see store_generation_frame_to_db. If it raises, nothing is written
+    @param sql_engine: SQL engine to the elec_lca database
+    @return: Number of rows written
+    """
+    s_1 = time.time()
+    start, end = None, None
+    with sql_engine.begin() as connection:
+        cursor = connection.connection.cursor()
+        for values_to_insert in frames:
+            if len(values_to_insert) == 0:
+                continue
+            values_to_insert = prepare_generation_frame(values_to_insert)
+            frame_start = values_to_insert['DateStamp'].min().to_pydatetime()
+            frame_end = values_to_insert['DateStamp'].max().to_pydatetime()
+            # The staging table is temporary, so the partitions can be created in their own transaction meanwhile
+            ensure_partitions(sql_engine, frame_start, frame_end)
+            if start is None:
+                create_staging_table(cursor)
+                start, end = frame_start, frame_end
+            start, end = min(start, frame_start), max(end, frame_end)
+            copy_df_to_table(cursor, values_to_insert, STAGING_TABLE, GENERATION_COLUMNS)
+        if start is None:
+            return 0
+        count_rows = merge_staging_table(connection, cursor, start, end)
+
+    e = time.time()
+    logging.info(f'Inserted {count_rows} values from `{start}` to `{end}` to database')
+    logging.info(f'{e - s_1:.2f} s to write to database ({count_rows / max(e - s_1, 1e-9):.0f} rows/s)')
+    return count_rows
@@ -1,20 +1,191 @@
 # -*- coding: utf-8 -*-
+"""
+Loader of the "Actual Generation per Production Type" CSV exports of the ENTSO-E Transparency Platform.
+
+The exports have one row per market time unit (MTU), e.g. `18.12.2023 00:00 - 18.12.2023 00:15 (CET/CEST)`, and one
+column per generation type, e.g. `Fossil Gas  - Actual Aggregated [MW]`, with `n/e` for values that are not expected.
+Files are read in chunks (or record batches with the pyarrow engine) so that memory stays bounded whatever the size of
+the export, and each chunk is converted to the long format of the ElectricityGeneration table.
+"""
+import csv
 import logging
+import os
+import re
+from collections import defaultdict
 from pathlib import Path
-from dotenv import find_dotenv, load_dotenv
+from typing import Iterator, List
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv
+import sqlalchemy
+from dotenv import find_dotenv, load_dotenv
+
+from src.data.get_common_data import BasicDataCache, ENTSOE_DATA_SOURCE_NAME, GenerationMappings, load_common_data_from_db
+from src.data.store_generation_data import GENERATION_COLUMNS, entsoe_generation_to_long_df, store_generation_frame_to_db
+from src.microservice.constants import TIMEZONE
+
+AREA_COLUMN = 'Area'
+MTU_COLUMN = 'MTU'
+MTU_FORMAT = '%d.%m.%Y %H:%M'
+GENERATION_COLUMN_PATTERN = re.compile(r'^(?P<name>.+?)\s+- Actual Aggregated \[MW\]$')
+NA_VALUES = ['n/e', 'N/A', '-']
+CHUNK_SIZE = 100_000
+ENGINES = ('c', 'pyarrow')
+
+
+def read_header(filepath) -> List[str]:
+    with open(filepath, newline='', encoding='utf-8-sig') as f:
+        return next(csv.reader(f))
+
+
+def generation_type_columns(header: List[str]) -> dict:
+    """Map the `<type>  - Actual Aggregated [MW]` columns to ENTSO-E generation type names. Consumption columns are
+    left out"""
+    columns = {}
+    for column in header:
+        match = GENERATION_COLUMN_PATTERN.match(column)
+        if match is not None:
+            columns[column] = match.group('name')
+    return columns
+
+
+def region_code_from_area(area: str) -> str:
+    """`BZN|NL` -> `NL`, `BZN|DE-LU` -> `DE_LU`, the codes of the Regions table"""
+    return area.split('|')[-1].replace('-', '_')
+
+
+class MtuParser:
+    """Vectorized conversion of MTU strings to tz-aware interval start timestamps.
+
+    MTUs are in local time. At the end of daylight saving time the local times of one hour occur twice in the export,
+    first in summer time and then in winter time. The parser remembers the ambiguous times it has seen for each area,
+    so that this is resolved correctly across chunks of the same file, also when a chunk holds several areas."""
+
+    def __init__(self, timezone: str = TIMEZONE):
+        self.timezone = timezone
+        self._ambiguous_seen = defaultdict(set)
+
+    def __call__(self, mtu: pd.Series, area: str = None) -> pd.DatetimeIndex:
+        """Parse the MTUs of one area, in the order of the export"""
+        local = pd.DatetimeIndex(pd.to_datetime(mtu.str.slice(0, 16), format=MTU_FORMAT))
+        ambiguous = local.tz_localize(self.timezone, ambiguous='NaT', nonexistent='raise').isna()
+        if not ambiguous.any():
+            return local.tz_localize(self.timezone)
+        # The first occurrence of an ambiguous time is in summer time (True), the second one in winter time
+        ambiguous_seen = self._ambiguous_seen[area]
+        repeated = pd.Series(local).duplicated(keep='first').to_numpy() | local.isin(list(ambiguous_seen))
+        ambiguous_seen.update(local[ambiguous])
+        return local.tz_localize(self.timezone, ambiguous=~repeated)
+
+
+def mtu_resolution_minutes(mtu: pd.Series) -> np.ndarray:
+    """Length in minutes of each MTU, from its local start and end times. Across a change of daylight saving time the
+    local times are an hour further apart (or closer) than the MTU is long, so as MTUs are at most an hour long the
+    difference is taken modulo an hour"""
+    start = pd.to_datetime(mtu.str.slice(0, 16), format=MTU_FORMAT)
+    end = pd.to_datetime(mtu.str.slice(19, 35), format=MTU_FORMAT)
+    minutes = ((end - start).dt.total_seconds() // 60).to_numpy(dtype=int)
+    return (minutes - 1) % 60 + 1
+
+
+def chunk_to_long_df(chunk: pd.DataFrame, columns: dict, parse_mtu: MtuParser, cache: GenerationMappings,
+                     region_id: int = None) -> pd.DataFrame:
+    """Convert a chunk of an export to long format (RegionId, GenerationTypeId, DateStamp, AggregatedGeneration,
+    ResolutionMinutes)"""
+    resolution_minutes = mtu_resolution_minutes(chunk[MTU_COLUMN])
+    areas = chunk[AREA_COLUMN].to_numpy()
+    long_dfs = []
+    for area in pd.unique(areas):
+        if region_id is not None:
+            area_region_id = region_id
+        else:
+            region_code = region_code_from_area(area)
+            if region_code not in cache.region_id_by_code:
+                raise ValueError(f'Could not find region {region_code} of area `{area}` in the Regions table. Please run fill_regions()')
+            area_region_id = cache.region_id_by_code[region_code]
+        rows = areas == area
+        date_stamps = parse_mtu(chunk.loc[rows, MTU_COLUMN], area)
+        generation = chunk.loc[rows, list(columns)]
+        generation = generation.set_axis(list(columns.values()), axis=1).set_axis(date_stamps, axis=0)
+        long_dfs.append(entsoe_generation_to_long_df(generation, area_region_id, cache, resolution_minutes=resolution_minutes[rows]))
+    if len(long_dfs) == 0:
+        return pd.DataFrame(columns=GENERATION_COLUMNS)
+    return pd.concat(long_dfs, ignore_index=True)
+
+
+def _read_chunks(filepath, columns: dict, chunksize: int, engine: str) -> Iterator[pd.DataFrame]:
+    if engine == 'pyarrow':
+        column_types = {column: pa.string() for column in (AREA_COLUMN, MTU_COLUMN)}
+        column_types.update({column: pa.float64() for column in columns})
+        reader = pyarrow.csv.open_csv(
+            filepath,
+            read_options=pyarrow.csv.ReadOptions(block_size=max(1 << 20, chunksize * 256)),
+            convert_options=pyarrow.csv.ConvertOptions(column_types=column_types,
+                                                       include_columns=[AREA_COLUMN, MTU_COLUMN, *columns],
+                                                       null_values=NA_VALUES,
+                                                       strings_can_be_null=False))
+        for batch in reader:
+            yield batch.to_pandas()
+    else:
+        dtypes = {column: 'float64' for column in columns}
+        dtypes.update({AREA_COLUMN: 'str', MTU_COLUMN: 'str'})
+        yield from pd.read_csv(filepath, usecols=[AREA_COLUMN, MTU_COLUMN, *columns], dtype=dtypes,
+                               na_values=NA_VALUES, keep_default_na=False, chunksize=chunksize, encoding='utf-8-sig')
+
+
+def iter_entsoe_csv(filepath, cache: GenerationMappings, region_id: int = None, chunksize: int = CHUNK_SIZE,
+                    engine: str = 'c') -> Iterator[pd.DataFrame]:
+    """Read an ENTSO-E "Actual Generation per Production Type" export in chunks of long format generation data.
+
+    @param filepath: Path of the CSV export
+    @param cache: BasicDataCache, or other GenerationMappings, for the regions and generation type mappings
+    @param region_id: Internal region id of the data. By default, it is looked up from the Area column
+    @param chunksize: Number of rows of the export per chunk (approximate with the pyarrow engine)
+    @param engine: `c` for pandas.read_csv, or `pyarrow` for the streaming reader of pyarrow
+    @return: Iterator of dataframes with columns RegionId, GenerationTypeId, DateStamp (tz-aware),
+        AggregatedGeneration (MW, NaN where the export has `n/e`) and ResolutionMinutes (length of the MTU)
+    """
+    if engine not in ENGINES:
+        raise ValueError(f'Invalid engine `{engine}`. Engine must be one of {", ".join(ENGINES)}')
+    header = read_header(filepath)
+    if AREA_COLUMN not in header or MTU_COLUMN not in header:
+        raise ValueError(f'{filepath} is not an ENTSO-E generation export: the `{AREA_COLUMN}` or `{MTU_COLUMN}` column is missing')
+    columns = generation_type_columns(header)
+    # Columns without a mapping are not read at all
+    unmapped = [name for name in columns.values() if (ENTSOE_DATA_SOURCE_NAME, name) not in cache.generation_type_id_by_external_name]
+    if len(unmapped) > 0:
+        logging.warning(f'No mapping for generation types `{unmapped}` of {filepath} to an internal generation type id. Will skip these generation types')
+    columns = {column: name for column, name in columns.items() if name not in unmapped}
+    parse_mtu = MtuParser()
+    for chunk in _read_chunks(filepath, columns, chunksize, engine):
+        yield chunk_to_long_df(chunk, columns, parse_mtu, cache, region_id)
+
+
+def store_entsoe_csv_to_db(filepath, cache: BasicDataCache, sql_engine, region_id: int = None,
+                           chunksize: int = CHUNK_SIZE, engine: str = 'c') -> int:
+    """Load an ENTSO-E export into the ElectricityGeneration table, one transaction per chunk.
+
+    @return: Number of rows written
+    """
+    count_rows = 0
+    for long_df in iter_entsoe_csv(filepath, cache, region_id=region_id, chunksize=chunksize, engine=engine):
+        count_rows += store_generation_frame_to_db(long_df, sql_engine)
+    logging.info(f'{count_rows} rows of {filepath} written to database')
+    return count_rows
+
 
 # @click.command()
 # @click.argument('input_filepath', type=click.Path(exists=True))
 # @click.argument('output_filepath', type=click.Path())
-def main(input_filepath):
+def main(input_filepath, cache: BasicDataCache):
     """ Runs data processing scripts to turn raw data from (../raw) into
         cleaned data ready to be analyzed (saved in ../processed).
     """
     logger = logging.getLogger(__name__)
     logger.info('making final data set from raw data')
-    entsoe_data = pd.read_csv(input_filepath)
+    entsoe_data = pd.concat(iter_entsoe_csv(input_filepath, cache), ignore_index=True)
     return entsoe_data
 
 if __name__ == '__main__':
@@ -29,4 +200,11 @@ if __name__ == '__main__':
     # load up the .env entries as environment variables
     load_dotenv(find_dotenv())
 
-    main(entsoe_data_path)
+    sql_engine = sqlalchemy.create_engine(sqlalchemy.engine.url.URL.create(
+        drivername='postgresql',
+        host=os.getenv('ELEC_LCA_HOST'),
+        database=os.getenv('ELEC_LCA_DB_NAME'),
+        username=os.getenv('ELEC_LCA_USER'),
+        password=os.getenv('ELEC_LCA_PASSWORD')
+    ))
+    store_entsoe_csv_to_db(entsoe_data_path, load_common_data_from_db(sql_engine), sql_engine)
@@ -0,0 +1,49 @@
+"""
+Read backends of the microservice.
+
+The data access functions of the microservice (src.microservice.generation, src.microservice.calculate and the result
+cache) only go through the GenerationBackend interface. One backend is chosen at startup with ELEC_LCA_BACKEND:
+PostgresBackend (src.microservice.database) queries the database, ParquetBackend (src.microservice.parquet_backend)
+queries a Parquet export of it.
+"""
+import abc
+import datetime
+from typing import AsyncIterator, List
+
+import pandas as pd
+
+from src.microservice.constants import STREAM_CHUNK_SIZE
+
+DATA_VERSION_COLUMNS = ['RegionId', 'GenerationTypeId', 'Version']
+
+
+class GenerationBackend(abc.ABC):
+    """Source of generation data and data versions. Region ids, generation type ids, dates and resolutions are
+    validated by the caller, and dates are naive UTC"""
+
+    @abc.abstractmethod
+    async def read_generation(self, region_ids: List[int], generation_type_ids: List[int], start: datetime.datetime | None = None,
+                              end: datetime.datetime | None = None, resolution: str | None = None,
+                              after: datetime.datetime | None = None, limit: int | None = None) -> pd.DataFrame:
+        """Rows of ElectricityGeneration, or their aggregates per region, generation type and period if a resolution is
+        given, of the regions and generation types in [start, end) and after the cursor `after`. Ordered by RegionId,
+        GenerationTypeId and DateStamp, and cut to `limit` rows"""
+
+    @abc.abstractmethod
+    async def count_generation(self, region_ids: List[int], generation_type_ids: List[int], start: datetime.datetime | None = None,
+                               end: datetime.datetime | None = None, resolution: str | None = None, limit: int | None = None) -> int:
+        """Number of rows read_generation returns, counted up to `limit`, without reading them"""
+
+    @abc.abstractmethod
+    def stream_generation(self, region_ids: List[int], generation_type_ids: List[int], start: datetime.datetime | None = None,
+                          end: datetime.datetime | None = None, resolution: str | None = None,
+                          chunk_size: int = STREAM_CHUNK_SIZE) -> AsyncIterator[pd.DataFrame]:
+        """Stream the result of read_generation in dataframes of up to `chunk_size` rows"""
+
+    @abc.abstractmethod
+    async def read_data_versions(self) -> pd.DataFrame:
+        """The GenerationDataVersions table, with the columns of DATA_VERSION_COLUMNS"""
+
+    @abc.abstractmethod
+    async def close(self):
+        """Release the connections of the backend"""
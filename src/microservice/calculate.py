@@ -1,11 +1,15 @@
 import logging
+from typing import AsyncIterator, List
+
 import pandas as pd
 from pydantic import BaseModel
-from sqlalchemy.orm import sessionmaker
 
-from src.microservice.constants import conversion_factors
-from src.microservice.generation import get_electricity_generation_df
-from src.orm.base import EnvironmentalImpacts
+from src.data.get_common_data import BasicDataCache
+from src.microservice.backend import GenerationBackend
+from src.microservice.constants import BATCH_ROW_LIMIT, DEFAULT_GENERATION_UNIT, ENERGY_COLUMN
+from src.microservice.generation import get_electricity_generation_batch_df, get_electricity_generation_df, stream_electricity_generation
+from src.microservice.formats import LONG_LAYOUT, WIDE_LAYOUT
+from src.microservice.impact_engine import WIDE_KEYS, calculate_impacts, impact_category_metadata, to_intensity_df, to_long_df, to_wide_df
 
 
 class ImpactResultSchema(BaseModel):
@@ -17,9 +21,9 @@ class ImpactResultSchema(BaseModel):
     model_config = {
         "json_schema_extra": {
             "examples": [{
-                "GenerationUnit": "MJ",
+                "GenerationUnit": "MWh",
                 "PerUnit": "kWh",
-                "ConversionFactor":3.6,
+                "ConversionFactor":1000,
                 "AggregatedGenerationConverted":2,
                 "EnvironmentalImpact":3
             }
@@ -28,43 +32,75 @@ class ImpactResultSchema(BaseModel):
     }
 
 
-async def calculate_impact_df(date_start, region_code: str, generation_type_id: int, engine):
+async def calculate_impact_df(date_start, date_end, region_code: str, generation_type_id: int, backend: GenerationBackend, cache: BasicDataCache,
+                              resolution: str | None = None, layout: str = LONG_LAYOUT):
     logging.debug(
-        f'Getting electricity generation data for date {date_start}, region code {region_code}, generation type id {generation_type_id}')
-    generation_df = await get_electricity_generation_df(date_start, None, region_code, generation_type_id,
-                                                        engine=engine)
+        f'Getting electricity generation data for dates {date_start} - {date_end}, region code {region_code}, generation type id {generation_type_id}')
+    generation_df = await get_electricity_generation_df(date_start, date_end, region_code, generation_type_id,
+                                                        backend=backend, cache=cache, resolution=resolution)
     logging.debug('Retrieved generation data')
-    environmental_impacts_df = await get_calculation_data(engine=engine)
+
+    return impacts_from_generation_df(generation_df, cache, layout=layout)
+
+
+def stream_impact_dfs(date_start, date_end, region_code: str, generation_type_id: int, backend: GenerationBackend, cache: BasicDataCache,
+                      resolution: str | None = None) -> AsyncIterator[pd.DataFrame]:
+    """Stream the environmental impacts of all the generation of a region and generation type in [date_start, date_end),
+    calculated chunk by chunk as rows arrive from the database"""
+    generation_chunks = stream_electricity_generation(date_start, date_end, region_code, generation_type_id,
+                                                      backend=backend, cache=cache, resolution=resolution)
+
+    async def impact_chunks():
+        async for generation_df in generation_chunks:
+            yield impacts_from_generation_df(generation_df, cache)
+    return impact_chunks()
+
+
+async def calculate_impact_batch_df(date_start, date_end, region_codes: List[str], generation_type_ids: List[int],
+                                    backend: GenerationBackend, cache: BasicDataCache, resolution: str | None = None,
+                                    layout: str = LONG_LAYOUT) -> pd.DataFrame:
+    """Calculate the environmental impacts of several regions and generation types from one query and one
+    calculation pass. The long layout has a row per generation row and impact category, so it is limited to
+    BATCH_ROW_LIMIT rows of impacts rather than of generation"""
+    row_limit = BATCH_ROW_LIMIT
+    if layout == LONG_LAYOUT:
+        row_limit = max(1, BATCH_ROW_LIMIT // max(1, len(cache.impact_factors.impact_category_ids)))
+    generation_df = await get_electricity_generation_batch_df(date_start, date_end, region_codes, generation_type_ids,
+                                                              backend=backend, cache=cache, resolution=resolution, row_limit=row_limit)
+    return impacts_from_generation_df(generation_df, cache, layout=layout)
+
+
+async def calculate_intensity_df(date_start, date_end, region_code: str, backend: GenerationBackend, cache: BasicDataCache,
+                                 resolution: str | None = None) -> pd.DataFrame:
+    """Calculate the generation weighted intensity of every impact category of the generation mix of a region, over
+    all its generation types, from one query and one calculation pass"""
+    generation_df = await get_electricity_generation_batch_df(date_start, date_end, [region_code], list(cache.generation_type_name_by_id),
+                                                              backend=backend, cache=cache, resolution=resolution)
+    result = calculate_impacts(generation_df, cache.impact_factors, value_column=ENERGY_COLUMN)
+    return to_intensity_df(result, value_column=ENERGY_COLUMN)
+
+
+def impacts_from_generation_df(generation_df: pd.DataFrame, cache: BasicDataCache, layout: str = LONG_LAYOUT) -> pd.DataFrame:
+    """Calculate the environmental impacts of rows of the ElectricityGeneration table, in the long or wide layout, from
+    the energy generated in each interval (MWh), which was computed at ingest from the interval's resolution"""
+    if layout == WIDE_LAYOUT:
+        return to_wide_df(generation_df, cache.impact_factors, value_column=ENERGY_COLUMN)
 
     # Annotate generation data with units # TODO: Move to DB
     if 'GenerationUnit' not in generation_df.columns.to_list():
-        generation_df['GenerationUnit'] = 'MJ'
-    generation_df.drop(['Id'], axis=1, inplace=True)
-
-    # Remove unnecessary columns for calculation
-    environmental_impacts_df.drop(['ReferenceYear'], axis=1, inplace=True)
-    environmental_impacts_df.drop(['Id'], axis=1, inplace=True)
-
-    # Join dataframes
-    calculation_df = generation_df.merge(environmental_impacts_df,
-                       left_on='GenerationTypeId',
-                       right_on='ElectricityGenerationTypeId')
-
-    # TODO: Move to database
-    # Convert units
-    calculation_df['ConversionFactor'] = calculation_df[['GenerationUnit','PerUnit']].apply(lambda x: conversion_factors[(x['GenerationUnit'],x['PerUnit'])],axis=1)
-    calculation_df['AggregatedGenerationConverted'] = calculation_df['AggregatedGeneration'] * calculation_df['ConversionFactor']
-    calculation_df['EnvironmentalImpact'] = calculation_df['AggregatedGenerationConverted']*calculation_df['ImpactValue']
-
-    return calculation_df
-
-
-async def get_calculation_data(engine) -> pd.DataFrame:
-    session_obj = sessionmaker(bind=engine)
-    with session_obj() as session:
-        impacts_query = session.query(EnvironmentalImpacts)
-        impacts_df = pd.read_sql(impacts_query.statement, session.bind)
-        # if isinstance(EnvironmentalImpactsSchema.validate(impacts_df), (SchemaError, SchemaErrors)):
-        #     logging.error('Schema error in environmental impacts data returned from database')
-        #     raise ServerError('Schema error in environmental impacts data returned from database')
-    return impacts_df
+        generation_df['GenerationUnit'] = DEFAULT_GENERATION_UNIT
+    generation_df = generation_df.drop(['Id'], axis=1, errors='ignore')  # Aggregated rows have no Id
+
+    # The factor matrix is built once when the cache is loaded, with the unit conversion already folded in
+    result = calculate_impacts(generation_df, cache.impact_factors, value_column=ENERGY_COLUMN)
+    return to_long_df(result, generation_df, value_column=ENERGY_COLUMN)
+
+
+def wide_header(wide_df: pd.DataFrame, cache: BasicDataCache, **fields) -> dict:
+    """Header of a wide result: the unit of Energy and the name, unit, per unit and conversion factor of the impact
+    category of each impact column, plus `fields`"""
+    impact_category_ids = [int(column) for column in wide_df.columns if column not in WIDE_KEYS + [ENERGY_COLUMN]]
+    metadata_df = impact_category_metadata(cache.impact_factors, impact_category_ids).merge(
+        cache.impact_categories[['Id', 'Name']].rename(columns={'Id': 'ImpactCategoryId'}), on='ImpactCategoryId', how='left')
+    return {**fields, 'GenerationUnit': cache.impact_factors.generation_unit,
+            'ImpactCategories': metadata_df[['ImpactCategoryId', 'Name', 'ImpactCategoryUnit', 'PerUnit', 'ConversionFactor']].to_dict(orient='records')}
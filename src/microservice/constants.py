@@ -2,5 +2,27 @@ class ServerError(Exception):
     pass
 
 
-conversion_factors = {('MJ', 'kWh'): 3.6}  # {(FromUnit,ToUnit): ConversionFactor, ...}
+conversion_factors = {('MJ', 'kWh'): 3.6, ('MWh', 'kWh'): 1000}  # {(FromUnit,ToUnit): ConversionFactor, ...}
+DEFAULT_GENERATION_UNIT = 'MWh'  # Unit of ElectricityGeneration.Energy, which calculations are based on
+ENERGY_COLUMN = 'Energy'
 ROW_LIMIT = 500
+BATCH_ROW_LIMIT = 500_000  # Maximum rows of a batch response, e.g. of impacts of /calculate/batch in the long layout
+STREAM_CHUNK_SIZE = 10000  # Rows fetched from the server side cursor at a time by streaming responses
+RESOLUTIONS = ('hour', 'day', 'week', 'month', 'year')  # Periods generation can be aggregated to, as named by date_trunc
+TIMEZONE = 'Europe/Brussels'  # Timezone of naive dates in requests. ElectricityGeneration.DateStamp is stored in UTC
+
+# Storage backends the microservice reads from, chosen with ELEC_LCA_BACKEND. The Parquet backend reads the export in
+# ELEC_LCA_PARQUET_DIR (see src.pipelines.export_parquet) and needs no database server
+POSTGRES_BACKEND = 'postgres'
+PARQUET_BACKEND = 'parquet'
+BACKENDS = (POSTGRES_BACKEND, PARQUET_BACKEND)
+
+# Default connection pool settings of the microservice's async engine. Can be overridden in the environment
+DB_POOL_SIZE = 10
+DB_MAX_OVERFLOW = 20
+DB_POOL_TIMEOUT = 30  # s
+
+# Cache of /calculate results
+RESULT_CACHE_MAX_BYTES = 256 * 1024 ** 2
+RESULT_CACHE_TTL = 15 * 60  # s
+DATA_VERSION_POLL_INTERVAL = 5  # s. Maximum time before newly ingested data invalidates cached results
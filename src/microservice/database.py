@@ -0,0 +1,133 @@
+"""
+Asynchronous database access for the microservice.
+
+Queries run over asyncpg through SQLAlchemy's async engine, so waiting on the database does not block the event loop
+and concurrent requests share a pool of connections.
+"""
+import datetime
+import logging
+import os
+from typing import AsyncIterator, List
+
+import pandas as pd
+import sqlalchemy as sqla
+from dotenv import load_dotenv
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+
+from src.data.rollups import choose_generation_source, mean_generation, period_start
+from src.microservice.backend import DATA_VERSION_COLUMNS, GenerationBackend
+from src.microservice.constants import DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, STREAM_CHUNK_SIZE
+from src.orm.base import ElectricityGeneration, GenerationDataVersions
+
+
+def create_async_db_engine() -> AsyncEngine:
+    """Create an async engine to the elec_lca database using the connection details in the environment"""
+    load_dotenv()
+    return create_async_engine(sqla.engine.url.URL.create(
+        drivername='postgresql+asyncpg',
+        host=os.getenv('ELEC_LCA_HOST'),
+        database=os.getenv('ELEC_LCA_DB_NAME'),
+        username=os.getenv('ELEC_LCA_USER'),
+        password=os.getenv('ELEC_LCA_PASSWORD')
+    ),
+        pool_size=int(os.getenv('ELEC_LCA_DB_POOL_SIZE', DB_POOL_SIZE)),
+        max_overflow=int(os.getenv('ELEC_LCA_DB_MAX_OVERFLOW', DB_MAX_OVERFLOW)),
+        pool_timeout=float(os.getenv('ELEC_LCA_DB_POOL_TIMEOUT', DB_POOL_TIMEOUT)),
+        pool_pre_ping=True)
+
+
+async def read_sql_df(statement, engine: AsyncEngine) -> pd.DataFrame:
+    """Async equivalent of pd.read_sql for a SQLAlchemy statement"""
+    async with engine.connect() as connection:
+        result = await connection.execute(statement)
+        return pd.DataFrame(result.fetchall(), columns=list(result.keys()))
+
+
+async def stream_sql_dfs(statement, engine: AsyncEngine, chunk_size: int) -> AsyncIterator[pd.DataFrame]:
+    """Execute a SQLAlchemy statement with a server side cursor and yield the result in dataframes of up to
+    `chunk_size` rows, so memory use does not depend on the size of the result"""
+    async with engine.connect() as connection:
+        result = await connection.stream(statement)
+        columns = list(result.keys())
+        async for rows in result.partitions(chunk_size):
+            yield pd.DataFrame(rows, columns=columns)
+
+
+def select_generation(resolution: str | None = None, start: datetime.datetime | None = None, end: datetime.datetime | None = None):
+    """Select the rows of ElectricityGeneration, or their aggregates per region, generation type and period if a
+    resolution is given: the mean power of the period in AggregatedGeneration (MW) and the energy generated over it in
+    Energy (MWh). The aggregation runs in the database so only the aggregates are transferred, and reads from the
+    smallest rollup table that can answer it for the range [start, end).
+
+    @return: Tuple of (select, table selected from, SQL expression of the DateStamp column of the result)
+    """
+    if resolution is None:
+        return sqla.select(ElectricityGeneration), ElectricityGeneration, ElectricityGeneration.DateStamp
+    source = choose_generation_source(resolution, start, end)
+    logging.debug(f'Reading {resolution} aggregates from {source.__tablename__}')
+    period = period_start(resolution, source.DateStamp)
+    query = (sqla.select(source.RegionId,
+                         source.GenerationTypeId,
+                         period.label('DateStamp'),
+                         mean_generation(source).label('AggregatedGeneration'),
+                         sqla.func.sum(source.Energy).label('Energy'))
+             .group_by(source.RegionId, source.GenerationTypeId, period))
+    return query, source, period
+
+
+def generation_query(region_ids: List[int], generation_type_ids: List[int], start: datetime.datetime | None = None,
+                     end: datetime.datetime | None = None, resolution: str | None = None, after: datetime.datetime | None = None):
+    """Query of the generation of the regions and generation types in [start, end) and after the cursor `after`,
+    ordered by RegionId, GenerationTypeId and DateStamp like the index of the UX_ElectricityGeneration constraint"""
+    query, source, date_stamp = select_generation(resolution, start, end)
+    query = (query
+             .where(source.RegionId.in_(region_ids))
+             .where(source.GenerationTypeId.in_(generation_type_ids)))
+    if start is not None:
+        query = query.where(source.DateStamp >= start)
+    if end is not None:
+        query = query.where(source.DateStamp < end)
+    if after is not None:
+        # Rows of later periods all start after the cursor, which keeps the index range scan
+        query = query.where(source.DateStamp > after)
+        if resolution is not None:
+            query = query.where(date_stamp > after)
+    return query.order_by(source.RegionId, source.GenerationTypeId, date_stamp)
+
+
+class PostgresBackend(GenerationBackend):
+    """The elec_lca database, queried through an async engine"""
+
+    def __init__(self, engine: AsyncEngine):
+        self.engine = engine
+
+    async def read_generation(self, region_ids: List[int], generation_type_ids: List[int], start: datetime.datetime | None = None,
+                              end: datetime.datetime | None = None, resolution: str | None = None,
+                              after: datetime.datetime | None = None, limit: int | None = None) -> pd.DataFrame:
+        query = generation_query(region_ids, generation_type_ids, start, end, resolution=resolution, after=after)
+        if limit is not None:
+            query = query.limit(limit)
+        return await read_sql_df(query, self.engine)
+
+    async def count_generation(self, region_ids: List[int], generation_type_ids: List[int], start: datetime.datetime | None = None,
+                               end: datetime.datetime | None = None, resolution: str | None = None, limit: int | None = None) -> int:
+        query = generation_query(region_ids, generation_type_ids, start, end, resolution=resolution).order_by(None)
+        if resolution is None:
+            # Only the columns of the UX_ElectricityGeneration index are read, with an index only scan
+            query = query.with_only_columns(ElectricityGeneration.DateStamp)
+        if limit is not None:
+            query = query.limit(limit)
+        df = await read_sql_df(sqla.select(sqla.func.count().label('Count')).select_from(query.subquery()), self.engine)
+        return int(df['Count'].iloc[0])
+
+    def stream_generation(self, region_ids: List[int], generation_type_ids: List[int], start: datetime.datetime | None = None,
+                          end: datetime.datetime | None = None, resolution: str | None = None,
+                          chunk_size: int = STREAM_CHUNK_SIZE) -> AsyncIterator[pd.DataFrame]:
+        query = generation_query(region_ids, generation_type_ids, start, end, resolution=resolution)
+        return stream_sql_dfs(query, self.engine, chunk_size=chunk_size)
+
+    async def read_data_versions(self) -> pd.DataFrame:
+        return await read_sql_df(sqla.select(*[getattr(GenerationDataVersions, column) for column in DATA_VERSION_COLUMNS]), self.engine)
+
+    async def close(self):
+        await self.engine.dispose()
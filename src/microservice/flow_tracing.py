@@ -0,0 +1,113 @@
+"""
+Flow tracing: consumption based intensity of the electricity of interconnected regions.
+
+Electricity flowing into a region is assumed to mix perfectly with its own generation, so the intensity c_n of the mix
+of region n (what is consumed in, and exported from, n) is the weighted mean of the intensity of its generation and of
+the mixes of the regions it imports from:
+
+    (P_n + sum_m F_mn) c_n - sum_m F_mn c_m = E_n
+
+with P_n the generation of n, F_mn the flow from m to n and E_n the impact of the generation of n. This is a linear
+system of one equation per region for each interval and impact category. Intervals are solved in batches, a stack of
+(regions x regions) systems at a time with numpy, and the batches are spread over a process pool.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Tuple
+
+import numpy as np
+
+TRACING_BATCH_SIZE = 2048  # Intervals solved at a time. A batch of 60 regions holds 2048 * 60 * 60 floats, about 60 MB
+
+
+def spread_to_grid(date_stamps: np.ndarray, resolution_minutes: np.ndarray, columns: np.ndarray, values: np.ndarray,
+                   start: np.datetime64, periods: int, step_minutes: int, n_columns: int) -> np.ndarray:
+    """Sum the average powers of rows of any resolution onto a regular grid: a row covers all the steps of its
+    interval, e.g. the four quarters of an hourly row on a 15 minute grid.
+
+    @param date_stamps: Start of the interval of each row (datetime64)
+    @param resolution_minutes: Length of the interval of each row, NaN for one step
+    @param columns: Column of the grid of each row, e.g. the position of its region
+    @param values: (R,) or (R, C) average power of each row. NaN counts as 0
+    @param start: Start of the first step of the grid
+    @param periods: Number of steps of the grid
+    @param step_minutes: Length of a step
+    @param n_columns: Number of columns of the grid
+    @return: (periods, n_columns) or (periods, n_columns, C) array
+    """
+    values = np.nan_to_num(np.asarray(values, dtype=float))
+    first_steps = (np.asarray(date_stamps, dtype='datetime64[m]') - np.datetime64(start, 'm')).astype(int) // step_minutes
+    resolution_minutes = np.nan_to_num(np.asarray(resolution_minutes, dtype=float), nan=step_minutes)
+    repeats = np.maximum(resolution_minutes.astype(int) // step_minutes, 1)
+
+    # Index of each step within the interval of its row
+    offsets = np.arange(repeats.sum()) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+    steps = np.repeat(first_steps, repeats) + offsets
+    columns = np.repeat(np.asarray(columns, dtype=int), repeats)
+    on_grid = (steps >= 0) & (steps < periods)
+    cells = steps[on_grid] * n_columns + columns[on_grid]
+
+    spread_values = np.repeat(values, repeats, axis=0)[on_grid]
+    if spread_values.ndim == 1:
+        return np.bincount(cells, weights=spread_values, minlength=periods * n_columns).reshape(periods, n_columns)
+    return np.stack([np.bincount(cells, weights=spread_values[:, i], minlength=periods * n_columns)
+                     for i in range(spread_values.shape[1])], axis=-1).reshape(periods, n_columns, -1)
+
+
+def trace_batch(generation: np.ndarray, flows: np.ndarray, borders: np.ndarray, impacts: np.ndarray) -> np.ndarray:
+    """Consumption based intensity of a batch of intervals.
+
+    @param generation: (T, N) generation of each region
+    @param flows: (T, B) flow over each border, in the same unit as the generation
+    @param borders: (B, 2) positions of the region the flow leaves and of the region it enters. Each pair appears once
+    @param impacts: (T, N, C) impact of the generation of each region, per impact category
+    @return: (T, N, C) impact per unit of the mix of each region, NaN for the regions without generation or imports
+    """
+    n_intervals, n_regions = generation.shape
+    from_regions, to_regions = borders[:, 0], borders[:, 1]
+    imports = np.zeros((n_intervals, n_regions))
+    np.add.at(imports, (slice(None), to_regions), flows)
+    throughput = generation + imports
+
+    systems = np.zeros((n_intervals, n_regions, n_regions))
+    diagonal = np.arange(n_regions)
+    systems[:, diagonal, diagonal] = throughput
+    systems[:, to_regions, from_regions] -= flows
+    # Regions without generation or imports would make the system singular. They keep an intensity of 0 in the
+    # system, which nothing flows from, and NaN in the result
+    empty = throughput <= 0
+    interval_positions, region_positions = np.nonzero(empty)
+    systems[interval_positions, region_positions, :] = 0
+    systems[interval_positions, region_positions, region_positions] = 1
+    impacts = np.where(empty[:, :, np.newaxis], 0.0, impacts)
+
+    try:
+        intensities = np.linalg.solve(systems, impacts)
+    except np.linalg.LinAlgError:
+        # Inconsistent data, e.g. more exported than generated and imported, may still leave a singular system
+        intensities = np.linalg.pinv(systems) @ impacts
+    intensities[empty] = np.nan
+    return intensities
+
+
+def _trace_batch(args: Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]) -> np.ndarray:
+    return trace_batch(*args)
+
+
+def trace_flows(generation: np.ndarray, flows: np.ndarray, borders: np.ndarray, impacts: np.ndarray,
+                batch_size: int = TRACING_BATCH_SIZE, workers: int = None) -> np.ndarray:
+    """Consumption based intensity of every interval (see trace_batch for the arguments), solved in batches of
+    `batch_size` intervals by a pool of `workers` processes (the number of cores by default). With one worker or one
+    batch, the batches are solved in this process"""
+    n_intervals = generation.shape[0]
+    batches = [(generation[i:i + batch_size], flows[i:i + batch_size], borders, impacts[i:i + batch_size])
+               for i in range(0, n_intervals, batch_size)]
+    workers = min(workers or os.cpu_count() or 1, len(batches))
+    if workers <= 1:
+        results = [_trace_batch(batch) for batch in batches]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_trace_batch, batches))
+    if len(results) == 0:
+        return np.zeros((0, *impacts.shape[1:]))
+    return np.concatenate(results)
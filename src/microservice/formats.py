@@ -0,0 +1,101 @@
+"""
+Response formats of the microservice
+"""
+import io
+import json
+from typing import AsyncIterator
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from fastapi import Response
+
+JSON = 'json'
+NDJSON = 'ndjson'
+ARROW = 'arrow'
+PARQUET = 'parquet'
+RESPONSE_FORMATS = (JSON, NDJSON, ARROW, PARQUET)
+MEDIA_TYPES = {
+    JSON: 'application/json',
+    NDJSON: 'application/x-ndjson',
+    ARROW: 'application/vnd.apache.arrow.stream',
+    PARQUET: 'application/vnd.apache.parquet',
+}
+
+# Layouts of impact results. Long: a row per generation row and impact category. Wide: a row per generation row and a
+# column per impact category, with the metadata of the categories sent once in a header
+LONG_LAYOUT = 'long'
+WIDE_LAYOUT = 'wide'
+LAYOUTS = (LONG_LAYOUT, WIDE_LAYOUT)
+WIDE_KEY_COLUMNS = ['RegionId', 'GenerationTypeId']  # In the header or the keys of wide JSON results, not in their rows
+HEADER_METADATA_KEY = b'header'  # Key of the header in the schema metadata of wide Arrow and Parquet results
+
+
+def check_response_format(response_format: str) -> str:
+    """Raise TypeError if the response format is not supported"""
+    if response_format not in RESPONSE_FORMATS:
+        raise TypeError(f'Invalid format `{response_format}`. Format must be one of {", ".join(RESPONSE_FORMATS)}')
+    return response_format
+
+
+def check_layout(layout: str) -> str:
+    """Raise TypeError if the layout is not supported"""
+    if layout not in LAYOUTS:
+        raise TypeError(f'Invalid layout `{layout}`. Layout must be one of {", ".join(LAYOUTS)}')
+    return layout
+
+
+def negotiate_response_format(response_format: str | None, accept: str | None) -> str:
+    """Choose the response format from the `format` query parameter if given, otherwise from the Accept header.
+    Defaults to JSON"""
+    if response_format is not None:
+        return check_response_format(response_format)
+    if accept:
+        for media_range in accept.split(','):
+            media_type = media_range.split(';')[0].strip().lower()
+            for candidate, candidate_media_type in MEDIA_TYPES.items():
+                if media_type == candidate_media_type:
+                    return candidate
+    return JSON
+
+
+async def ndjson_lines(dfs: AsyncIterator[pd.DataFrame]) -> AsyncIterator[str]:
+    """Serialize a stream of dataframes as newline delimited JSON, one record per line"""
+    async for df in dfs:
+        if len(df) > 0:
+            yield df.to_json(orient='records', lines=True)
+
+
+def to_arrow_table(df: pd.DataFrame) -> pa.Table:
+    """Convert a result dataframe to an Arrow table. DateStamp is stored as naive UTC in the database and is marked
+    as UTC so that clients get tz-aware timestamps"""
+    if 'DateStamp' in df.columns and pd.api.types.is_datetime64_dtype(df['DateStamp']):
+        df = df.assign(DateStamp=df['DateStamp'].dt.tz_localize('UTC'))
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def wide_json(df: pd.DataFrame, header: dict, data: str = None) -> str:
+    """Serialize a wide result as {<header>, "columns": [...], "data": [[...], ...]}: the header and the column names
+    once, then each row as an array of values. `data` is JSON that replaces the rows, e.g. the rows of a batch keyed
+    by region code and generation type id"""
+    df = df.drop(columns=WIDE_KEY_COLUMNS, errors='ignore')
+    if data is None:
+        data = df.to_json(orient='values')
+    return f'{json.dumps({**header, "columns": df.columns.to_list()})[:-1]},"data":{data}}}'
+
+
+def binary_response(df: pd.DataFrame, response_format: str, headers: dict = None, metadata: dict = None) -> Response:
+    """Serialize a dataframe as an Arrow IPC stream or a Parquet file. `metadata` (e.g. the header of a wide result) is
+    added to the schema metadata as JSON"""
+    table = to_arrow_table(df)
+    if metadata is not None:
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), HEADER_METADATA_KEY: json.dumps(metadata).encode()})
+    sink = io.BytesIO()
+    if response_format == ARROW:
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+    elif response_format == PARQUET:
+        pq.write_table(table, sink)
+    else:
+        raise TypeError(f'Format `{response_format}` is not a binary format')
+    return Response(sink.getvalue(), media_type=MEDIA_TYPES[response_format], headers=headers)
@@ -1,37 +1,173 @@
+import datetime
+import json
 import logging
+from typing import AsyncIterator, List
+
 import pandas as pd
-from sqlalchemy.orm import sessionmaker
+from pydantic import BaseModel
+
+from src.data.get_common_data import BasicDataCache
+from src.microservice.backend import GenerationBackend
+from src.microservice.constants import BATCH_ROW_LIMIT, RESOLUTIONS, ROW_LIMIT, STREAM_CHUNK_SIZE, TIMEZONE
+
+
+def to_utc(value) -> datetime.datetime | None:
+    """Convert a date or timestamp (or its string representation) to a naive UTC datetime, the convention used for
+    ElectricityGeneration.DateStamp. Naive values are interpreted as local time in TIMEZONE. Empty values are None"""
+    if value is None:
+        return None
+    timestamp = pd.Timestamp(value)
+    if pd.isna(timestamp):
+        return None
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.tz_localize(TIMEZONE)
+    return timestamp.tz_convert('UTC').tz_localize(None).to_pydatetime()
+
+
+def encode_cursor(date_stamp) -> str:
+    """Encode the DateStamp (naive UTC) of the last row of a page as a cursor for the next page"""
+    return pd.Timestamp(date_stamp).tz_localize('UTC').isoformat()
+
+
+def next_cursor(df: pd.DataFrame, limit: int = ROW_LIMIT) -> str | None:
+    """Cursor of the page that follows `df`, a page of get_electricity_generation_df read with `limit`, or None if it
+    is the last page. A full page may be followed by more rows"""
+    if len(df) == 0 or len(df) < min(limit, ROW_LIMIT):
+        return None
+    return encode_cursor(df['DateStamp'].iloc[-1])
+
+
+class BatchRequestSchema(BaseModel):
+    region_codes: List[str]
+    generation_type_ids: List[int]
+    date_start: str
+    date_end: str
+    resolution: str | None = None
+    model_config = {
+        "json_schema_extra": {
+            "examples": [{
+                "region_codes": ["NL", "BE"],
+                "generation_type_ids": [1, 5, 18],
+                "date_start": "2023-12-02",
+                "date_end": "2023-12-03"
+            }
+            ]
+        }
+    }
+
+
+def check_resolution(resolution: str | None) -> str | None:
+    """Raise TypeError if the resolution is not supported"""
+    if resolution is not None and resolution not in RESOLUTIONS:
+        raise TypeError(f'Invalid resolution `{resolution}`. Resolution must be one of {", ".join(RESOLUTIONS)}')
+    return resolution
 
-from src.microservice.constants import ServerError, ROW_LIMIT
-from src.orm.base import Regions, ElectricityGeneration
 
+def check_generation_request(date_start, date_end, region_code: str, generation_type_id: int, cache: BasicDataCache):
+    """Validate the parameters of a request for the electricity generation of a region and generation type.
 
-async def get_electricity_generation_df(date_start, date_end, region_code: str, generation_type_id: int, engine) -> pd.DataFrame:
+    @return: Tuple of (region id, start, end), with start and end in naive UTC
+    """
     if not isinstance(region_code, str):
         raise TypeError('Invalid region code. Region code must be a string')
 
     if not isinstance(generation_type_id, int):
         raise TypeError('Invalid generation type id. Generation type id must be an integer')
 
+    region_id = cache.get_region_id(region_code)
+    logging.debug(f'REGION IS {region_id}')
 
-    session_obj = sessionmaker(bind=engine)
-    with session_obj() as session:
-        impacts_query = session.query(Regions.Id).where(Regions.Code == region_code).limit(1)
+    start = to_utc(date_start)
+    end = to_utc(date_end)
+    if start is not None and end is not None and end <= start:
+        raise ValueError(f'date_end `{date_end}` must be after date_start `{date_start}`')
+    return region_id, start, end
 
-        # TODO: Consider replacing with a lookup in the common data cached in the main body
-        region_id_df = pd.read_sql(impacts_query.statement, session.bind)
-        if region_id_df is None or region_id_df.shape[0] == 0:
-            raise ValueError(f'Region Code `{region_code}` could not be found in database')
-        elif region_id_df.shape[0] > 1:
-            raise ServerError(f'More than one region found for region code `{region_code}`. There is probably an error in the database')
 
-        region_id = int(region_id_df.iat[0, 0])
-        logging.debug(f'REGION IS {region_id}')
+async def get_electricity_generation_df(date_start, date_end, region_code: str, generation_type_id: int, backend: GenerationBackend, cache: BasicDataCache,
+                                        after=None, limit: int = ROW_LIMIT, resolution: str | None = None) -> pd.DataFrame:
+    """Retrieve electricity generation of a region and generation type in [date_start, date_end), ordered by DateStamp.
 
-        query = (session.query(ElectricityGeneration)
-                 .where(ElectricityGeneration.GenerationTypeId == generation_type_id)
-                 .where(ElectricityGeneration.RegionId == region_id)
-                 .limit(ROW_LIMIT))
+    Pages are keyset based: pass the cursor of the previous page (see encode_cursor) as `after` to get the rows that
+    follow it. On the database, both this and the range filter are answered from the (RegionId, GenerationTypeId,
+    DateStamp) index of the UX_ElectricityGeneration constraint, so deep pages cost the same as the first one.
 
-        df = pd.read_sql(query.statement, session.bind)
+    @param date_start: Start of the range (inclusive). Naive dates are in Europe/Brussels time
+    @param date_end: End of the range (exclusive), or None for no upper bound
+    @param after: Cursor of the last row of the previous page, or None for the first page
+    @param limit: Maximum number of rows to return, capped at ROW_LIMIT
+    @param resolution: If given, return a row per `hour`, `day`, `week`, `month` or `year` (in Europe/Brussels time),
+        with the mean power of the period in AggregatedGeneration (MW) and the energy generated in Energy (MWh)
+    """
+    if not isinstance(limit, int) or limit <= 0:
+        raise TypeError('Invalid limit. Limit must be a positive integer')
+
+    region_id, start, end = check_generation_request(date_start, date_end, region_code, generation_type_id, cache)
+    return await backend.read_generation([region_id], [generation_type_id], start, end, resolution=check_resolution(resolution),
+                                         after=to_utc(after), limit=min(limit, ROW_LIMIT))
+
+
+def stream_electricity_generation(date_start, date_end, region_code: str, generation_type_id: int, backend: GenerationBackend,
+                                  cache: BasicDataCache, chunk_size: int = STREAM_CHUNK_SIZE,
+                                  resolution: str | None = None) -> AsyncIterator[pd.DataFrame]:
+    """Stream all the electricity generation of a region and generation type in [date_start, date_end) from the
+    backend, in dataframes of up to `chunk_size` rows. Parameters are validated before the stream is returned"""
+    region_id, start, end = check_generation_request(date_start, date_end, region_code, generation_type_id, cache)
+    return backend.stream_generation([region_id], [generation_type_id], start, end, resolution=check_resolution(resolution),
+                                     chunk_size=chunk_size)
+
+
+def check_batch_request(date_start, date_end, region_codes: List[str], generation_type_ids: List[int], cache: BasicDataCache):
+    """Validate the parameters of a batch request.
+
+    @return: Tuple of (region ids, start, end), with start and end in naive UTC
+    """
+    if len(region_codes) == 0 or len(generation_type_ids) == 0:
+        raise ValueError('At least one region code and one generation type id must be given')
+    region_ids = [cache.get_region_id(region_code) for region_code in region_codes]
+    unknown_generation_type_ids = [i for i in generation_type_ids if i not in cache.generation_type_name_by_id]
+    if len(unknown_generation_type_ids) > 0:
+        raise ValueError(f'Generation type ids {unknown_generation_type_ids} could not be found in database')
+
+    start = to_utc(date_start)
+    end = to_utc(date_end)
+    if start is None or end is None:
+        raise ValueError('Batch requests need both date_start and date_end')
+    if end <= start:
+        raise ValueError(f'date_end `{date_end}` must be after date_start `{date_start}`')
+    return region_ids, start, end
+
+
+async def get_electricity_generation_batch_df(date_start, date_end, region_codes: List[str], generation_type_ids: List[int],
+                                              backend: GenerationBackend, cache: BasicDataCache, resolution: str | None = None,
+                                              row_limit: int = BATCH_ROW_LIMIT) -> pd.DataFrame:
+    """Retrieve the electricity generation of several regions and generation types in one query.
+    Raises ValueError if the result would have more than `row_limit` rows, which is checked by counting them (up to
+    the limit) before any is read"""
+    region_ids, start, end = check_batch_request(date_start, date_end, region_codes, generation_type_ids, cache)
+    resolution = check_resolution(resolution)
+    too_many = f'Batch request returns more than {row_limit} rows. Please request a shorter date range, fewer regions or a coarser resolution'
+    if await backend.count_generation(region_ids, generation_type_ids, start, end, resolution=resolution, limit=row_limit + 1) > row_limit:
+        raise ValueError(too_many)
+    df = await backend.read_generation(region_ids, generation_type_ids, start, end, resolution=resolution, limit=row_limit + 1)
+    # Rows may have been written since they were counted
+    if len(df) > row_limit:
+        raise ValueError(too_many)
     return df
+
+
+def to_keyed_json(df: pd.DataFrame, region_codes: List[str], generation_type_ids: List[int], cache: BasicDataCache,
+                  orient: str = 'records') -> str:
+    """Serialize the result of a batch request as a JSON object keyed by region code and then generation type id,
+    e.g. {"NL": {"1": [{...}, ...], ...}, ...}. Requested combinations without data map to empty lists.
+    With orient='values', rows are arrays of the values of the columns other than the keys, e.g. for wide results"""
+    key_columns = ['RegionId', 'GenerationTypeId']
+    records_by_key = {key: (group if orient == 'records' else group.drop(columns=key_columns)).to_json(orient=orient)
+                      for key, group in df.groupby(key_columns, sort=False)}
+    regions = []
+    for region_code in dict.fromkeys(region_codes):
+        region_id = cache.get_region_id(region_code)
+        generation_types = [f'"{generation_type_id}":{records_by_key.get((region_id, generation_type_id), "[]")}'
+                            for generation_type_id in dict.fromkeys(generation_type_ids)]
+        regions.append(f'{json.dumps(region_code)}:{{{",".join(generation_types)}}}')
+    return f'{{{",".join(regions)}}}'
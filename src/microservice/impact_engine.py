@@ -0,0 +1,211 @@
+"""
+Matrix based calculation of environmental impacts.
+
+Generation data is pivoted into a (timestamps x generation types) array and the environmental impact factors into a
+(generation types x impact categories) array with the unit conversion folded in, so that all impact categories are
+calculated with a single matrix product instead of a merge and a row-wise apply.
+"""
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from src.microservice.constants import conversion_factors, DEFAULT_GENERATION_UNIT
+
+ROW_KEYS = ['RegionId', 'DateStamp']
+WIDE_KEYS = ['RegionId', 'GenerationTypeId', 'DateStamp']
+
+
+@dataclass
+class ImpactFactors:
+    """Environmental impact factors as dense arrays.
+
+    Rows are indexed directly by generation type id, columns follow `impact_category_ids`. Entries for
+    (generation type, impact category) pairs without a factor in the database are NaN."""
+    impact_category_ids: np.ndarray  # (C,)
+    impact_values: np.ndarray  # (max generation type id + 1, C) ImpactValue as stored in the database
+    conversion_factors: np.ndarray  # (max generation type id + 1, C) GenerationUnit -> PerUnit
+    impact_category_units: np.ndarray  # (max generation type id + 1, C) object array
+    per_units: np.ndarray  # (max generation type id + 1, C) object array
+    generation_unit: str
+
+    @property
+    def values(self) -> np.ndarray:
+        """Impact per generation unit, i.e. ImpactValue * ConversionFactor"""
+        return self.impact_values * self.conversion_factors
+
+    @property
+    def available(self) -> np.ndarray:
+        """Boolean mask of the (generation type, impact category) pairs that have a factor"""
+        return ~np.isnan(self.impact_values)
+
+    def for_generation_types(self, generation_type_ids) -> np.ndarray:
+        """Return the (K, C) factor matrix for the given generation type ids, with 0 for missing factors"""
+        generation_type_ids = np.asarray(generation_type_ids, dtype=int)
+        factors = np.zeros((len(generation_type_ids), len(self.impact_category_ids)))
+        known = (generation_type_ids >= 0) & (generation_type_ids < self.impact_values.shape[0])
+        factors[known] = np.nan_to_num(self.values[generation_type_ids[known]])
+        return factors
+
+
+@dataclass
+class ImpactMatrixResult:
+    """Result of an impact calculation.
+
+    `generation` is the (T, K) generation matrix with a row per (RegionId, DateStamp) in `row_index` and a column per
+    generation type in `generation_type_ids`. `totals` is the (T, C) impact summed over generation types."""
+    row_index: pd.MultiIndex
+    generation_type_ids: np.ndarray
+    generation: np.ndarray
+    factors: ImpactFactors
+    totals: np.ndarray
+
+    def by_generation_type(self) -> np.ndarray:
+        """Return the (T, K, C) impact of each generation type"""
+        return self.generation[:, :, np.newaxis] * self.factors.for_generation_types(self.generation_type_ids)[np.newaxis, :, :]
+
+    def totals_df(self) -> pd.DataFrame:
+        """Return the impact summed over generation types, with a column per impact category id"""
+        return pd.DataFrame(self.totals, index=self.row_index, columns=self.factors.impact_category_ids)
+
+
+def build_impact_factors(environmental_impacts_df: pd.DataFrame, generation_unit: str = DEFAULT_GENERATION_UNIT) -> ImpactFactors:
+    """Pivot the EnvironmentalImpacts table into dense factor arrays, with the conversion from the generation unit to
+    each row's `PerUnit` applied once.
+
+    @param environmental_impacts_df: Rows of the EnvironmentalImpacts table
+    @param generation_unit: Unit the generation values are expressed in
+    @return: ImpactFactors
+    """
+    impact_category_ids = np.sort(environmental_impacts_df['ImpactCategoryId'].unique()).astype(int)
+    generation_type_ids = environmental_impacts_df['ElectricityGenerationTypeId'].to_numpy(dtype=int)
+    n_generation_types = int(generation_type_ids.max()) + 1 if len(generation_type_ids) > 0 else 0
+    rows = generation_type_ids
+    columns = np.searchsorted(impact_category_ids, environmental_impacts_df['ImpactCategoryId'].to_numpy(dtype=int))
+
+    shape = (n_generation_types, len(impact_category_ids))
+    impact_values = np.full(shape, np.nan)
+    impact_values[rows, columns] = environmental_impacts_df['ImpactValue'].to_numpy(dtype=float)
+
+    per_units = np.full(shape, None, dtype=object)
+    per_units[rows, columns] = environmental_impacts_df['PerUnit'].to_numpy(dtype=object)
+    impact_category_units = np.full(shape, None, dtype=object)
+    impact_category_units[rows, columns] = environmental_impacts_df['ImpactCategoryUnit'].to_numpy(dtype=object)
+
+    # Look up each distinct unit pair once rather than once per row
+    factors = np.full(shape, np.nan)
+    for per_unit in environmental_impacts_df['PerUnit'].unique():
+        if (generation_unit, per_unit) not in conversion_factors:
+            raise ValueError(f'No conversion factor from `{generation_unit}` to `{per_unit}`')
+        factors[per_units == per_unit] = conversion_factors[(generation_unit, per_unit)]
+
+    return ImpactFactors(impact_category_ids=impact_category_ids,
+                         impact_values=impact_values,
+                         conversion_factors=factors,
+                         impact_category_units=impact_category_units,
+                         per_units=per_units,
+                         generation_unit=generation_unit)
+
+
+def pivot_generation(generation_df: pd.DataFrame, value_column: str = 'AggregatedGeneration'):
+    """Pivot long format generation data into a (T, K) array. Generation types without a row at a timestamp count
+    as 0, rows with a missing value stay NaN.
+
+    @return: Tuple of (row index of (RegionId, DateStamp), generation type ids, generation array)
+    """
+    grouped = generation_df.groupby(ROW_KEYS + ['GenerationTypeId'], sort=True)[value_column].agg(['sum', 'count', 'size'])
+    pivot = grouped['sum'].where(grouped['count'] == grouped['size']).unstack('GenerationTypeId', fill_value=0.0)
+    return pivot.index, pivot.columns.to_numpy(dtype=int), pivot.to_numpy(dtype=float)
+
+
+def calculate_impacts(generation_df: pd.DataFrame, factors: ImpactFactors, value_column: str = 'AggregatedGeneration') -> ImpactMatrixResult:
+    """Calculate the environmental impacts of all impact categories for long format generation data
+    (RegionId, DateStamp, GenerationTypeId, <value_column>). A total is NaN when the generation of a type with a
+    factor for its impact category is missing"""
+    row_index, generation_type_ids, generation = pivot_generation(generation_df, value_column=value_column)
+    type_factors = factors.for_generation_types(generation_type_ids)
+    missing = np.isnan(generation)
+    totals = np.where(missing, 0.0, generation) @ type_factors
+    totals[(missing.astype(float) @ (type_factors != 0)) > 0] = np.nan
+    return ImpactMatrixResult(row_index=row_index,
+                              generation_type_ids=generation_type_ids,
+                              generation=generation,
+                              factors=factors,
+                              totals=totals)
+
+
+def to_long_df(result: ImpactMatrixResult, generation_df: pd.DataFrame, value_column: str = 'AggregatedGeneration') -> pd.DataFrame:
+    """Expand an ImpactMatrixResult into the long format returned by /calculate: one row per generation row and
+    impact category, for generation types that have environmental impact factors. `value_column` is the column the
+    result was calculated from"""
+    factors = result.factors
+    generation_type_ids = generation_df['GenerationTypeId'].to_numpy(dtype=int)
+    in_range = (generation_type_ids >= 0) & (generation_type_ids < factors.impact_values.shape[0])
+    available = np.zeros((len(generation_df), len(factors.impact_category_ids)), dtype=bool)
+    available[in_range] = factors.available[generation_type_ids[in_range]]
+    generation_rows, category_positions = np.nonzero(available)
+    type_ids = generation_type_ids[generation_rows]
+
+    # Locate each generation row in the impact matrix
+    row_positions = result.row_index.get_indexer(pd.MultiIndex.from_frame(generation_df[ROW_KEYS]))[generation_rows]
+    column_positions = np.searchsorted(result.generation_type_ids, type_ids)
+    impacts = result.by_generation_type()[row_positions, column_positions, category_positions]
+
+    long_df = generation_df.iloc[generation_rows].reset_index(drop=True)
+    long_df['ElectricityGenerationTypeId'] = type_ids
+    long_df['ImpactCategoryId'] = factors.impact_category_ids[category_positions]
+    long_df['ImpactValue'] = factors.impact_values[type_ids, category_positions]
+    long_df['ImpactCategoryUnit'] = factors.impact_category_units[type_ids, category_positions]
+    long_df['PerUnit'] = factors.per_units[type_ids, category_positions]
+    long_df['ConversionFactor'] = factors.conversion_factors[type_ids, category_positions]
+    long_df['AggregatedGenerationConverted'] = long_df[value_column] * long_df['ConversionFactor']
+    long_df['EnvironmentalImpact'] = impacts
+    return long_df
+
+
+def to_wide_df(generation_df: pd.DataFrame, factors: ImpactFactors, value_column: str = 'AggregatedGeneration') -> pd.DataFrame:
+    """Expand generation data into the wide format of /calculate: one row per generation row and a column per impact
+    category, named by its id, for the generation types and impact categories that have environmental impact factors.
+    The units of the columns are given by impact_category_metadata"""
+    generation_type_ids = generation_df['GenerationTypeId'].to_numpy(dtype=int)
+    in_range = (generation_type_ids >= 0) & (generation_type_ids < factors.impact_values.shape[0])
+    values = np.full((len(generation_df), len(factors.impact_category_ids)), np.nan)
+    values[in_range] = factors.values[generation_type_ids[in_range]]
+    available = ~np.isnan(values)
+    rows = available.any(axis=1)
+    categories = available.any(axis=0)
+
+    impacts = generation_df[value_column].to_numpy(dtype=float)[rows, np.newaxis] * values[np.ix_(rows, categories)]
+    wide_df = generation_df.loc[rows, WIDE_KEYS + [value_column]].reset_index(drop=True)
+    impacts_df = pd.DataFrame(impacts, columns=[str(impact_category_id) for impact_category_id in factors.impact_category_ids[categories]])
+    return pd.concat([wide_df, impacts_df], axis=1)
+
+
+def impact_category_metadata(factors: ImpactFactors, impact_category_ids) -> pd.DataFrame:
+    """Unit, per unit and conversion factor of impact categories, as sent once in the header of wide results.
+    These are the same for all the generation types of a category"""
+    positions = np.searchsorted(factors.impact_category_ids, np.asarray(impact_category_ids, dtype=int))
+    # First generation type with a factor for each category
+    generation_type_ids = factors.available[:, positions].argmax(axis=0)
+    return pd.DataFrame({'ImpactCategoryId': factors.impact_category_ids[positions],
+                         'ImpactCategoryUnit': factors.impact_category_units[generation_type_ids, positions],
+                         'PerUnit': factors.per_units[generation_type_ids, positions],
+                         'ConversionFactor': factors.conversion_factors[generation_type_ids, positions]})
+
+
+def to_intensity_df(result: ImpactMatrixResult, value_column: str = 'AggregatedGeneration') -> pd.DataFrame:
+    """Generation weighted intensity of the mix of each row of the impact matrix: the impact of each impact category
+    summed over all generation types, per unit (`PerUnit` of the category) of the total generation of all generation
+    types, including the ones without impact factors. One row per (RegionId, DateStamp), with the total generation in
+    `value_column` and a column per impact category, named by its id. Rows without generation, or with the generation
+    of a type missing, have NaN intensities"""
+    generation = result.generation.sum(axis=1)
+    metadata_df = impact_category_metadata(result.factors, result.factors.impact_category_ids)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        intensities = result.totals / (generation[:, np.newaxis] * metadata_df['ConversionFactor'].to_numpy(dtype=float))
+    intensities[generation == 0] = np.nan
+
+    intensity_df = result.row_index.to_frame(index=False)
+    intensity_df[value_column] = generation
+    intensities_df = pd.DataFrame(intensities, columns=[str(impact_category_id) for impact_category_id in result.factors.impact_category_ids])
+    return pd.concat([intensity_df, intensities_df], axis=1)
@@ -1,3 +1,4 @@
+import itertools
 import logging
 import os
 from typing import Any
@@ -5,30 +6,54 @@ from typing import Any
 import pandas as pd
 import sqlalchemy as sqla
 from dotenv import load_dotenv
-from fastapi import FastAPI, Response
+from fastapi import FastAPI, Header, Query, Response
+from fastapi.responses import StreamingResponse
 from fastapi.openapi.docs import get_swagger_ui_html
 import uvicorn
 
-from src.data.get_common_data import load_common_data_from_db
-from src.microservice.calculate import ImpactResultSchema, calculate_impact_df
-from src.microservice.constants import ServerError
-from src.microservice.generation import get_electricity_generation_df
+from src.data.get_common_data import load_common_data_from_db, load_common_data_from_parquet
+from src.microservice.calculate import ImpactResultSchema, calculate_impact_batch_df, calculate_impact_df, calculate_intensity_df, stream_impact_dfs, \
+    wide_header
+from src.microservice.constants import BACKENDS, PARQUET_BACKEND, POSTGRES_BACKEND, ServerError, ROW_LIMIT
+from src.microservice.database import PostgresBackend, create_async_db_engine
+from src.microservice.formats import ARROW, LONG_LAYOUT, MEDIA_TYPES, NDJSON, PARQUET, WIDE_LAYOUT, binary_response, check_layout, \
+    negotiate_response_format, ndjson_lines, wide_json
+from src.microservice.generation import BatchRequestSchema, get_electricity_generation_batch_df, get_electricity_generation_df, \
+    next_cursor, stream_electricity_generation, to_keyed_json, to_utc
+from src.microservice.parquet_backend import ParquetBackend
+from src.microservice.result_cache import ResultCache
 
 load_dotenv()
 HOST = os.getenv('ELEC_LCA_HOST')
 DB_NAME = os.getenv('ELEC_LCA_DB_NAME')
 USER = os.getenv('ELEC_LCA_USER')
 PASSWORD = os.getenv('ELEC_LCA_PASSWORD')
-
-# Connect to postgres database
-engine = sqla.create_engine(sqla.engine.url.URL.create(
-    drivername='postgresql',
-    host=HOST,
-    database=DB_NAME,
-    username=USER,
-    password=PASSWORD
-))
-cache = load_common_data_from_db(sql_engine=engine)
+BACKEND = os.getenv('ELEC_LCA_BACKEND', POSTGRES_BACKEND)
+PARQUET_DIR = os.getenv('ELEC_LCA_PARQUET_DIR')
+
+if BACKEND not in BACKENDS:
+    raise ValueError(f'Invalid ELEC_LCA_BACKEND `{BACKEND}`. Backend must be one of {", ".join(BACKENDS)}')
+if BACKEND == PARQUET_BACKEND:
+    # Serve everything from the Parquet export, without a database server
+    if not PARQUET_DIR:
+        raise ValueError('ELEC_LCA_PARQUET_DIR must be set to use the parquet backend')
+    cache = load_common_data_from_parquet(PARQUET_DIR)
+    backend = ParquetBackend(PARQUET_DIR)
+else:
+    # Connect to postgres database
+    engine = sqla.create_engine(sqla.engine.url.URL.create(
+        drivername='postgresql',
+        host=HOST,
+        database=DB_NAME,
+        username=USER,
+        password=PASSWORD
+    ))
+    cache = load_common_data_from_db(sql_engine=engine)
+
+    # Requests go through the async engine so that database round trips do not block the event loop
+    backend = PostgresBackend(create_async_db_engine())
+
+result_cache = ResultCache()
 
 app = FastAPI()
 
@@ -53,10 +78,24 @@ async def list_generation_type_mappings():
     generation_type_mappings_df = cache.generation_type_mappings
     return Response(generation_type_mappings_df.to_json(orient='records'), media_type="application/json")
 
+@app.get('/cache_stats')
+async def get_cache_stats():
+    """Size, hit rate, evictions and invalidations of the /calculate result cache"""
+    return result_cache.stats()
+
+
 @app.get('/generation')
-async def get_electricity_generation(date_start, region_code: str, generation_type_id: int):
+async def get_electricity_generation(date_start, region_code: str, generation_type_id: int, date_end=None, cursor=None, limit: int = ROW_LIMIT,
+                                     resolution: str = None, response_format: str = Query(None, alias='format'), accept: str = Header(None)):
     try:
-        df = await get_electricity_generation_df(date_start, None, region_code, generation_type_id, engine=engine)
+        response_format = negotiate_response_format(response_format, accept)
+        if response_format == NDJSON:
+            # Stream every row in the range, without paging
+            chunks = stream_electricity_generation(date_start, date_end, region_code, generation_type_id, backend=backend, cache=cache,
+                                                   resolution=resolution)
+            return StreamingResponse(ndjson_lines(chunks), media_type=MEDIA_TYPES[NDJSON])
+        df = await get_electricity_generation_df(date_start, date_end, region_code, generation_type_id, backend=backend, cache=cache,
+                                                 after=cursor, limit=limit, resolution=resolution)
     except TypeError as e:
         return Response(status_code=400, content=str(e))
     except ValueError as e:
@@ -65,13 +104,35 @@ async def get_electricity_generation(date_start, region_code: str, generation_ty
         return Response(status_code=500, content=str(e))
     if not isinstance(df, pd.DataFrame):
         return Response(status_code=500)
-    return Response(df.to_json(orient='records'), media_type="application/json")
+    headers = {}
+    next_page = next_cursor(df, limit)
+    if next_page is not None:
+        # The client passes this back as `cursor` to get the next page
+        headers['X-Next-Cursor'] = next_page
+    if response_format in (ARROW, PARQUET):
+        return binary_response(df, response_format, headers=headers)
+    return Response(df.to_json(orient='records'), media_type="application/json", headers=headers)
 
 
 @app.get('/calculate', response_model=ImpactResultSchema)
-async def calculate_impact(date_start, region_code: str, generation_type_id: int)->Any:
+async def calculate_impact(date_start, region_code: str, generation_type_id: int, date_end=None, resolution: str = None,
+                           layout: str = LONG_LAYOUT, response_format: str = Query(None, alias='format'), accept: str = Header(None))->Any:
+    """Environmental impacts of the generation of a region and generation type. With layout=wide, a row per timestamp
+    and a column per impact category, with the names and units of the categories in a header"""
     try:
-        impact_df = await calculate_impact_df(date_start, region_code, generation_type_id,engine=engine)
+        response_format = negotiate_response_format(response_format, accept)
+        check_layout(layout)
+        if response_format == NDJSON:
+            if layout == WIDE_LAYOUT:
+                raise TypeError('Layout `wide` is not supported with format `ndjson`')
+            chunks = stream_impact_dfs(date_start, date_end, region_code, generation_type_id, backend=backend, cache=cache,
+                                       resolution=resolution)
+            return StreamingResponse(ndjson_lines(chunks), media_type=MEDIA_TYPES[NDJSON])
+        await result_cache.refresh_versions(backend)
+        key = result_cache.make_key('calculate', [(cache.get_region_id(region_code), generation_type_id)],
+                                    date_start=to_utc(date_start), date_end=to_utc(date_end), resolution=resolution, layout=layout)
+        impact_df = await result_cache.get_or_calculate(key, lambda: calculate_impact_df(
+            date_start, date_end, region_code, generation_type_id, backend=backend, cache=cache, resolution=resolution, layout=layout))
     except TypeError as e:
         return Response(status_code=400, content=str(e))
     except ValueError as e:
@@ -80,9 +141,96 @@ async def calculate_impact(date_start, region_code: str, generation_type_id: int
         return Response(status_code=500, content=str(e))
     if not isinstance(impact_df, pd.DataFrame):
         return Response(status_code=500)
+    header = wide_header(impact_df, cache, RegionCode=region_code, GenerationTypeId=generation_type_id) if layout == WIDE_LAYOUT else None
+    if response_format in (ARROW, PARQUET):
+        return binary_response(impact_df, response_format, metadata=header)
+    if layout == WIDE_LAYOUT:
+        return Response(wide_json(impact_df, header), media_type='application/json')
     return Response(impact_df.to_json(orient='records'), media_type='text/json')
 
 
+@app.get('/intensity')
+async def get_intensity(date_start, date_end, region_code: str, resolution: str = None, response_format: str = Query(None, alias='format'),
+                        accept: str = Header(None)):
+    """Generation weighted intensity of each impact category (e.g. g CO2 eq. per kWh) of the generation mix of a region,
+    over all its generation types. A row per timestamp and a column per impact category, in the wide layout"""
+    try:
+        response_format = negotiate_response_format(response_format, accept)
+        if response_format == NDJSON:
+            raise TypeError('Format `ndjson` is not supported for intensities')
+        await result_cache.refresh_versions(backend)
+        region_id = cache.get_region_id(region_code)
+        key = result_cache.make_key('intensity', [(region_id, generation_type_id) for generation_type_id in cache.generation_type_name_by_id],
+                                    date_start=to_utc(date_start), date_end=to_utc(date_end), resolution=resolution)
+        intensity_df = await result_cache.get_or_calculate(key, lambda: calculate_intensity_df(
+            date_start, date_end, region_code, backend=backend, cache=cache, resolution=resolution))
+    except TypeError as e:
+        return Response(status_code=400, content=str(e))
+    except ValueError as e:
+        return Response(status_code=422, content=str(e))
+    except ServerError as e:
+        return Response(status_code=500, content=str(e))
+    header = wide_header(intensity_df, cache, RegionCode=region_code)
+    if response_format in (ARROW, PARQUET):
+        return binary_response(intensity_df, response_format, metadata=header)
+    return Response(wide_json(intensity_df, header), media_type='application/json')
+
+
+@app.post('/generation/batch')
+async def get_electricity_generation_batch(request: BatchRequestSchema, response_format: str = Query(None, alias='format'), accept: str = Header(None)):
+    """Electricity generation of several regions and generation types, keyed by region code and generation type id"""
+    try:
+        response_format = negotiate_response_format(response_format, accept)
+        if response_format == NDJSON:
+            raise TypeError('Format `ndjson` is not supported for batch requests')
+        df = await get_electricity_generation_batch_df(request.date_start, request.date_end, request.region_codes,
+                                                       request.generation_type_ids, backend=backend, cache=cache,
+                                                       resolution=request.resolution)
+    except TypeError as e:
+        return Response(status_code=400, content=str(e))
+    except ValueError as e:
+        return Response(status_code=422, content=str(e))
+    except ServerError as e:
+        return Response(status_code=500, content=str(e))
+    if response_format in (ARROW, PARQUET):
+        return binary_response(df, response_format)
+    return Response(to_keyed_json(df, request.region_codes, request.generation_type_ids, cache), media_type='application/json')
+
+
+@app.post('/calculate/batch')
+async def calculate_impact_batch(request: BatchRequestSchema, layout: str = LONG_LAYOUT, response_format: str = Query(None, alias='format'),
+                                 accept: str = Header(None)):
+    """Environmental impacts of several regions and generation types, keyed by region code and generation type id.
+    With layout=wide, the rows of each key are arrays with a value per impact category, described once in a header"""
+    try:
+        response_format = negotiate_response_format(response_format, accept)
+        check_layout(layout)
+        if response_format == NDJSON:
+            raise TypeError('Format `ndjson` is not supported for batch requests')
+        await result_cache.refresh_versions(backend)
+        key = result_cache.make_key('calculate_batch',
+                                    itertools.product([cache.get_region_id(c) for c in request.region_codes], request.generation_type_ids),
+                                    date_start=to_utc(request.date_start), date_end=to_utc(request.date_end), resolution=request.resolution,
+                                    layout=layout)
+        impact_df = await result_cache.get_or_calculate(key, lambda: calculate_impact_batch_df(
+            request.date_start, request.date_end, request.region_codes, request.generation_type_ids,
+            backend=backend, cache=cache, resolution=request.resolution, layout=layout))
+    except TypeError as e:
+        return Response(status_code=400, content=str(e))
+    except ValueError as e:
+        return Response(status_code=422, content=str(e))
+    except ServerError as e:
+        return Response(status_code=500, content=str(e))
+    header = wide_header(impact_df, cache) if layout == WIDE_LAYOUT else None
+    if response_format in (ARROW, PARQUET):
+        return binary_response(impact_df, response_format, metadata=header)
+    if layout == WIDE_LAYOUT:
+        return Response(wide_json(impact_df, header, data=to_keyed_json(impact_df, request.region_codes, request.generation_type_ids, cache,
+                                                                        orient='values')),
+                        media_type='application/json')
+    return Response(to_keyed_json(impact_df, request.region_codes, request.generation_type_ids, cache), media_type='application/json')
+
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG,filename='api.log')
     uvicorn.run(app, port=8000)
@@ -0,0 +1,150 @@
+"""
+Read backend of the microservice on a Parquet export of the database, queried in process with DuckDB.
+
+The export (see src.data.parquet_store and src.pipelines.export_parquet) holds the generation data partitioned by
+region and month. A query only opens the files of the requested regions and months, and DuckDB only reads the columns
+and row groups it needs from them, so scans and aggregations over long ranges are columnar and no database server is
+needed. Queries run in worker threads, each on its own cursor, so they do not block the event loop.
+
+Periods are truncated in local time (TIMEZONE) without DuckDB's ICU extension, which may not be available offline:
+each UTC hour is joined to the start of its period, computed with pandas.
+"""
+import asyncio
+import datetime
+import functools
+from pathlib import Path
+from typing import AsyncIterator, List
+
+import duckdb
+import pandas as pd
+
+from src.data.parquet_store import MONTH_DIRECTORY_PATTERN, generation_files, read_table
+from src.microservice.backend import DATA_VERSION_COLUMNS, GenerationBackend
+from src.microservice.constants import STREAM_CHUNK_SIZE, TIMEZONE
+from src.orm.base import GenerationDataVersions
+
+GENERATION_COLUMNS = ['Id', 'RegionId', 'DateStamp', 'GenerationTypeId', 'AggregatedGeneration', 'ResolutionMinutes', 'Energy']
+AGGREGATED_COLUMNS = ['RegionId', 'GenerationTypeId', 'DateStamp', 'AggregatedGeneration', 'Energy']
+PERIOD_FREQUENCIES = {'month': 'M', 'year': 'Y'}
+
+
+@functools.lru_cache(maxsize=64)
+def period_starts_by_hour(year: int, resolution: str) -> pd.DataFrame:
+    """Start of the `resolution` long period (local time) of every UTC hour of a year, both in naive UTC.
+    Vectorized equivalent of src.data.rollups.floor_to_period"""
+    hours = pd.date_range(datetime.datetime(year, 1, 1), datetime.datetime(year + 1, 1, 1), freq='h', inclusive='left')
+    local = hours.tz_localize('UTC').tz_convert(TIMEZONE).tz_localize(None).normalize()
+    if resolution == 'week':
+        local = local - pd.to_timedelta(local.weekday, unit='D')
+    elif resolution in PERIOD_FREQUENCIES:
+        local = local.to_period(PERIOD_FREQUENCIES[resolution]).to_timestamp()
+    elif resolution != 'day':
+        raise ValueError(f'Unknown resolution `{resolution}`')
+    starts = local.tz_localize(TIMEZONE).tz_convert('UTC').tz_localize(None)
+    return pd.DataFrame({'Hour': hours.as_unit('us'), 'PeriodStart': starts.as_unit('us')})
+
+
+class ParquetBackend(GenerationBackend):
+    """Parquet files of a database export, queried with DuckDB"""
+
+    def __init__(self, root, threads: int = None):
+        self.root = Path(root)
+        self._connection = duckdb.connect(config={} if threads is None else {'threads': threads})
+
+    async def close(self):
+        self._connection.close()
+
+    def _generation_query(self, files: List[Path], region_ids: List[int], generation_type_ids: List[int],
+                          start: datetime.datetime | None, end: datetime.datetime | None, resolution: str | None,
+                          after: datetime.datetime | None, limit: int | None):
+        """Build the SQL, its parameters and the period table (or None) of a generation query"""
+        params = {'files': [str(path) for path in files]}
+        # Ids are inlined, as constant lists are pushed down to the row group statistics of the files
+        conditions = [f'g.RegionId IN ({", ".join(str(int(i)) for i in region_ids)})',
+                      f'g.GenerationTypeId IN ({", ".join(str(int(i)) for i in generation_type_ids)})']
+        for name, condition, value in (('start', 'g.DateStamp >= $start', start),
+                                       ('end', 'g.DateStamp < $end', end),
+                                       ('after', 'g.DateStamp > $after', after)):
+            if value is not None:
+                conditions.append(condition)
+                params[name] = value
+        source = "read_parquet($files, hive_partitioning = true, hive_types = {'RegionId': BIGINT, 'Month': VARCHAR}) AS g"
+        periods = None
+        if resolution is None:
+            sql = f'SELECT {", ".join(f"g.{column}" for column in GENERATION_COLUMNS)} FROM {source}'
+        else:
+            if resolution == 'hour':
+                # TIMEZONE is a whole number of hours from UTC, so hours can be truncated in UTC
+                period = "date_trunc('hour', g.DateStamp)"
+            else:
+                years = sorted({int(MONTH_DIRECTORY_PATTERN.match(path.parent.name).group('month')[:4]) for path in files})
+                periods = pd.concat([period_starts_by_hour(year, resolution) for year in years], ignore_index=True)
+                source += " JOIN periods AS p ON p.Hour = date_trunc('hour', g.DateStamp)"
+                period = 'p.PeriodStart'
+            sql = (f'SELECT g.RegionId, g.GenerationTypeId, {period} AS DateStamp, avg(g.AggregatedGeneration) AS AggregatedGeneration, '
+                   f'sum(g.Energy) AS Energy FROM {source}')
+        sql += ' WHERE ' + ' AND '.join(conditions)
+        if resolution is not None:
+            sql += f' GROUP BY g.RegionId, g.GenerationTypeId, {period}'
+            if after is not None:
+                sql += f' HAVING {period} > $after'
+        sql += ' ORDER BY RegionId, GenerationTypeId, DateStamp'
+        if limit is not None:
+            sql += f' LIMIT {int(limit)}'
+        return sql, params, periods
+
+    def _execute(self, files: List[Path], region_ids: List[int], generation_type_ids: List[int], start, end, resolution, after, limit,
+                 count: bool = False):
+        cursor = self._connection.cursor()
+        sql, params, periods = self._generation_query(files, region_ids, generation_type_ids, start, end, resolution, after, limit)
+        if count:
+            sql = f'SELECT count(*) FROM ({sql}) AS q'
+        if periods is not None:
+            cursor.register('periods', periods)
+        return cursor.execute(sql, params)
+
+    async def read_generation(self, region_ids: List[int], generation_type_ids: List[int], start: datetime.datetime | None = None,
+                              end: datetime.datetime | None = None, resolution: str | None = None,
+                              after: datetime.datetime | None = None, limit: int | None = None) -> pd.DataFrame:
+        columns = GENERATION_COLUMNS if resolution is None else AGGREGATED_COLUMNS
+        files = generation_files(self.root, region_ids, max((value for value in (start, after) if value is not None), default=None), end)
+        if len(files) == 0:
+            return pd.DataFrame(columns=columns)
+
+        def read():
+            return self._execute(files, region_ids, generation_type_ids, start, end, resolution, after, limit).df()
+        return await asyncio.to_thread(read)
+
+    async def count_generation(self, region_ids: List[int], generation_type_ids: List[int], start: datetime.datetime | None = None,
+                               end: datetime.datetime | None = None, resolution: str | None = None, limit: int | None = None) -> int:
+        files = generation_files(self.root, region_ids, start, end)
+        if len(files) == 0:
+            return 0
+
+        def count():
+            return self._execute(files, region_ids, generation_type_ids, start, end, resolution, None, limit, count=True).fetchone()[0]
+        return await asyncio.to_thread(count)
+
+    async def stream_generation(self, region_ids: List[int], generation_type_ids: List[int], start: datetime.datetime | None = None,
+                                end: datetime.datetime | None = None, resolution: str | None = None,
+                                chunk_size: int = STREAM_CHUNK_SIZE) -> AsyncIterator[pd.DataFrame]:
+        files = generation_files(self.root, region_ids, start, end)
+        if len(files) == 0:
+            return
+        reader = await asyncio.to_thread(
+            lambda: self._execute(files, region_ids, generation_type_ids, start, end, resolution, None, None).to_arrow_reader(chunk_size))
+
+        def read_next():
+            try:
+                return reader.read_next_batch().to_pandas()
+            except StopIteration:
+                return None
+        while (df := await asyncio.to_thread(read_next)) is not None:
+            yield df
+
+    async def read_table_df(self, table_name: str) -> pd.DataFrame:
+        """A table of common data, e.g. EnvironmentalImpacts"""
+        return await asyncio.to_thread(read_table, self.root, table_name)
+
+    async def read_data_versions(self) -> pd.DataFrame:
+        return (await self.read_table_df(GenerationDataVersions.__tablename__))[DATA_VERSION_COLUMNS]
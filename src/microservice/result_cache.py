@@ -0,0 +1,119 @@
+"""
+In-process cache of calculation results.
+
+Entries are evicted least recently used first once the cache holds more than `max_bytes` of dataframes, and expire
+after `ttl` seconds. Each entry records the (RegionId, GenerationTypeId) pairs it was calculated from and their data
+version (see src.data.data_versions). The versions are polled from the backend every `poll_interval` seconds, and
+entries that depend on a pair whose version changed are dropped.
+"""
+import asyncio
+import logging
+import time
+from typing import Callable, Hashable, Iterable, Tuple
+
+import cachetools
+import pandas as pd
+
+from src.microservice.backend import GenerationBackend
+from src.microservice.constants import DATA_VERSION_POLL_INTERVAL, RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL
+
+
+class _CountingTTLCache(cachetools.TTLCache):
+    """TTLCache that counts the entries evicted to make space and the entries that expired"""
+    evictions = 0
+    expirations = 0
+
+    def popitem(self):
+        item = super().popitem()
+        self.evictions += 1
+        return item
+
+    def expire(self, time=None):
+        expired = super().expire(time)
+        self.expirations += len(expired)
+        return expired
+
+
+def dataframe_size(df: pd.DataFrame) -> int:
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+class ResultCache:
+    """Bounded LRU/TTL cache of result dataframes, invalidated by generation data versions"""
+
+    def __init__(self, max_bytes: int = RESULT_CACHE_MAX_BYTES, ttl: float = RESULT_CACHE_TTL,
+                 poll_interval: float = DATA_VERSION_POLL_INTERVAL):
+        self._entries = _CountingTTLCache(maxsize=max_bytes, ttl=ttl, getsizeof=dataframe_size)
+        self._dependencies = {}  # {cache key: frozenset of (RegionId, GenerationTypeId)}
+        self._versions = {}  # {(RegionId, GenerationTypeId): Version}
+        self._versions_polled_at = None
+        self._poll_interval = poll_interval
+        self._lock = asyncio.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    async def refresh_versions(self, backend: GenerationBackend):
+        """Reload the data versions if they are older than the poll interval, and drop the entries calculated from
+        data that changed since"""
+        if self._versions_polled_at is not None and time.monotonic() - self._versions_polled_at < self._poll_interval:
+            return
+        async with self._lock:
+            if self._versions_polled_at is not None and time.monotonic() - self._versions_polled_at < self._poll_interval:
+                return
+            versions_df = await backend.read_data_versions()
+            versions = {(int(r), int(g)): int(v) for r, g, v in versions_df.itertuples(index=False)}
+            changed = {pair for pair, version in versions.items() if self._versions.get(pair) != version}
+            if self._versions_polled_at is not None and len(changed) > 0:
+                self.invalidate(changed)
+            self._versions = versions
+            self._versions_polled_at = time.monotonic()
+
+    def invalidate(self, pairs: Iterable[Tuple[int, int]]):
+        """Drop the entries calculated from any of the (RegionId, GenerationTypeId) pairs"""
+        pairs = set(pairs)
+        stale_keys = [key for key, dependencies in self._dependencies.items() if not dependencies.isdisjoint(pairs)]
+        for key in stale_keys:
+            self._dependencies.pop(key, None)
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+        if len(stale_keys) > 0:
+            logging.debug(f'Invalidated {len(stale_keys)} cached results')
+
+    def make_key(self, name: str, dependencies: Iterable[Tuple[int, int]], **params) -> Hashable:
+        """Key of a result: the name of the calculation, its normalized parameters and the current data version of each
+        (RegionId, GenerationTypeId) pair it depends on"""
+        dependencies = tuple(sorted(set(dependencies)))
+        versions = tuple(self._versions.get(pair, 0) for pair in dependencies)
+        return name, tuple(sorted(params.items())), dependencies, versions
+
+    async def get_or_calculate(self, key: Hashable, calculate: Callable) -> pd.DataFrame:
+        """Return the cached result for the key, or await `calculate()` and cache its result"""
+        result = self._entries.get(key)
+        if result is not None:
+            self.hits += 1
+            return result
+        self.misses += 1
+        result = await calculate()
+        if dataframe_size(result) <= self._entries.maxsize:
+            self._entries[key] = result
+            self._dependencies[key] = frozenset(key[2])
+        # Forget the dependencies of entries evicted or expired in the meantime
+        for stale_key in [k for k in self._dependencies if k not in self._entries]:
+            del self._dependencies[stale_key]
+        return result
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self._entries.currsize,
+            'max_bytes': self._entries.maxsize,
+            'ttl': self._entries.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests if requests > 0 else None,
+            'evictions': self._entries.evictions,
+            'expirations': self._entries.expirations,
+            'invalidations': self.invalidations,
+        }
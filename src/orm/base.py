@@ -56,16 +56,112 @@ class Regions(sql_alchemy_base):
     )
 
 
+# Range partitioned by month on DateStamp, see src.data.partitions. The primary and unique keys include DateStamp,
+# as PostgreSQL requires of the keys of a partitioned table
 class ElectricityGeneration(sql_alchemy_base):
     __tablename__ = 'ElectricityGeneration'
-    Id = sqla.Column(sqla.Integer,primary_key=True, autoincrement=True, nullable=True)
+    Id = sqla.Column(sqla.Integer, primary_key=True, autoincrement=True)
     RegionId = sqla.Column(sqla.Integer)
-    DateStamp = sqla.Column(sqla.DateTime)
+    DateStamp = sqla.Column(sqla.DateTime, primary_key=True)
     GenerationTypeId = sqla.Column(sqla.Integer)
-    AggregatedGeneration = sqla.Column(sqla.Float)
+    AggregatedGeneration = sqla.Column(sqla.Float)  # MW, average over the interval
+    ResolutionMinutes = sqla.Column(sqla.Integer)  # Length of the interval starting at DateStamp (15, 30 or 60)
+    Energy = sqla.Column(sqla.Float)  # MWh generated in the interval, AggregatedGeneration * ResolutionMinutes / 60
     __table_args__ = (
         sqla.ForeignKeyConstraint(['RegionId'], ['Regions.Id']),
         sqla.ForeignKeyConstraint(['GenerationTypeId'], ['ElectricityGenerationTypes.Id']),
         sqla.UniqueConstraint('RegionId', 'GenerationTypeId', 'DateStamp', name='UX_ElectricityGeneration'),
+        sqla.Index('IX_ElectricityGeneration_DateStamp', 'DateStamp', postgresql_using='brin'),
+        {'postgresql_partition_by': 'RANGE ("DateStamp")'},
+    )
+
+
+
+# Rollups of ElectricityGeneration, maintained incrementally by src.data.rollups.refresh_rollups
+# DateStamp is the start of the period (naive UTC), periods are in Europe/Brussels time
+class ElectricityGenerationHourly(sql_alchemy_base):
+    __tablename__ = 'ElectricityGenerationHourly'
+    RegionId = sqla.Column(sqla.Integer, primary_key=True)
+    GenerationTypeId = sqla.Column(sqla.Integer, primary_key=True)
+    DateStamp = sqla.Column(sqla.DateTime, primary_key=True)
+    AggregatedGeneration = sqla.Column(sqla.Float)  # Mean power of the rows of the period, MW
+    Energy = sqla.Column(sqla.Float)  # MWh
+    SampleCount = sqla.Column(sqla.Integer)  # Number of ElectricityGeneration rows with a value in the period
+    __table_args__ = (
+        sqla.ForeignKeyConstraint(['RegionId'], ['Regions.Id']),
+        sqla.ForeignKeyConstraint(['GenerationTypeId'], ['ElectricityGenerationTypes.Id']),
+    )
+
+
+class ElectricityGenerationDaily(sql_alchemy_base):
+    __tablename__ = 'ElectricityGenerationDaily'
+    RegionId = sqla.Column(sqla.Integer, primary_key=True)
+    GenerationTypeId = sqla.Column(sqla.Integer, primary_key=True)
+    DateStamp = sqla.Column(sqla.DateTime, primary_key=True)
+    AggregatedGeneration = sqla.Column(sqla.Float)
+    Energy = sqla.Column(sqla.Float)
+    SampleCount = sqla.Column(sqla.Integer)
+    __table_args__ = (
+        sqla.ForeignKeyConstraint(['RegionId'], ['Regions.Id']),
+        sqla.ForeignKeyConstraint(['GenerationTypeId'], ['ElectricityGenerationTypes.Id']),
+    )
+
+
+class ElectricityGenerationMonthly(sql_alchemy_base):
+    __tablename__ = 'ElectricityGenerationMonthly'
+    RegionId = sqla.Column(sqla.Integer, primary_key=True)
+    GenerationTypeId = sqla.Column(sqla.Integer, primary_key=True)
+    DateStamp = sqla.Column(sqla.DateTime, primary_key=True)
+    AggregatedGeneration = sqla.Column(sqla.Float)
+    Energy = sqla.Column(sqla.Float)
+    SampleCount = sqla.Column(sqla.Integer)
+    __table_args__ = (
+        sqla.ForeignKeyConstraint(['RegionId'], ['Regions.Id']),
+        sqla.ForeignKeyConstraint(['GenerationTypeId'], ['ElectricityGenerationTypes.Id']),
+    )
+
+
+class GenerationDataVersions(sql_alchemy_base):
+    """Version of the generation data of each region and generation type, incremented whenever it is written.
+    Used to invalidate cached results in the microservice"""
+    __tablename__ = 'GenerationDataVersions'
+    RegionId = sqla.Column(sqla.Integer, primary_key=True)
+    GenerationTypeId = sqla.Column(sqla.Integer, primary_key=True)
+    Version = sqla.Column(sqla.BigInteger, nullable=False, default=1)
+    UpdatedAt = sqla.Column(sqla.DateTime(timezone=True), server_default=sqla.func.now())
+    __table_args__ = (
+        sqla.ForeignKeyConstraint(['RegionId'], ['Regions.Id']),
+        sqla.ForeignKeyConstraint(['GenerationTypeId'], ['ElectricityGenerationTypes.Id']),
     )
 
+
+class CrossBorderFlows(sql_alchemy_base):
+    """Physical flows between neighbouring regions, from the ENTSO-E "Cross-Border Physical Flows". Each direction of
+    a border has its own rows"""
+    __tablename__ = 'CrossBorderFlows'
+    Id = sqla.Column(sqla.Integer, primary_key=True, autoincrement=True)
+    FromRegionId = sqla.Column(sqla.Integer)
+    ToRegionId = sqla.Column(sqla.Integer)
+    DateStamp = sqla.Column(sqla.DateTime)  # Naive UTC
+    Flow = sqla.Column(sqla.Float)  # MW from FromRegionId to ToRegionId, average over the interval
+    ResolutionMinutes = sqla.Column(sqla.Integer)
+    Energy = sqla.Column(sqla.Float)  # MWh, Flow * ResolutionMinutes / 60
+    __table_args__ = (
+        sqla.ForeignKeyConstraint(['FromRegionId'], ['Regions.Id']),
+        sqla.ForeignKeyConstraint(['ToRegionId'], ['Regions.Id']),
+        sqla.UniqueConstraint('FromRegionId', 'ToRegionId', 'DateStamp', name='UX_CrossBorderFlows'),
+    )
+
+
+class ConsumptionIntensities(sql_alchemy_base):
+    """Consumption based intensity of the electricity consumed in each region, imports included, per impact category.
+    Computed by flow tracing, see src.pipelines.trace_crossborder_flows"""
+    __tablename__ = 'ConsumptionIntensities'
+    RegionId = sqla.Column(sqla.Integer, primary_key=True)
+    ImpactCategoryId = sqla.Column(sqla.Integer, primary_key=True)
+    DateStamp = sqla.Column(sqla.DateTime, primary_key=True)  # Naive UTC start of the interval
+    Intensity = sqla.Column(sqla.Float)  # ImpactCategoryUnit per PerUnit (e.g. g CO2 eq. per kWh) consumed
+    __table_args__ = (
+        sqla.ForeignKeyConstraint(['RegionId'], ['Regions.Id']),
+        sqla.ForeignKeyConstraint(['ImpactCategoryId'], ['ImpactCategories.Id']),
+    )
@@ -0,0 +1,30 @@
+"""
+Bulk loading of dataframes into PostgreSQL with COPY FROM STDIN
+"""
+import io
+from typing import List
+
+import pandas as pd
+
+
+def quote_identifier(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def copy_df_to_table(cursor, df: pd.DataFrame, table_name: str, columns: List[str] = None) -> int:
+    """Stream the rows of a dataframe into a table with COPY, which is much faster than INSERT statements.
+    NaN and None are loaded as NULL.
+
+    @param cursor: psycopg2 cursor. The rows are part of the cursor's transaction
+    @param df: Dataframe to load. The index is not loaded
+    @param table_name: Name of the (possibly temporary) table to load into
+    @param columns: Columns of the dataframe to load, which must match column names of the table. Defaults to all
+    @return: Number of rows loaded
+    """
+    columns = list(df.columns) if columns is None else columns
+    buffer = io.StringIO()
+    df.to_csv(buffer, columns=columns, index=False, header=False)
+    buffer.seek(0)
+    columns_sql = ', '.join(quote_identifier(column) for column in columns)
+    cursor.copy_expert(f'COPY {quote_identifier(table_name)} ({columns_sql}) FROM STDIN WITH (FORMAT csv)', buffer)
+    return len(df)
@@ -1,144 +1,105 @@
-# TODO: Validate that it works, and get the table comparison to match
-# The reason for including it is that we need to do upserts since entire days are returned
 # Upsert function for pandas to_sql with postgres
+# The reason for including it is that we need to do upserts since entire days are returned
 # https://stackoverflow.com/questions/1109061/insert-on-duplicate-update-in-postgresql/8702291#8702291
 # https://www.postgresql.org/docs/devel/sql-insert.html#SQL-ON-CONFLICT
-import os
-import uuid
+import logging
+from dataclasses import dataclass
+from typing import List
 
 import pandas as pd
 import sqlalchemy
 from sqlalchemy import text
-from dotenv import load_dotenv
 
+from src.orm.bulk import copy_df_to_table, quote_identifier
+
+TEMP_TABLE = 'temp_upsert'
+
+
+@dataclass
+class UpsertResult:
+    """Number of rows inserted and updated by upsert_df"""
+    inserted: int
+    updated: int
 
-def upsert_df(df: pd.DataFrame, table_name: str, engine: sqlalchemy.engine.Engine):
+
+def get_unique_keys(connection, table_name: str, schema: str = 'public') -> List[set]:
+    """Return the column sets of the unique constraints and unique indexes of a table (partial indexes excluded)"""
+    rows = connection.execute(text("""
+        SELECT array_agg(a.attname::text)
+        FROM pg_index i
+        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+        WHERE i.indrelid = to_regclass(:qualified_name) AND i.indisunique AND i.indpred IS NULL
+        GROUP BY i.indexrelid
+        """), {'qualified_name': f'{quote_identifier(schema)}.{quote_identifier(table_name)}'}).fetchall()
+    return [set(row[0]) for row in rows]
+
+
+def upsert_df(df: pd.DataFrame, table_name: str, engine: sqlalchemy.engine.Engine) -> UpsertResult:
     """Implements the equivalent of pd.DataFrame.to_sql(..., if_exists='update')
     (which does not exist). Creates or updates the db records based on the
     dataframe records.
-    Conflicts to determine update are based on the dataframes index.
-    This will set primary keys on the table equal to the index names
+    Conflicts to determine update are based on the dataframes index, whose names must match the columns of a
+    unique constraint (or unique index) of the table. The table must already exist: no DDL is run on it, creating it
+    is left to the schema setup.
+
+    1. COPY the dataframe into a temp table that is dropped at the end of the transaction
+    2. Insert/update from the temp table into table_name with INSERT ... ON CONFLICT DO UPDATE
 
-    1. Create a temp table from the dataframe
-    2. Insert/update from temp table into table_name
+    Everything runs in one transaction. If the dataframe has several rows with the same index, the last one is kept.
 
-    Returns: True if successful
+    Returns: UpsertResult with the number of rows inserted and updated
 
     """
-    with engine.connect() as connection:
-        # If the table does not exist, we should just use to_sql to create it
-        if not connection.execute(
-            text(f"""SELECT EXISTS (
-                SELECT FROM information_schema.tables 
-                WHERE  table_schema = 'public'
-                AND    table_name   = '{table_name}');
-                """)
-        ).first()[0]:
-            df.to_sql(table_name, engine)
-            return True
-    
-        # If it already exists...
-        temp_table_name = f"temp_{uuid.uuid4().hex[:6]}"
-        df.to_sql(temp_table_name, engine, index=True)
-    
-        index = list(df.index.names)
-        index_sql_txt = ", ".join([f'"{i}"' for i in index])
-        columns = list(df.columns)
-        headers = index + columns
-        headers_sql_txt = ", ".join(
-            [f'"{i}"' for i in headers]
-        )  # index1, index2, ..., column 1, col2, ...
-    
-        # col1 = excluded.col1, col2=excluded.col2
-        update_column_stmt = ", ".join([f'"{col}" = EXCLUDED."{col}"' for col in columns])
-    
-        # For the ON CONFLICT clause, postgres requires that the columns have unique constraint
-        query_pk = text(f"""
-        ALTER TABLE "{table_name}" ADD CONSTRAINT {table_name}_unique_constraint_for_upsert UNIQUE ({index_sql_txt});
-        """)
-        try:
-            connection.execute(query_pk)
-        except Exception as e:
-            # relation "unique_constraint_for_upsert" already exists
-            if not 'unique_constraint_for_upsert" already exists' in e.args[0]:
-                raise e
-    
-        # Compose and execute upsert query
-        query_upsert = text(f"""
-        INSERT INTO "{table_name}" ({headers_sql_txt}) 
-        SELECT {headers_sql_txt} FROM "{temp_table_name}"
-        ON CONFLICT ({index_sql_txt}) DO UPDATE 
-        SET {update_column_stmt};
+    index = list(df.index.names)
+    columns = list(df.columns)
+    headers = index + columns
+    if any(name is None for name in index):
+        raise ValueError('All levels of the dataframe index must be named, as they are used as the conflict columns')
+
+    data = df.reset_index()
+    duplicated = data.duplicated(subset=index, keep='last')
+    if duplicated.any():
+        logging.warning(f'{duplicated.sum()} rows with duplicate index values will be skipped. The last one is kept')
+        data = data.loc[~duplicated]
+
+    index_sql_txt = ", ".join(quote_identifier(i) for i in index)
+    headers_sql_txt = ", ".join(quote_identifier(i) for i in headers)  # index1, index2, ..., column 1, col2, ...
+    table_sql_txt = quote_identifier(table_name)
+
+    with engine.begin() as connection:
+        if connection.execute(text("SELECT to_regclass(:qualified_name)"),
+                              {'qualified_name': f'public.{table_sql_txt}'}).scalar() is None:
+            raise ValueError(f'Table `{table_name}` does not exist, it must be created before upserting into it')
+        unique_keys = get_unique_keys(connection, table_name)
+        # For the ON CONFLICT clause, postgres requires that the columns have a unique constraint
+        if set(index) not in unique_keys:
+            raise ValueError(f'Table `{table_name}` has no unique constraint on the index columns {index}')
+
+        cursor = connection.connection.cursor()
+        # Temp table with the types of the target table's columns
+        cursor.execute(f"""
+        CREATE TEMP TABLE "{TEMP_TABLE}" ON COMMIT DROP AS
+        SELECT {headers_sql_txt} FROM {table_sql_txt} WITH NO DATA;
         """)
-        connection.execute(query_upsert)
-        connection.execute(text(f'DROP TABLE "{temp_table_name}"'))
-        # connection.commit()
-    return True
-
-
-if __name__ == "__main__":
-    # TESTS (create environment variable DB_STR to do it)
-    load_dotenv()
-    HOST = os.getenv('ELEC_LCA_HOST')
-    DB_NAME = os.getenv('ELEC_LCA_DB_NAME')
-    USER = os.getenv('ELEC_LCA_USER')
-    PASSWORD = os.getenv('ELEC_LCA_PASSWORD')
-
-    engine = sqlalchemy.create_engine(sqlalchemy.engine.url.URL.create(
-        drivername='postgresql',
-        host=HOST,
-        database=DB_NAME,
-        username=USER,
-        password=PASSWORD
-    ))
-
-    indexes = ["id1", "id2"]
-
-    df = pd.DataFrame(
-        {
-            "id1": [1, 2, 3, 3],
-            "id2": ["a", "a", "b", "c"],
-            "name": ["name1", "name2", "name3", "name4"],
-            "age": [20, 32, 29, 68],
-        }
-    ).set_index(indexes)
-
-    df_update = pd.DataFrame(
-        {
-            "id1": [1, 2, 3],
-            "id2": ["a", "a", "b"],
-            "name": ["surname1", "surname2", "surname3"],
-            "age": [13, 44, 29],
-        }
-    ).set_index(indexes)
-
-    df_insert = pd.DataFrame(
-        {
-            "id1": [1],
-            "id2": ["d"],
-            "name": ["dname"],
-            "age": [100],
-        }
-    ).set_index(indexes)
-
-    expected_result = (
-        pd.DataFrame(
-            {
-                "id1": [1, 2, 3, 3, 1],
-                "id2": ["a", "a", "b", "c", "d"],
-                "name": ["surname1", "surname2", "surname3", "name4", "dname"],
-                "age": [13, 44, 29, 68, 100],
-            }
+        copy_df_to_table(cursor, data, TEMP_TABLE, headers)
+
+        if len(columns) > 0:
+            # col1 = excluded.col1, col2=excluded.col2
+            update_column_stmt = ", ".join([f'{quote_identifier(col)} = EXCLUDED.{quote_identifier(col)}' for col in columns])
+            on_conflict = f'DO UPDATE SET {update_column_stmt}'
+        else:
+            on_conflict = 'DO NOTHING'
+
+        # Compose and execute upsert query. xmax is 0 for rows that were inserted rather than updated
+        cursor.execute(f"""
+        WITH upserted AS (
+            INSERT INTO {table_sql_txt} ({headers_sql_txt})
+            SELECT {headers_sql_txt} FROM "{TEMP_TABLE}"
+            ON CONFLICT ({index_sql_txt}) {on_conflict}
+            RETURNING (xmax = 0) AS inserted
         )
-        .set_index(indexes)
-        .sort_index()
-    )
-
-    TNAME = "test_upsert_df"
-    upsert_df(df=df, table_name=TNAME, engine=engine)
-    upsert_df(df=df_update, table_name=TNAME, engine=engine)
-    upsert_df(df=df_insert, table_name=TNAME, engine=engine)
-    result = pd.read_sql_table(TNAME, engine).set_index(indexes).sort_index()
-    difference = result.compare(expected_result)
-    assert difference.shape[0] == 0
-    print("Passed tests")
+        SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) FROM upserted;
+        """)
+        inserted, updated = cursor.fetchone()
+    logging.info(f'Upserted into {table_name}: {inserted} rows inserted, {updated} rows updated')
+    return UpsertResult(inserted=inserted, updated=updated)
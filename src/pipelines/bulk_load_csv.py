@@ -0,0 +1,298 @@
+"""
+Parallel bulk load of a directory of ENTSO-E CSV exports, e.g. data/external/entso-e/<zone>/*.csv.
+
+Files are parsed in a process pool, so parsing uses all the cores. Each worker sends the chunks of its file back as
+they are parsed, and a writer thread per file stages them in the database in one transaction (see
+store_generation_frames_to_db), so a file is never in memory as a whole. Parsed chunks wait in memory until they are
+staged, so the workers pause while the chunks waiting add up to max_bytes_in_flight. The status of each file is
+recorded in a JSON manifest after its transaction commits: an interrupted run started again skips the files that were
+already loaded (unless they changed since).
+"""
+import argparse
+import collections
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List
+
+import dotenv
+import pandas as pd
+import sqlalchemy
+
+from src.data.get_common_data import BasicDataCache, load_common_data_from_db
+from src.data.store_generation_data import store_generation_frames_to_db
+from src.extract.extract_entsoe_from_csv import CHUNK_SIZE, iter_entsoe_csv
+
+MANIFEST_NAME = 'bulk_load_manifest.json'
+MAX_BYTES_IN_FLIGHT = 256 * 1024 * 1024  # Of parsed chunks waiting to be written
+DONE = 'done'
+FAILED = 'failed'
+END_OF_FILE = None
+
+_chunk_queue = None  # Of the worker processes, see parse_file
+
+
+@dataclass(frozen=True)
+class CsvMappings:
+    """The parts of BasicDataCache needed to parse exports, as plain dicts that can be sent to worker processes"""
+    region_id_by_code: Dict[str, int]
+    generation_type_id_by_external_name: Dict[tuple, int]
+
+    @classmethod
+    def from_cache(cls, cache: BasicDataCache) -> 'CsvMappings':
+        return cls(region_id_by_code=dict(cache.region_id_by_code),
+                   generation_type_id_by_external_name=dict(cache.generation_type_id_by_external_name))
+
+
+class Manifest:
+    """Load status of each file, saved to a JSON file after every change. Thread safe"""
+
+    def __init__(self, path, root):
+        self.path = Path(path)
+        self.root = Path(root)
+        self._lock = threading.Lock()
+        self.entries = json.loads(self.path.read_text()) if self.path.exists() else {}
+
+    def _key(self, filepath: Path) -> str:
+        return Path(filepath).relative_to(self.root).as_posix()
+
+    @staticmethod
+    def _signature(filepath: Path) -> dict:
+        stat = Path(filepath).stat()
+        return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+    def is_done(self, filepath: Path) -> bool:
+        """True if the file was loaded and has not changed since"""
+        entry = self.entries.get(self._key(filepath))
+        return entry is not None and entry['status'] == DONE and all(
+            entry.get(name) == value for name, value in self._signature(filepath).items())
+
+    def record(self, filepath: Path, status: str, rows: int = None, error: str = None):
+        with self._lock:
+            self.entries[self._key(filepath)] = {'status': status, **self._signature(filepath), 'rows': rows,
+                                                 'error': error, 'updated_at': datetime.datetime.now().isoformat()}
+            # Replace the manifest atomically, so that an interrupted run never leaves a truncated manifest
+            temporary_path = self.path.with_name(f'{self.path.name}.tmp')
+            temporary_path.write_text(json.dumps(self.entries, indent=1, sort_keys=True))
+            os.replace(temporary_path, self.path)
+
+
+def discover_files(root, pattern: str = '*.csv') -> List[Path]:
+    """Find the exports under `root`, in all its subdirectories"""
+    return sorted(path for path in Path(root).rglob(pattern) if path.is_file())
+
+
+class ParseError(Exception):
+    """Error of a worker process parsing an export, sent to the parent after the chunks it parsed before the error"""
+
+
+def _set_chunk_queue(chunk_queue):
+    global _chunk_queue
+    _chunk_queue = chunk_queue
+
+
+def parse_file(filepath: Path, mappings: CsvMappings, chunksize: int = CHUNK_SIZE, engine: str = 'c') -> int:
+    """Parse an export and send its long format chunks to the parent through the chunk queue of the worker process, as
+    (filepath, chunk), followed by (filepath, END_OF_FILE) or (filepath, ParseError). Runs in a worker process.
+
+    @return: Number of chunks sent
+    """
+    count_chunks = 0
+    try:
+        for long_df in iter_entsoe_csv(filepath, mappings, chunksize=chunksize, engine=engine):
+            if len(long_df) > 0:
+                _chunk_queue.put((filepath, long_df))
+                count_chunks += 1
+    except Exception as e:
+        _chunk_queue.put((filepath, ParseError(f'{type(e).__name__}: {e}')))
+        return count_chunks
+    _chunk_queue.put((filepath, END_OF_FILE))
+    return count_chunks
+
+
+def bulk_load_directory(
+        root,
+        cache: BasicDataCache,
+        sql_engine,
+        pattern: str = '*.csv',
+        manifest_path=None,
+        parse_workers: int = None,
+        engine: str = 'c',
+        chunksize: int = CHUNK_SIZE,
+        store_frames: Callable[[Iterator[pd.DataFrame], object], int] = store_generation_frames_to_db,
+        max_bytes_in_flight: int = MAX_BYTES_IN_FLIGHT) -> Dict[str, int]:
+    """Load all the ENTSO-E exports under a directory into the ElectricityGeneration table. Each file is written in
+    one transaction.
+
+    @param root: Directory of the exports
+    @param cache: BasicDataCache
+    @param sql_engine: SQL engine to the elec_lca database. Its pool needs a connection per parse worker
+    @param pattern: Glob pattern of the export file names
+    @param manifest_path: Path of the JSON manifest. Defaults to bulk_load_manifest.json in `root`
+    @param parse_workers: Number of parsing processes, and of files loaded at once. Defaults to the number of cores
+    @param engine: CSV engine of iter_entsoe_csv
+    @param chunksize: Number of rows of the exports per chunk
+    @param store_frames: Function storing the chunks of a file in one transaction, store_generation_frames_to_db by
+        default
+    @param max_bytes_in_flight: Size of the parsed chunks that can wait to be written at once. Parsing pauses above it
+    @return: Number of files by status (done, failed, skipped)
+    """
+    root = Path(root)
+    manifest = Manifest(manifest_path or root / MANIFEST_NAME, root)
+    files = discover_files(root, pattern)
+    pending = [filepath for filepath in files if not manifest.is_done(filepath)]
+    logging.info(f'{len(files)} files found in {root}, {len(files) - len(pending)} already loaded')
+    counts = {DONE: 0, FAILED: 0, 'skipped': len(files) - len(pending)}
+    counts_lock = threading.Lock()
+
+    def finish(filepath, status, rows=None, error=None):
+        manifest.record(filepath, status, rows=rows, error=error)
+        with counts_lock:
+            counts[status] += 1
+
+    # Bytes of the parsed chunks waiting to be written. Chunks are only taken from the workers while this is below
+    # max_bytes_in_flight, and the workers pause when the few chunks the chunk queue holds are not taken
+    bytes_in_flight = 0
+    bytes_released = threading.Condition()
+
+    def release(size: int):
+        nonlocal bytes_in_flight
+        with bytes_released:
+            bytes_in_flight -= size
+            bytes_released.notify_all()
+
+    def write(filepath, file_queue):
+        def chunks():
+            while True:
+                item = file_queue.get()
+                if item is END_OF_FILE:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                long_df, size = item
+                del item
+                try:
+                    yield long_df
+                finally:
+                    del long_df
+                    release(size)
+
+        try:
+            s = time.time()
+            rows = store_frames(chunks(), sql_engine)
+            logging.info(f'{rows} rows of {filepath} written in {time.time() - s:.2f} s')
+            finish(filepath, DONE, rows=rows)
+        except ParseError as e:
+            logging.error(f'Failed to parse {filepath}: {e}')
+            finish(filepath, FAILED, error=str(e))
+        except Exception as e:
+            logging.exception(f'Failed to store {filepath}')
+            finish(filepath, FAILED, error=str(e))
+
+    # A writer thread per file being loaded, each with its own queue of chunks
+    writers = {}
+    file_queues = {}
+
+    def remove_finished_writers():
+        for filepath in [filepath for filepath, writer in writers.items() if not writer.is_alive()]:
+            del writers[filepath]
+            # Chunks that arrived after the writer failed
+            file_queue = file_queues.pop(filepath)
+            while not file_queue.empty():
+                item = file_queue.get()
+                if isinstance(item, tuple):
+                    release(item[1])
+
+    mappings = CsvMappings.from_cache(cache)
+    parse_workers = parse_workers or os.cpu_count() or 1
+    context = multiprocessing.get_context()
+    chunk_queue = context.Queue(maxsize=parse_workers)
+    try:
+        with ProcessPoolExecutor(max_workers=parse_workers, mp_context=context, initializer=_set_chunk_queue,
+                                 initargs=(chunk_queue,)) as pool:
+            to_parse = collections.deque(pending)
+            parsing = {}
+            while len(to_parse) > 0 or len(writers) > 0:
+                while len(to_parse) > 0 and len(writers) < parse_workers:
+                    filepath = to_parse.popleft()
+                    file_queues[filepath] = queue.Queue()
+                    writers[filepath] = threading.Thread(target=write, args=(filepath, file_queues[filepath]),
+                                                         name=f'bulk-load-writer-{filepath.name}')
+                    writers[filepath].start()
+                    parsing[pool.submit(parse_file, filepath, mappings, chunksize=chunksize, engine=engine)] = filepath
+
+                # Wake up now and then to start files when writers finish
+                with bytes_released:
+                    within_budget = bytes_released.wait_for(lambda: bytes_in_flight < max_bytes_in_flight, timeout=1.0)
+                if within_budget:
+                    try:
+                        filepath, item = chunk_queue.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+                    else:
+                        if filepath in file_queues:
+                            if isinstance(item, pd.DataFrame):
+                                size = int(item.memory_usage(deep=True).sum())
+                                with bytes_released:
+                                    bytes_in_flight += size
+                                item = (item, size)
+                            file_queues[filepath].put(item)
+                        del item
+
+                # Worker processes that died do not send the end of their file
+                for future in [future for future in parsing if future.done()]:
+                    filepath = parsing.pop(future)
+                    if future.exception() is not None and filepath in file_queues:
+                        file_queues[filepath].put(ParseError(str(future.exception())))
+                remove_finished_writers()
+    finally:
+        for file_queue in file_queues.values():
+            file_queue.put(ParseError('Bulk load interrupted'))
+        for writer in writers.values():
+            writer.join()
+    logging.info(f'Bulk load of {root} finished: {counts}')
+    return counts
+
+
+def main():
+    dotenv.load_dotenv()
+    project_dir = Path(__file__).resolve().parents[2]
+    parser = argparse.ArgumentParser(description='Load a directory of ENTSO-E "Actual Generation per Production Type" CSV exports')
+    parser.add_argument('root', nargs='?', default=project_dir / 'data/external/entso-e')
+    parser.add_argument('--pattern', default='*.csv')
+    parser.add_argument('--parse-workers', type=int, default=None)
+    parser.add_argument('--engine', default='c', choices=['c', 'pyarrow'])
+    parser.add_argument('--max-mb-in-flight', type=int, default=MAX_BYTES_IN_FLIGHT // (1024 * 1024),
+                        help='Megabytes of parsed chunks waiting to be written at once')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(message)s')
+
+    HOST = os.getenv('ELEC_LCA_HOST')
+    DB_NAME = os.getenv('ELEC_LCA_DB_NAME')
+    USER = os.getenv('ELEC_LCA_USER')
+    PASSWORD = os.getenv('ELEC_LCA_PASSWORD')
+
+    # Connect to postgres database
+    sql_engine = sqlalchemy.create_engine(sqlalchemy.engine.url.URL.create(
+        drivername='postgresql',
+        host=HOST,
+        database=DB_NAME,
+        username=USER,
+        password=PASSWORD
+    ), pool_size=args.parse_workers or os.cpu_count() or 1)
+    cache = load_common_data_from_db(sql_engine)
+    bulk_load_directory(args.root, cache, sql_engine, pattern=args.pattern, parse_workers=args.parse_workers, engine=args.engine,
+                        max_bytes_in_flight=args.max_mb_in_flight * 1024 * 1024)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+"""
+Concurrent retrieval of ENTSO-E generation data for many regions.
+
+Regions are fetched by a pool of worker threads, which share a token bucket so that the ENTSO-E request quota is
+respected whatever the number of workers. Fetched data is handed to a single writer through a bounded queue, so the
+workers only wait for the database when the writer falls `queue_size` regions behind.
+"""
+import logging
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
+
+import pandas as pd
+import requests.exceptions
+from entsoe.exceptions import NoMatchingDataError
+
+from src.data.get_common_data import BasicDataCache
+from src.data.store_generation_data import entsoe_generation_to_long_df, store_generation_frame_to_db
+
+# ENTSO-E allows 400 requests per minute per user
+ENTSOE_REQUESTS_PER_MINUTE = 400
+FETCH_WORKERS = 4
+FETCH_QUEUE_SIZE = 8
+MAX_RETRIES = 5
+BACKOFF_SECONDS = 2.0
+
+
+class TokenBucket:
+    """Thread safe token bucket rate limiter: `rate` tokens per second are added, up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, waiting until one is available"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def entsoe_rate_limiter(requests_per_minute: float = ENTSOE_REQUESTS_PER_MINUTE) -> TokenBucket:
+    """Token bucket for the ENTSO-E quota. The burst is kept small so that requests are spread over the minute"""
+    return TokenBucket(rate=requests_per_minute / 60, capacity=max(1.0, requests_per_minute / 60))
+
+
+def is_retryable(error: requests.exceptions.HTTPError) -> bool:
+    """Rate limiting (429) and server errors are retried. Other client errors would fail again"""
+    response = error.response
+    return response is None or response.status_code == 429 or response.status_code >= 500
+
+
+def fetch_with_retries(query: Callable[[], pd.DataFrame | pd.Series], description: str, rate_limiter: TokenBucket,
+                       max_retries: int = MAX_RETRIES, backoff_seconds: float = BACKOFF_SECONDS) -> pd.DataFrame | pd.Series | None:
+    """Run an ENTSO-E query, retrying with exponential backoff on HTTP errors.
+
+    @param query: Function running the query
+    @param description: What is queried, e.g. the region code, for the logs
+    @param rate_limiter: Token bucket shared by all the workers. A token is taken before each attempt
+    @param max_retries: Number of retries after the first attempt
+    @param backoff_seconds: Wait before the first retry. It doubles after each retry
+    @return: Result of the query, or None if there is no data or all the attempts failed
+    """
+    for attempt in range(max_retries + 1):
+        rate_limiter.acquire()
+        try:
+            return query()
+        except NoMatchingDataError:
+            logging.warning(f'NoMatchingDataError for {description} in date range')
+            return None
+        except requests.exceptions.HTTPError as e:
+            if attempt == max_retries or not is_retryable(e):
+                logging.warning(f'HTTP error in entsoepy library for {description} after {attempt + 1} attempts. Skipping. Full error: {e}')
+                return None
+            # Jitter keeps the workers from retrying in lockstep
+            delay = backoff_seconds * 2 ** attempt * random.uniform(1, 1.5)
+            logging.info(f'HTTP error for {description}, retrying in {delay:.1f} s. Full error: {e}')
+            time.sleep(delay)
+    return None
+
+
+def fetch_generation(entsoe_client, region_code: str, start: pd.Timestamp, end: pd.Timestamp, rate_limiter: TokenBucket,
+                     max_retries: int = MAX_RETRIES, backoff_seconds: float = BACKOFF_SECONDS) -> pd.DataFrame | None:
+    """Query the generation of a region, retrying with exponential backoff on HTTP errors (see fetch_with_retries).
+
+    @param entsoe_client: EntsoePandasClient
+    @param region_code: ENTSO-E Region code
+    @return: Wide generation dataframe, or None if there is no data or all the attempts failed
+    """
+    return fetch_with_retries(lambda: entsoe_client.query_generation(region_code, start=start, end=end, psr_type=None),
+                              region_code, rate_limiter, max_retries, backoff_seconds)
+
+
+def retrieve_and_store_intervals(
+        entsoe_client,
+        sql_engine,
+        intervals: List[Tuple[str, pd.Timestamp, pd.Timestamp]],
+        cache: BasicDataCache,
+        generation_type_filter: List[Tuple] = None,
+        workers: int = FETCH_WORKERS,
+        rate_limiter: TokenBucket = None,
+        queue_size: int = FETCH_QUEUE_SIZE,
+        max_retries: int = MAX_RETRIES,
+        backoff_seconds: float = BACKOFF_SECONDS,
+        store_frame: Callable[[pd.DataFrame, object], int] = store_generation_frame_to_db) -> Dict[Tuple, int | None]:
+    """Retrieve the electricity generation of several (region, start, end) intervals concurrently and store it to the
+    database. Each interval is written in its own transaction by the calling thread, as soon as it is fetched.
+
+    @param entsoe_client: EntsoePandasClient. It is shared by the workers
+    @param sql_engine: SQL engine to the elec_lca database
+    @param intervals: Tuples of (ENTSO-E Region code, start pd.Timestamp, end pd.Timestamp)
+    @param cache: BasicDataCache
+    @param generation_type_filter: See get_and_store_generation_for_region
+    @param workers: Number of concurrent fetches
+    @param rate_limiter: Token bucket limiting the requests. Defaults to the ENTSO-E quota
+    @param queue_size: Number of fetched intervals that can wait for the writer
+    @param max_retries: See fetch_generation
+    @param backoff_seconds: See fetch_generation
+    @param store_frame: Function storing a long format frame, store_generation_frame_to_db by default
+    @return: Number of rows written per interval, None for the intervals that could not be fetched or stored
+    """
+    for region_code, _, _ in intervals:
+        if region_code not in cache.region_id_by_code:
+            raise ValueError(f'Could not find region {region_code} in the Regions table. Please run fill_regions()')
+    if rate_limiter is None:
+        rate_limiter = entsoe_rate_limiter()
+    fetched = queue.Queue(maxsize=queue_size)
+
+    def fetch(interval):
+        region_code, start, end = interval
+        generation = None
+        try:
+            s = time.time()
+            generation = fetch_generation(entsoe_client, region_code, start, end, rate_limiter, max_retries, backoff_seconds)
+            logging.info(f'Retrieved {region_code} from `{start}` to `{end}` in {time.time() - s:.3f} s')
+        except Exception:
+            logging.exception(f'Failed to retrieve data for {region_code}')
+        finally:
+            # Always hand over a result, so that the writer does not wait for it forever
+            fetched.put((interval, generation))
+
+    rows_written = {}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='entsoe-fetch') as pool:
+        for interval in intervals:
+            pool.submit(fetch, interval)
+        for _ in range(len(intervals)):
+            interval, generation = fetched.get()
+            if generation is None:
+                rows_written[interval] = None
+                continue
+            region_code = interval[0]
+            try:
+                generation_to_add = entsoe_generation_to_long_df(generation, cache.region_id_by_code[region_code], cache,
+                                                                 generation_type_filter)
+                rows_written[interval] = store_frame(generation_to_add, sql_engine)
+            except Exception:
+                logging.exception(f'Failed to store data for {region_code}')
+                rows_written[interval] = None
+    return rows_written
+
+
+def retrieve_and_store_regions(
+        entsoe_client,
+        sql_engine,
+        region_codes: List[str],
+        start: pd.Timestamp,
+        end: pd.Timestamp,
+        cache: BasicDataCache,
+        **kwargs) -> Dict[str, int | None]:
+    """Retrieve the electricity generation of several regions between the same two timestamps concurrently, and store
+    it to the database. Keyword arguments are passed to retrieve_and_store_intervals.
+
+    @return: Number of rows written per region code, None for the regions that could not be fetched or stored
+    """
+    rows_written = retrieve_and_store_intervals(entsoe_client, sql_engine,
+                                                [(region_code, start, end) for region_code in region_codes],
+                                                cache, **kwargs)
+    return {region_code: count_rows for (region_code, _, _), count_rows in rows_written.items()}
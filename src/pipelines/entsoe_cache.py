@@ -0,0 +1,150 @@
+"""
+Local cache of the raw responses of the ENTSO-E API.
+
+Responses are stored as Parquet files named after a hash of the query (method, region(s), psr_type, start, end), so a
+query that was answered once can be replayed from disk, e.g. to re-ingest history after a change of the generation
+type mapping or of the schema. Queries that ENTSO-E answered with "no matching data" are cached too, for `no_data_ttl`
+seconds only, as data that is not published yet (e.g. of the last hours) is published later. ENTSO-E also revises the
+data of the last days after its first publication, so queries that end less than `revision_horizon` seconds ago are not
+answered from the cache in read_through mode: they are queried again, and their latest response is cached for replay.
+
+Modes:
+  - read_through: answer from the cache, and query ENTSO-E (and cache the response) on a miss or for recent data
+  - write_through: always query ENTSO-E, and cache the response. Refreshes the cache
+  - offline: only answer from the cache. A miss raises CacheMissError, without any network access
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+import pandas as pd
+from entsoe import EntsoePandasClient
+from entsoe.exceptions import NoMatchingDataError
+
+READ_THROUGH = 'read_through'
+WRITE_THROUGH = 'write_through'
+OFFLINE = 'offline'
+CACHE_MODES = (READ_THROUGH, WRITE_THROUGH, OFFLINE)
+NO_DATA_SUFFIX = '.nodata'
+NO_DATA_TTL = 24 * 60 * 60  # s. "No matching data" answers are queried again after this long, except offline
+REVISION_HORIZON = 3 * 24 * 60 * 60  # s. Queries that end less than this long ago are queried again, except offline
+SERIES_COLUMN = 'Value'
+
+
+class CacheMissError(NoMatchingDataError):
+    """Raised in offline mode for a query that is not in the cache. Like NoMatchingDataError, the pipelines skip the
+    query"""
+
+
+def cache_key(method: str, country_code: str, start: pd.Timestamp, end: pd.Timestamp, **params) -> str:
+    """Content address of a query. Timestamps are normalized to UTC so equal instants give equal keys"""
+    query = {'method': method,
+             'country_code': str(country_code),
+             'start': pd.Timestamp(start).tz_convert('UTC').isoformat(),
+             'end': pd.Timestamp(end).tz_convert('UTC').isoformat(),
+             **{name: None if value is None else str(value) for name, value in params.items()}}
+    return hashlib.sha256(json.dumps(query, sort_keys=True).encode()).hexdigest()
+
+
+class CachingEntsoeClient:
+    """Wraps an EntsoePandasClient so that its responses are cached on disk. Other methods are passed through"""
+
+    def __init__(self, client, cache_dir, mode: str = READ_THROUGH, no_data_ttl: float = NO_DATA_TTL,
+                 revision_horizon: float = REVISION_HORIZON):
+        if mode not in CACHE_MODES:
+            raise ValueError(f'Invalid cache mode `{mode}`. Mode must be one of {", ".join(CACHE_MODES)}')
+        if client is None and mode != OFFLINE:
+            raise ValueError(f'A client is needed in `{mode}` mode')
+        self.client = client
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.mode = mode
+        self.no_data_ttl = no_data_ttl
+        self.revision_horizon = revision_horizon
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name):
+        if name == 'client':
+            raise AttributeError(name)
+        return getattr(self.client, name)
+
+    def with_mode(self, mode: str) -> 'CachingEntsoeClient':
+        """A client of the same ENTSO-E client and cache directory, in another mode"""
+        return CachingEntsoeClient(self.client, self.cache_dir, mode, no_data_ttl=self.no_data_ttl, revision_horizon=self.revision_horizon)
+
+    def _path(self, key: str) -> Path:
+        # Two levels of directories keep the number of files per directory small
+        return self.cache_dir / key[:2] / f'{key}.parquet'
+
+    def _read(self, path: Path) -> pd.DataFrame | None:
+        if path.exists():
+            return pd.read_parquet(path)
+        no_data_path = path.with_suffix(NO_DATA_SUFFIX)
+        try:
+            age = time.time() - no_data_path.stat().st_mtime
+        except FileNotFoundError:
+            return None
+        # Offline, there is nothing better to answer than an expired marker
+        if self.mode == OFFLINE or age < self.no_data_ttl:
+            raise NoMatchingDataError()
+        return None
+
+    def _write(self, path: Path, df: pd.DataFrame | None):
+        path.parent.mkdir(exist_ok=True)
+        # Write to a temporary file first, so that concurrent readers never see a partial file
+        temporary_path = path.with_name(f'{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        if df is None:
+            temporary_path.touch()
+            os.replace(temporary_path, path.with_suffix(NO_DATA_SUFFIX))
+        else:
+            # Series, e.g. cross-border flows, are stored as frames of one column
+            (df.to_frame(name=SERIES_COLUMN) if isinstance(df, pd.Series) else df).to_parquet(temporary_path)
+            os.replace(temporary_path, path)
+
+    def _cached(self, method: str, country_code, start: pd.Timestamp, end: pd.Timestamp, **params) -> pd.DataFrame:
+        path = self._path(cache_key(method, country_code, start, end, **params))
+        recent = pd.Timestamp(end) > pd.Timestamp.now(tz='UTC') - pd.Timedelta(seconds=self.revision_horizon)
+        if self.mode == OFFLINE or (self.mode == READ_THROUGH and not recent):
+            df = self._read(path)
+            if df is not None:
+                self.hits += 1
+                return df
+        self.misses += 1
+        if self.mode == OFFLINE:
+            raise CacheMissError(f'{method} for {country_code} from `{start}` to `{end}` is not in the cache')
+        try:
+            df = getattr(self.client, method)(country_code, start=start, end=end, **params)
+        except NoMatchingDataError:
+            self._write(path, None)
+            raise
+        self._write(path, df)
+        logging.debug(f'Cached {method} for {country_code} from `{start}` to `{end}` in {path}')
+        return df
+
+    def query_generation(self, country_code, start: pd.Timestamp, end: pd.Timestamp, psr_type: str = None, **kwargs) -> pd.DataFrame:
+        return self._cached('query_generation', country_code, start, end, psr_type=psr_type, **kwargs)
+
+    def query_crossborder_flows(self, country_code_from, country_code_to, start: pd.Timestamp, end: pd.Timestamp, **kwargs) -> pd.Series:
+        flows = self._cached('query_crossborder_flows', country_code_from, start, end, country_code_to=country_code_to, **kwargs)
+        return flows[SERIES_COLUMN].rename(None) if isinstance(flows, pd.DataFrame) else flows
+
+
+def create_entsoe_client(api_key: str):
+    """Create the ENTSO-E client of the pipelines. If ENTSOE_CACHE_DIR is set, its responses are cached there, in the
+    mode given by ENTSOE_CACHE_MODE (read_through by default), with "no matching data" answers kept for
+    ENTSOE_CACHE_NO_DATA_TTL seconds and queries that end less than ENTSOE_CACHE_REVISION_HORIZON seconds ago always
+    queried again. In offline mode no API key is needed"""
+    cache_dir = os.environ.get('ENTSOE_CACHE_DIR')
+    if cache_dir is None or cache_dir == '':
+        return EntsoePandasClient(api_key=api_key)
+    mode = os.environ.get('ENTSOE_CACHE_MODE', READ_THROUGH)
+    logging.info(f'Caching ENTSO-E responses in {cache_dir} ({mode})')
+    client = None if mode == OFFLINE else EntsoePandasClient(api_key=api_key)
+    no_data_ttl = float(os.environ.get('ENTSOE_CACHE_NO_DATA_TTL', NO_DATA_TTL))
+    revision_horizon = float(os.environ.get('ENTSOE_CACHE_REVISION_HORIZON', REVISION_HORIZON))
+    return CachingEntsoeClient(client, cache_dir, mode, no_data_ttl=no_data_ttl, revision_horizon=revision_horizon)
@@ -0,0 +1,137 @@
+"""
+Export of the elc_lca database to Parquet files, for the Parquet backend of the microservice (ELEC_LCA_BACKEND=parquet).
+
+The tables of common data are exported whole, and the generation data one file per region and month (see
+src.data.parquet_store). Syncs are incremental: only the regions whose GenerationDataVersions changed since the last
+export are exported again, optionally only from `since` on. The files of months of these regions that no longer have
+rows, and of regions that no longer exist, are removed. The versions are written last, so the Parquet backend
+invalidates its cached results once the new files are in place. Run it after each ingestion, e.g. from cron.
+"""
+import argparse
+import datetime
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import dotenv
+import pandas as pd
+import sqlalchemy as sqla
+
+from src.data.parquet_store import COMMON_TABLES, GENERATION_FILE_COLUMNS, generation_months, generation_region_ids, remove_generation_month, \
+    remove_generation_region, table_path, write_generation_month, write_parquet
+from src.data.rollups import to_naive_utc
+from src.orm.base import GenerationDataVersions, Regions
+from src.orm.bulk import quote_identifier
+
+VERSIONS_TABLE = GenerationDataVersions.__tablename__
+
+
+def changed_regions(versions_df: pd.DataFrame, exported_versions_df: pd.DataFrame) -> List[int]:
+    """Regions with a (RegionId, GenerationTypeId) pair whose data version is not the one exported"""
+    merged = versions_df.merge(exported_versions_df[['RegionId', 'GenerationTypeId', 'Version']],
+                               on=['RegionId', 'GenerationTypeId'], how='left', suffixes=('', 'Exported'))
+    changed = merged[merged['Version'] != merged['VersionExported']]
+    return sorted(int(region_id) for region_id in changed['RegionId'].unique())
+
+
+def region_months(connection, region_ids: List[int], since: datetime.datetime = None) -> List[tuple]:
+    """(RegionId, month start) of the months of generation data of the regions, from the month of `since` on"""
+    query = '''
+        SELECT "RegionId", date_trunc('month', "DateStamp") AS "Month" FROM "ElectricityGeneration"
+        WHERE "RegionId" = ANY(:region_ids)'''
+    params = {'region_ids': region_ids}
+    if since is not None:
+        query += ' AND "DateStamp" >= :since'
+        params['since'] = pd.Timestamp(to_naive_utc(since)).to_period('M').to_timestamp().to_pydatetime()
+    query += ' GROUP BY 1, 2 ORDER BY 1, 2'
+    return [(int(region_id), month) for region_id, month in connection.execute(sqla.text(query), params)]
+
+
+def export_generation_month(connection, root, region_id: int, month_start: datetime.datetime) -> int:
+    """Export the generation data of a region and month, removing its file if it has no rows. Returns the number of rows"""
+    month_end = (pd.Timestamp(month_start) + pd.DateOffset(months=1)).to_pydatetime()
+    generation_df = pd.read_sql(sqla.text(f'''
+        SELECT {", ".join(quote_identifier(column) for column in GENERATION_FILE_COLUMNS)} FROM "ElectricityGeneration"
+        WHERE "RegionId" = :region_id AND "DateStamp" >= :start AND "DateStamp" < :end'''),
+                                connection, params={'region_id': region_id, 'start': month_start, 'end': month_end})
+    if len(generation_df) == 0:
+        if remove_generation_month(root, region_id, month_start):
+            logging.info(f'Removed the generation file of region {region_id} and month {month_start:%Y-%m}, which has no rows anymore')
+    else:
+        write_generation_month(root, region_id, month_start, generation_df)
+    return len(generation_df)
+
+
+def export_to_parquet(sql_engine, root, since=None, full: bool = False) -> Dict[str, int]:
+    """Export the database to Parquet files under `root`.
+
+    @param sql_engine: SQL engine to the elc_lca database
+    @param root: Directory of the export
+    @param since: Only export the generation data from the month of `since` on (tz-aware or naive UTC)
+    @param full: Export all the regions, not only the ones whose data changed since the last export
+    @return: Number of regions, months and rows of generation data exported
+    """
+    root = Path(root)
+    s = time.time()
+    with sql_engine.connect() as connection:
+        # Versions are read before the data, so data written during the export is exported again by the next sync
+        versions_df = pd.read_sql(sqla.select(GenerationDataVersions), connection)
+        versions_path = table_path(root, VERSIONS_TABLE)
+        exported_versions_df = pd.read_parquet(versions_path) if versions_path.exists() and not full else None
+        tables = {table_name: pd.read_sql(sqla.text(f'SELECT * FROM {quote_identifier(table_name)}'), connection)
+                  for table_name in COMMON_TABLES if table_name != VERSIONS_TABLE}
+        for table_name, df in tables.items():
+            write_parquet(df, table_path(root, table_name))
+
+        if exported_versions_df is None:
+            region_ids = sorted(int(region_id) for region_id in tables[Regions.__tablename__]['Id'])
+        else:
+            region_ids = changed_regions(versions_df, exported_versions_df)
+        months = region_months(connection, region_ids, since) if len(region_ids) > 0 else []
+        # Months that were exported before but have no rows anymore are exported again, which removes their file
+        since_month = None if since is None else to_naive_utc(since)
+        months = sorted(set(months) | {(region_id, month_start) for region_id in region_ids
+                                       for month_start in generation_months(root, region_id, since_month)})
+        existing_region_ids = {int(region_id) for region_id in tables[Regions.__tablename__]['Id']}
+        for region_id in generation_region_ids(root):
+            if region_id not in existing_region_ids:
+                remove_generation_region(root, region_id)
+                logging.info(f'Removed the generation files of region {region_id}, which does not exist anymore')
+        count_rows = 0
+        for region_id, month_start in months:
+            count_rows += export_generation_month(connection, root, region_id, month_start)
+    write_parquet(versions_df, versions_path)
+    logging.info(f'{count_rows} rows of {len(months)} months of {len(region_ids)} regions exported to {root} in {time.time() - s:.1f} s')
+    return {'regions': len(region_ids), 'months': len(months), 'rows': count_rows}
+
+
+def main():
+    dotenv.load_dotenv()
+    project_dir = Path(__file__).resolve().parents[2]
+    parser = argparse.ArgumentParser(description='Export the elc_lca database to Parquet files for the parquet backend of the microservice')
+    parser.add_argument('root', nargs='?', default=os.getenv('ELEC_LCA_PARQUET_DIR') or project_dir / 'data/processed/parquet')
+    parser.add_argument('--since', default=None, help='Only export generation data from the month of this date on')
+    parser.add_argument('--full', action='store_true', help='Export all regions, not only the ones that changed since the last export')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(message)s')
+
+    HOST = os.getenv('ELEC_LCA_HOST')
+    DB_NAME = os.getenv('ELEC_LCA_DB_NAME')
+    USER = os.getenv('ELEC_LCA_USER')
+    PASSWORD = os.getenv('ELEC_LCA_PASSWORD')
+
+    sql_engine = sqla.create_engine(sqla.engine.url.URL.create(
+        drivername='postgresql',
+        host=HOST,
+        database=DB_NAME,
+        username=USER,
+        password=PASSWORD
+    ))
+    export_to_parquet(sql_engine, args.root, since=args.since, full=args.full)
+
+
+if __name__ == '__main__':
+    main()
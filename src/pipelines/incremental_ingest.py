@@ -0,0 +1,294 @@
+"""
+Incremental ingestion of ENTSO-E generation data.
+
+Every cycle, the data already in ElectricityGeneration decides what is fetched:
+  - The high-water mark of each (RegionId, GenerationTypeId), i.e. its last DateStamp. Each region is fetched from the
+    oldest high-water mark of its generation types up to now.
+  - Holes in the recent data of each (RegionId, GenerationTypeId): missing (or NULL) intervals between two stored ones.
+The intervals to fetch are merged per region and split into chunks that ENTSO-E answers in one request, so a cycle
+only downloads and rewrites the data that is new or missing. Intervals with holes bypass the cache of ENTSO-E responses
+(see src.pipelines.entsoe_cache), which would answer them with the response that had the holes. Regions without any data that ENTSO-E returned nothing for
+are only tried again every EMPTY_REGION_RETRY_INTERVAL, as most ENTSO-E areas do not publish generation data.
+"""
+import datetime
+import logging
+import os
+import time
+from typing import Dict, List, Tuple
+
+import dotenv
+import pandas as pd
+import sqlalchemy
+
+from src.data.get_common_data import BasicDataCache, load_common_data_from_db
+from src.pipelines.concurrent_fetch import FETCH_WORKERS, entsoe_rate_limiter, retrieve_and_store_intervals
+from src.pipelines.entsoe_cache import READ_THROUGH, WRITE_THROUGH, CachingEntsoeClient, create_entsoe_client
+
+REFRESH_INTERVAL = pd.Timedelta(minutes=15)
+# entsoe-py splits queries at month boundaries, so chunks of up to a month are answered with one or two requests
+MAX_CHUNK = pd.Timedelta(days=31)
+# Regions without any data are backfilled from this long ago, unless ENTSOE_BACKFILL_START is set
+DEFAULT_BACKFILL = pd.Timedelta(days=7)
+# Holes are looked for in this much recent data, and generation types that reported nothing for this long are
+# considered not reported anymore, so that they do not hold the region's high-water mark back
+LOOKBACK = pd.Timedelta(days=7)
+# Recent values are revised by ENTSO-E after their first publication, so they are fetched again
+REFETCH_OVERLAP = pd.Timedelta(hours=1)
+# Holes that are still missing after being fetched are probably missing at ENTSO-E too. They are retried this late
+GAP_RETRY_INTERVAL = pd.Timedelta(hours=6)
+# Regions without any data that returned nothing are probably not published by ENTSO-E. They are retried this late
+EMPTY_REGION_RETRY_INTERVAL = pd.Timedelta(days=1)
+
+Interval = Tuple[datetime.datetime, datetime.datetime]
+
+
+def get_watermarks(sql_engine, since: datetime.datetime) -> pd.DataFrame:
+    """Return the last DateStamp with a value of each (RegionId, GenerationTypeId), as column Watermark.
+
+    Only the data stored since `since` (naive UTC) is scanned. The series of GenerationDataVersions without any value
+    since then are looked up one at a time, each with a backward scan of the (RegionId, GenerationTypeId, DateStamp)
+    index of the UX_ElectricityGeneration constraint
+    """
+    query = sqlalchemy.text('''
+        WITH "Recent" AS (
+            SELECT "RegionId", "GenerationTypeId", max("DateStamp") AS "Watermark"
+            FROM "ElectricityGeneration"
+            WHERE "DateStamp" >= :since AND "AggregatedGeneration" IS NOT NULL
+            GROUP BY "RegionId", "GenerationTypeId"
+        )
+        SELECT "RegionId", "GenerationTypeId", "Watermark" FROM "Recent"
+        UNION ALL
+        SELECT v."RegionId", v."GenerationTypeId", w."Watermark"
+        FROM "GenerationDataVersions" AS v
+        CROSS JOIN LATERAL (
+            SELECT max(g."DateStamp") AS "Watermark"
+            FROM "ElectricityGeneration" AS g
+            WHERE g."RegionId" = v."RegionId" AND g."GenerationTypeId" = v."GenerationTypeId" AND g."AggregatedGeneration" IS NOT NULL
+        ) AS w
+        WHERE w."Watermark" IS NOT NULL AND NOT EXISTS (
+            SELECT 1 FROM "Recent" AS r WHERE r."RegionId" = v."RegionId" AND r."GenerationTypeId" = v."GenerationTypeId")''')
+    with sql_engine.connect() as connection:
+        return pd.read_sql(query, connection, params={'since': since})
+
+
+def find_gaps(sql_engine, since: datetime.datetime) -> pd.DataFrame:
+    """Find the holes in the generation data stored since `since` (naive UTC).
+
+    The time step of each (RegionId, GenerationTypeId) is the smallest difference between two consecutive DateStamps,
+    and there is a hole wherever two consecutive values are further apart than that. NULL values are holes too.
+
+    @return: Dataframe with columns RegionId, GenerationTypeId, GapStart and GapEnd (naive UTC, GapEnd exclusive)
+    """
+    query = sqlalchemy.text('''
+        WITH "Steps" AS (
+            SELECT "RegionId", "GenerationTypeId", "DateStamp",
+                   lead("DateStamp") OVER (PARTITION BY "RegionId", "GenerationTypeId" ORDER BY "DateStamp") AS "Next"
+            FROM "ElectricityGeneration"
+            WHERE "DateStamp" >= :since AND "AggregatedGeneration" IS NOT NULL
+        ), "Resolutions" AS (
+            SELECT "RegionId", "GenerationTypeId", min("Next" - "DateStamp") AS "Step"
+            FROM "Steps"
+            GROUP BY "RegionId", "GenerationTypeId"
+        )
+        SELECT s."RegionId", s."GenerationTypeId", s."DateStamp" + r."Step" AS "GapStart", s."Next" AS "GapEnd"
+        FROM "Steps" AS s
+        JOIN "Resolutions" AS r ON r."RegionId" = s."RegionId" AND r."GenerationTypeId" = s."GenerationTypeId"
+        WHERE s."Next" - s."DateStamp" > r."Step"
+        ORDER BY s."RegionId", s."DateStamp"''')
+    with sql_engine.connect() as connection:
+        return pd.read_sql(query, connection, params={'since': since})
+
+
+def merge_intervals(intervals: List[Interval]) -> List[Interval]:
+    """Merge overlapping or touching [start, end) intervals, and drop empty ones"""
+    merged = []
+    for start, end in sorted(i for i in intervals if i[1] > i[0]):
+        if len(merged) > 0 and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def split_interval(start: datetime.datetime, end: datetime.datetime, max_span: pd.Timedelta = MAX_CHUNK) -> List[Interval]:
+    """Split [start, end) into consecutive intervals of at most `max_span`"""
+    chunks = []
+    while start < end:
+        chunk_end = min(end, (pd.Timestamp(start) + max_span).to_pydatetime())
+        chunks.append((start, chunk_end))
+        start = chunk_end
+    return chunks
+
+
+def select_regions(region_ids: List[int], watermarks_df: pd.DataFrame, empty_regions: Dict[int, datetime.datetime],
+                   now: datetime.datetime, retry_interval: pd.Timedelta = EMPTY_REGION_RETRY_INTERVAL) -> List[int]:
+    """Regions to fetch this cycle: the regions with data, and the regions without data that did not return nothing
+    less than `retry_interval` ago.
+
+    @param empty_regions: When each region without data last returned nothing. Regions that have data are removed
+    """
+    stored_region_ids = set(watermarks_df['RegionId'].astype(int))
+    for region_id in stored_region_ids & set(empty_regions):
+        del empty_regions[region_id]
+    return [region_id for region_id in region_ids
+            if region_id in stored_region_ids or empty_regions.get(region_id, datetime.datetime.min) <= now - retry_interval]
+
+
+def prune_gap_attempts(gap_attempts: Dict[Tuple, datetime.datetime], since: datetime.datetime):
+    """Forget the holes that end before `since`, which find_gaps does not look at anymore"""
+    for key in [key for key in gap_attempts if key[2] <= since]:
+        del gap_attempts[key]
+
+
+def plan_fetches(region_ids: List[int], watermarks_df: pd.DataFrame, gaps_df: pd.DataFrame, now: datetime.datetime,
+                 backfill_start: datetime.datetime, overlap: pd.Timedelta = REFETCH_OVERLAP,
+                 lookback: pd.Timedelta = LOOKBACK, max_chunk: pd.Timedelta = MAX_CHUNK) -> Dict[int, List[Interval]]:
+    """Decide which intervals of each region to fetch. All the datetimes are naive UTC.
+
+    @param region_ids: Internal ids of the regions to keep up to date
+    @param watermarks_df: See get_watermarks
+    @param gaps_df: See find_gaps
+    @param now: End of the intervals to fetch (exclusive)
+    @param backfill_start: Start of the data of regions without any data yet
+    @param overlap: How much data before the high-water mark is fetched again
+    @param lookback: Generation types whose high-water mark is this much older than the region's are ignored
+    @param max_chunk: Maximum length of an interval
+    @return: Intervals to fetch by region id
+    """
+    plan = {}
+    for region_id in region_ids:
+        watermarks = watermarks_df.loc[watermarks_df['RegionId'] == region_id, 'Watermark']
+        if len(watermarks) == 0:
+            intervals = [(backfill_start, now)]
+        else:
+            reporting = watermarks[watermarks >= watermarks.max() - lookback]
+            intervals = [((reporting.min() - overlap).to_pydatetime(), now)]
+        region_gaps = gaps_df[gaps_df['RegionId'] == region_id]
+        intervals += [(pd.Timestamp(s).to_pydatetime(), pd.Timestamp(e).to_pydatetime())
+                      for s, e in zip(region_gaps['GapStart'], region_gaps['GapEnd'])]
+        chunks = [chunk for start, end in merge_intervals(intervals) for chunk in split_interval(start, end, max_chunk)]
+        if len(chunks) > 0:
+            plan[region_id] = chunks
+    return plan
+
+
+def overlaps_gaps(region_id: int, start: datetime.datetime, end: datetime.datetime, gaps_df: pd.DataFrame) -> bool:
+    """Whether [start, end) overlaps one of the holes of the region in gaps_df (see find_gaps)"""
+    region_gaps = gaps_df[gaps_df['RegionId'] == region_id]
+    return bool(((region_gaps['GapStart'] < end) & (region_gaps['GapEnd'] > start)).any())
+
+
+def bypass_cache(entsoe_client):
+    """The client to fetch holes again with: a read_through CachingEntsoeClient would answer them from the cached
+    response that had the holes, so it is replaced by a write_through one. Other clients are returned as is"""
+    if isinstance(entsoe_client, CachingEntsoeClient) and entsoe_client.mode == READ_THROUGH:
+        return entsoe_client.with_mode(WRITE_THROUGH)
+    return entsoe_client
+
+
+def run_ingestion_cycle(entsoe_client, sql_engine, cache: BasicDataCache, backfill_start: datetime.datetime,
+                        gap_attempts: Dict[Tuple, datetime.datetime], empty_regions: Dict[int, datetime.datetime],
+                        now: datetime.datetime = None, **kwargs) -> Dict[Tuple, int | None]:
+    """Fetch and store the new and missing data of all the regions.
+
+    @param entsoe_client: EntsoePandasClient
+    @param sql_engine: SQL engine to the elec_lca database
+    @param cache: BasicDataCache
+    @param backfill_start: Start of the data of regions without any data yet (naive UTC)
+    @param gap_attempts: When each hole was last fetched, by (RegionId, GapStart, GapEnd). Updated by this function
+    @param empty_regions: When each region without data last returned nothing, by RegionId. Updated by this function
+    @param now: End of the data to fetch (naive UTC). Defaults to the current time
+    @param kwargs: Passed to retrieve_and_store_intervals
+    @return: Number of rows written per (region code, start, end) fetched
+    """
+    if now is None:
+        now = pd.Timestamp.now(tz='UTC').tz_localize(None).floor(REFRESH_INTERVAL).to_pydatetime()
+    watermarks_df = get_watermarks(sql_engine, now - LOOKBACK)
+    gaps_df = find_gaps(sql_engine, now - LOOKBACK)
+    prune_gap_attempts(gap_attempts, now - LOOKBACK)
+
+    # Leave out the holes that were fetched recently and are still there
+    gap_keys = [(int(r), pd.Timestamp(s).to_pydatetime(), pd.Timestamp(e).to_pydatetime())
+                for r, s, e in zip(gaps_df['RegionId'], gaps_df['GapStart'], gaps_df['GapEnd'])]
+    to_fill = [gap_attempts.get(key, datetime.datetime.min) <= now - GAP_RETRY_INTERVAL for key in gap_keys]
+    gaps_df = gaps_df.loc[to_fill]
+    for key, fill in zip(gap_keys, to_fill):
+        if fill:
+            gap_attempts[key] = now
+    logging.info(f'{len(gaps_df)} holes to fill')
+
+    region_ids = select_regions(list(cache.region_id_by_code.values()), watermarks_df, empty_regions, now)
+    logging.info(f'{len(region_ids)} of {len(cache.region_id_by_code)} regions to fetch')
+    plan = plan_fetches(region_ids, watermarks_df, gaps_df, now, backfill_start)
+    intervals, gap_intervals = [], []
+    for region_id, chunks in plan.items():
+        for start, end in chunks:
+            interval = (cache.region_code_by_id[region_id], pd.Timestamp(start, tz='UTC'), pd.Timestamp(end, tz='UTC'))
+            (gap_intervals if overlaps_gaps(region_id, start, end, gaps_df) else intervals).append(interval)
+    s = time.time()
+    rows_written = retrieve_and_store_intervals(entsoe_client, sql_engine, intervals, cache, **kwargs)
+    if len(gap_intervals) > 0:
+        rows_written.update(retrieve_and_store_intervals(bypass_cache(entsoe_client), sql_engine, gap_intervals, cache, **kwargs))
+    intervals += gap_intervals
+    logging.info(f'{time.time() - s:.2f} s to retrieve and store {len(intervals)} intervals '
+                 f'({sum(count_rows or 0 for count_rows in rows_written.values())} rows)')
+
+    # Back off the regions without data that returned nothing
+    rows_by_region = {}
+    for (region_code, _, _), count_rows in rows_written.items():
+        rows_by_region[region_code] = rows_by_region.get(region_code, 0) + (count_rows or 0)
+    stored_region_ids = set(watermarks_df['RegionId'].astype(int))
+    for region_id in plan:
+        if region_id not in stored_region_ids and rows_by_region.get(cache.region_code_by_id[region_id], 0) == 0:
+            empty_regions[region_id] = now
+    return rows_written
+
+
+def run_forever(entsoe_client, sql_engine, cache: BasicDataCache, backfill_start: datetime.datetime,
+                refresh_interval: pd.Timedelta = REFRESH_INTERVAL, **kwargs):
+    """Run an ingestion cycle every `refresh_interval`"""
+    gap_attempts = {}
+    empty_regions = {}
+    rate_limiter = entsoe_rate_limiter()
+    while True:
+        s = time.time()
+        try:
+            run_ingestion_cycle(entsoe_client, sql_engine, cache, backfill_start, gap_attempts, empty_regions,
+                                rate_limiter=rate_limiter, **kwargs)
+        except Exception:
+            logging.exception('Ingestion cycle failed')
+        time.sleep(max(0.0, refresh_interval.total_seconds() - (time.time() - s)))
+
+
+def main():
+    dotenv.load_dotenv()
+    ENTOSE_SECURITY_TOKEN = os.environ.get('ENTSOE_SECURITY_TOKEN')
+    FETCH_WORKER_COUNT = int(os.environ.get('ENTSOE_FETCH_WORKERS', FETCH_WORKERS))
+    BACKFILL_START = os.environ.get('ENTSOE_BACKFILL_START')
+    HOST = os.getenv('ELEC_LCA_HOST')
+    DB_NAME = os.getenv('ELEC_LCA_DB_NAME')
+    USER = os.getenv('ELEC_LCA_USER')
+    PASSWORD = os.getenv('ELEC_LCA_PASSWORD')
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(message)s')
+
+    if BACKFILL_START is not None:
+        backfill_start = pd.Timestamp(BACKFILL_START, tz='Europe/Brussels').tz_convert('UTC').tz_localize(None).to_pydatetime()
+    else:
+        backfill_start = (pd.Timestamp.now(tz='UTC').tz_localize(None).floor('D') - DEFAULT_BACKFILL).to_pydatetime()
+
+    # Connect to postgres database
+    sql_engine = sqlalchemy.create_engine(sqlalchemy.engine.url.URL.create(
+        drivername='postgresql',
+        host=HOST,
+        database=DB_NAME,
+        username=USER,
+        password=PASSWORD
+    ))
+    cache = load_common_data_from_db(sql_engine)
+    client = create_entsoe_client(ENTOSE_SECURITY_TOKEN)
+    run_forever(client, sql_engine, cache, backfill_start, workers=FETCH_WORKER_COUNT)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+Retrieval of the ENTSO-E "Cross-Border Physical Flows" between the regions of the Regions table, for flow tracing
+(see src.pipelines.trace_crossborder_flows).
+
+Both directions of each border between two known regions are fetched, by a pool of worker threads sharing the ENTSO-E
+rate limit like the generation pipelines. Fetched flows are written by the calling thread as they arrive.
+"""
+import argparse
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Tuple
+
+import dotenv
+import pandas as pd
+import sqlalchemy
+from entsoe.mappings import NEIGHBOURS
+
+from src.data.get_common_data import BasicDataCache, load_common_data_from_db
+from src.data.store_crossborder_flows import entsoe_flows_to_long_df, store_crossborder_flow_frame_to_db
+from src.pipelines.concurrent_fetch import BACKOFF_SECONDS, FETCH_WORKERS, MAX_RETRIES, TokenBucket, entsoe_rate_limiter, \
+    fetch_with_retries
+from src.pipelines.entsoe_cache import create_entsoe_client
+
+Border = Tuple[str, str]  # (ENTSO-E code of the region the flow leaves, ENTSO-E code of the region it enters)
+
+
+def crossborder_pairs(cache: BasicDataCache) -> List[Border]:
+    """Both directions of the borders between regions of the Regions table"""
+    return [(region_code, neighbour_code)
+            for region_code, neighbour_codes in NEIGHBOURS.items() if region_code in cache.region_id_by_code
+            for neighbour_code in neighbour_codes if neighbour_code in cache.region_id_by_code]
+
+
+def retrieve_and_store_crossborder_flows(
+        entsoe_client,
+        sql_engine,
+        start: pd.Timestamp,
+        end: pd.Timestamp,
+        cache: BasicDataCache,
+        borders: List[Border] = None,
+        workers: int = FETCH_WORKERS,
+        rate_limiter: TokenBucket = None,
+        max_retries: int = MAX_RETRIES,
+        backoff_seconds: float = BACKOFF_SECONDS) -> Dict[Border, int | None]:
+    """Retrieve the physical flows over borders between two timestamps concurrently, and store them to the database.
+    Each border direction is written in its own transaction.
+
+    @param entsoe_client: EntsoePandasClient, or CachingEntsoeClient. It is shared by the workers
+    @param sql_engine: SQL engine to the elec_lca database
+    @param cache: BasicDataCache
+    @param borders: Border directions to fetch. Defaults to all the borders between regions of the Regions table
+    @param workers: Number of concurrent fetches
+    @param rate_limiter: Token bucket limiting the requests. Defaults to the ENTSO-E quota
+    @return: Number of rows written per border direction, None for the ones that could not be fetched or stored
+    """
+    borders = crossborder_pairs(cache) if borders is None else borders
+    for border in borders:
+        for region_code in border:
+            if region_code not in cache.region_id_by_code:
+                raise ValueError(f'Could not find region {region_code} in the Regions table. Please run fill_regions()')
+    if rate_limiter is None:
+        rate_limiter = entsoe_rate_limiter()
+
+    def fetch(border: Border):
+        s = time.time()
+        flows = fetch_with_retries(lambda: entsoe_client.query_crossborder_flows(border[0], border[1], start=start, end=end),
+                                   f'{border[0]} -> {border[1]}', rate_limiter, max_retries, backoff_seconds)
+        logging.info(f'Retrieved flows {border[0]} -> {border[1]} from `{start}` to `{end}` in {time.time() - s:.3f} s')
+        return flows
+
+    rows_written = {}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='entsoe-fetch') as pool:
+        futures = {pool.submit(fetch, border): border for border in borders}
+        for future in as_completed(futures):
+            border = futures[future]
+            try:
+                flows = future.result()
+                if flows is None:
+                    rows_written[border] = None
+                    continue
+                long_df = entsoe_flows_to_long_df(flows, cache.region_id_by_code[border[0]], cache.region_id_by_code[border[1]])
+                rows_written[border] = store_crossborder_flow_frame_to_db(long_df, sql_engine)
+            except Exception:
+                logging.exception(f'Failed to retrieve or store flows {border[0]} -> {border[1]}')
+                rows_written[border] = None
+    return rows_written
+
+
+def main():
+    dotenv.load_dotenv()
+    parser = argparse.ArgumentParser(description='Retrieve the cross-border physical flows between the regions from ENTSO-E')
+    parser.add_argument('start', help='Start date, in Europe/Brussels time')
+    parser.add_argument('end', help='End date, in Europe/Brussels time')
+    args = parser.parse_args()
+
+    ENTOSE_SECURITY_TOKEN = os.environ.get('ENTSOE_SECURITY_TOKEN')
+    FETCH_WORKER_COUNT = int(os.environ.get('ENTSOE_FETCH_WORKERS', FETCH_WORKERS))
+    HOST = os.getenv('ELEC_LCA_HOST')
+    DB_NAME = os.getenv('ELEC_LCA_DB_NAME')
+    USER = os.getenv('ELEC_LCA_USER')
+    PASSWORD = os.getenv('ELEC_LCA_PASSWORD')
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(message)s')
+
+    sql_engine = sqlalchemy.create_engine(sqlalchemy.engine.url.URL.create(
+        drivername='postgresql',
+        host=HOST,
+        database=DB_NAME,
+        username=USER,
+        password=PASSWORD
+    ))
+    cache = load_common_data_from_db(sql_engine)
+    client = create_entsoe_client(ENTOSE_SECURITY_TOKEN)
+    rows_written = retrieve_and_store_crossborder_flows(client, sql_engine, pd.Timestamp(args.start, tz='Europe/Brussels'),
+                                                        pd.Timestamp(args.end, tz='Europe/Brussels'), cache, workers=FETCH_WORKER_COUNT)
+    failed = [border for border, count_rows in rows_written.items() if count_rows is None]
+    logging.info(f'Flows of {len(rows_written) - len(failed)} border directions stored, {len(failed)} failed or without data')
+
+
+if __name__ == '__main__':
+    main()
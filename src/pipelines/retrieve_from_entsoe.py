@@ -13,8 +13,10 @@ from dotenv import load_dotenv
 from entsoe import EntsoePandasClient
 from entsoe.exceptions import NoMatchingDataError
 
-from src.data.get_common_data import BasicDataCache, load_common_data_from_db
-from src.data.store_generation_data import store_generation_data_to_db
+from src.data.get_common_data import BasicDataCache, ENTSOE_DATA_SOURCE_NAME, load_common_data_from_db
+from src.data.store_generation_data import entsoe_generation_to_long_df, store_generation_frame_to_db
+from src.pipelines.concurrent_fetch import FETCH_WORKERS, retrieve_and_store_regions
+from src.pipelines.entsoe_cache import create_entsoe_client
 
 
 # Logging
@@ -48,7 +50,10 @@ def get_and_store_generation_for_region(
         of the list should be a tuple, like ('Fossil Hard coal', 'Actual Aggregated')
     @return: bool. True if stores to database successfully. False otherwise
     """
-    generation_type_to_id_mapping = cache.generation_type_mappings['ExternalName'].reset_index().set_index('ExternalName')['index'].to_dict()
+    if region_code not in cache.region_id_by_code:
+        raise ValueError(f'Could not find region {region_code} in the Regions table. Please run fill_regions()')
+    region_id = cache.region_id_by_code[region_code]
+
     logging.info(f'Retrieving data for {region_code} for Date range FROM `{start}` TO `{end}` ...')
     s_0 = time.time()
     try:
@@ -62,37 +67,16 @@ def get_and_store_generation_for_region(
     e = time.time()
     logging.info(f'Retrieved in {e - s_0:.3f} s')
 
-    generation_types_added = set()
-    for generation_type_retrieved in generation.keys():
-        generation_type_retrieved = generation_type_retrieved[0]
-        if (generation_type_filter is not None) and (generation_type_retrieved not in generation_type_filter):
-            logging.debug(
-                f'Skipping generation type `{generation_type_retrieved}` as not in the generation type filter')
-            continue
-
-        # Map generation types to generationtypeid
-        if generation_type_retrieved not in generation_type_to_id_mapping:
-            logging.warning(f'No mapping for entsoepy generation type `{generation_type_retrieved}` to an internal generation type id. Will skip this generation type')
-            continue
-        generation_type_id = generation_type_to_id_mapping[generation_type_retrieved]
-
-        # Map region to regionid
-        region_index = (cache.regions['Code'] == region_code)
-        if not region_index.any():
-            raise ValueError(f'Could not find region {region_code} in the Regions table. Please run fill_regions()')
-        region_id = cache.regions.loc[region_index, 'Id'].iloc[0]
-
-        # Generation amounts in MW
-        generation_data_to_add = generation[generation_type_retrieved]
-
-        store_successful = store_generation_data_to_db(generation_data_to_add,
-                                                       generation_type_id,
-                                                       region_id,
-                                                       sql_engine)
-        if store_successful:
-            generation_types_added.add(generation_type_retrieved)
+    # All the generation types of the region are written in one transaction
+    generation_to_add = entsoe_generation_to_long_df(generation, region_id, cache, generation_type_filter)
+    store_generation_frame_to_db(generation_to_add, sql_engine)
+
     if generation_type_filter is not None:
-        generation_types_in_filter_not_stored = set(generation_type_filter).difference(generation_types_added)
+        generation_types_retrieved = set(generation.columns.get_level_values(0))
+        generation_types_in_filter_not_stored = {
+            f for f in generation_type_filter
+            if f[0] not in generation_types_retrieved
+            or (ENTSOE_DATA_SOURCE_NAME, f[0]) not in cache.generation_type_id_by_external_name}
         if len(generation_types_in_filter_not_stored) > 0:
             logging.warning(
                 f'Electricity data in region `{region_code}` was not stored for following generation types: {pprint.pformat(generation_types_in_filter_not_stored)}')
@@ -102,6 +86,7 @@ def get_and_store_generation_for_region(
 def main():
     dotenv.load_dotenv()
     ENTOSE_SECURITY_TOKEN = os.environ.get('ENTSOE_SECURITY_TOKEN')
+    FETCH_WORKER_COUNT = int(os.environ.get('ENTSOE_FETCH_WORKERS', FETCH_WORKERS))
 
     start = pd.Timestamp('20231202', tz='Europe/Brussels')
     end = pd.Timestamp('20231203', tz='Europe/Brussels')
@@ -127,12 +112,16 @@ def main():
 
     regions = cache.regions
 
-    client = EntsoePandasClient(api_key=ENTOSE_SECURITY_TOKEN)
+    client = create_entsoe_client(ENTOSE_SECURITY_TOKEN)
 
     s = time.time()
-    for _, region_code in regions['Code'].items():
-        get_and_store_generation_for_region(entsoe_client=client, sql_engine=sql_engine, region_code=region_code,start=start,end=end,cache=cache,generation_type_filter=generation_type_filter)
+    rows_written = retrieve_and_store_regions(entsoe_client=client, sql_engine=sql_engine, region_codes=regions['Code'].to_list(),
+                                              start=start, end=end, cache=cache, generation_type_filter=generation_type_filter,
+                                              workers=FETCH_WORKER_COUNT)
     e = time.time()
+    regions_failed = [region_code for region_code, count_rows in rows_written.items() if count_rows is None]
+    if len(regions_failed) > 0:
+        logging.warning(f'Electricity data was not stored for regions {regions_failed}')
     logging.info(f'{e - s:.2f} s to retrieve and store data for {len(regions)} regions')
 
 
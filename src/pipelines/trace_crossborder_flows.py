@@ -0,0 +1,157 @@
+"""
+Consumption based intensity of the electricity of each region, by flow tracing of the cross-border flows (see
+src.microservice.flow_tracing), stored to the ConsumptionIntensities table.
+
+The generation of all the regions and the flows between them are read a chunk of time at a time and put on a regular
+grid of `step_minutes` steps (15 minutes by default), average powers of hourly data covering the four quarters of their
+hour. The impact of the generation of each region comes from the environmental impact factors, and the systems of all
+the steps of a chunk are solved in batches in a process pool. Run it after the generation and the flows are ingested.
+"""
+import argparse
+import datetime
+import logging
+import os
+import time
+from typing import List
+
+import dotenv
+import numpy as np
+import pandas as pd
+import sqlalchemy as sqla
+
+from src.data.get_common_data import BasicDataCache, load_common_data_from_db
+from src.data.rollups import to_naive_utc
+from src.microservice.flow_tracing import TRACING_BATCH_SIZE, spread_to_grid, trace_flows
+from src.microservice.impact_engine import impact_category_metadata
+from src.orm.base import ConsumptionIntensities
+from src.orm.bulk import copy_df_to_table
+
+STEP_MINUTES = 15
+CHUNK = pd.Timedelta(days=31)  # Time solved at a time. A chunk of 15 minute steps of 60 regions and 7 categories is about 100 MB
+MAX_RESOLUTION = pd.Timedelta(minutes=60)  # Rows starting this long before a chunk may cover its first steps
+INTENSITY_COLUMNS = ['RegionId', 'ImpactCategoryId', 'DateStamp', 'Intensity']
+
+
+def read_tracing_inputs(connection, start: datetime.datetime, end: datetime.datetime):
+    """Generation of all the regions, and flows over all the borders, whose intervals can overlap [start, end) (naive UTC)
+
+    @return: Tuple of (generation dataframe, flows dataframe)
+    """
+    params = {'start': start - MAX_RESOLUTION.to_pytimedelta(), 'end': end}
+    generation_df = pd.read_sql(sqla.text('''
+        SELECT "RegionId", "GenerationTypeId", "DateStamp", "AggregatedGeneration", "ResolutionMinutes" FROM "ElectricityGeneration"
+        WHERE "DateStamp" >= :start AND "DateStamp" < :end AND "AggregatedGeneration" IS NOT NULL'''), connection, params=params)
+    flows_df = pd.read_sql(sqla.text('''
+        SELECT "FromRegionId", "ToRegionId", "DateStamp", "Flow", "ResolutionMinutes" FROM "CrossBorderFlows"
+        WHERE "DateStamp" >= :start AND "DateStamp" < :end AND "Flow" IS NOT NULL'''), connection, params=params)
+    return generation_df, flows_df
+
+
+def trace_consumption_intensities(generation_df: pd.DataFrame, flows_df: pd.DataFrame, cache: BasicDataCache,
+                                  start: datetime.datetime, end: datetime.datetime, step_minutes: int = STEP_MINUTES,
+                                  batch_size: int = TRACING_BATCH_SIZE, workers: int = None) -> pd.DataFrame:
+    """Consumption based intensity of each region and impact category at each step of [start, end) (naive UTC).
+
+    @param generation_df: Rows of ElectricityGeneration (RegionId, GenerationTypeId, DateStamp, AggregatedGeneration, ResolutionMinutes)
+    @param flows_df: Rows of CrossBorderFlows (FromRegionId, ToRegionId, DateStamp, Flow, ResolutionMinutes)
+    @param cache: BasicDataCache, for the environmental impact factors
+    @param step_minutes: Length of the steps of the grid
+    @param batch_size: Steps solved at a time, see trace_flows
+    @param workers: Processes solving the batches, see trace_flows
+    @return: Dataframe with the columns of INTENSITY_COLUMNS, with an intensity in ImpactCategoryUnit per PerUnit of
+        the consumption. Regions without generation or imports at a step have no row
+    """
+    factors = cache.impact_factors
+    periods = int((pd.Timestamp(end) - pd.Timestamp(start)) / pd.Timedelta(minutes=step_minutes))
+    region_ids = np.union1d(generation_df['RegionId'].unique(), np.union1d(flows_df['FromRegionId'].unique(), flows_df['ToRegionId'].unique()))
+    region_positions = np.searchsorted(region_ids, generation_df['RegionId'].to_numpy(dtype=int))
+    borders_df = flows_df[['FromRegionId', 'ToRegionId']].drop_duplicates(ignore_index=True)
+    flows_df = flows_df.merge(borders_df.reset_index(), on=['FromRegionId', 'ToRegionId'])
+    borders = np.searchsorted(region_ids, borders_df.to_numpy(dtype=int))
+
+    # Average powers (MW) and impacts per hour of the generation, on the grid
+    power = generation_df['AggregatedGeneration'].to_numpy(dtype=float)
+    impacts_per_hour = power[:, np.newaxis] * factors.for_generation_types(generation_df['GenerationTypeId'])
+    grid = dict(start=np.datetime64(start), periods=periods, step_minutes=step_minutes)
+    generation = spread_to_grid(generation_df['DateStamp'].to_numpy(), generation_df['ResolutionMinutes'].to_numpy(dtype=float),
+                                region_positions, power, n_columns=len(region_ids), **grid)
+    impacts = spread_to_grid(generation_df['DateStamp'].to_numpy(), generation_df['ResolutionMinutes'].to_numpy(dtype=float),
+                             region_positions, impacts_per_hour, n_columns=len(region_ids), **grid)
+    flows = spread_to_grid(flows_df['DateStamp'].to_numpy(), flows_df['ResolutionMinutes'].to_numpy(dtype=float),
+                           flows_df['index'].to_numpy(), flows_df['Flow'].to_numpy(dtype=float), n_columns=len(borders_df), **grid)
+
+    # Impact per MWh of the generation unit, converted to PerUnit like the factors
+    intensities = trace_flows(generation, flows, borders, impacts, batch_size=batch_size, workers=workers)
+    intensities /= impact_category_metadata(factors, factors.impact_category_ids)['ConversionFactor'].to_numpy(dtype=float)
+
+    steps, positions, categories = np.nonzero(np.isfinite(intensities))
+    return pd.DataFrame({'RegionId': region_ids[positions],
+                         'ImpactCategoryId': factors.impact_category_ids[categories],
+                         'DateStamp': pd.Timestamp(start) + pd.to_timedelta(steps * step_minutes, unit='m'),
+                         'Intensity': intensities[steps, positions, categories]})[INTENSITY_COLUMNS]
+
+
+def store_consumption_intensity_frame_to_db(intensity_df: pd.DataFrame, sql_engine, start: datetime.datetime, end: datetime.datetime) -> int:
+    """Replace the consumption based intensities in [start, end) (naive UTC) in one transaction. Returns the number of rows written"""
+    with sql_engine.begin() as connection:
+        connection.execute(sqla.delete(ConsumptionIntensities).where(ConsumptionIntensities.DateStamp >= start)
+                           .where(ConsumptionIntensities.DateStamp < end))
+        cursor = connection.connection.cursor()
+        return copy_df_to_table(cursor, intensity_df, ConsumptionIntensities.__tablename__, INTENSITY_COLUMNS)
+
+
+def chunks(start: datetime.datetime, end: datetime.datetime, chunk: pd.Timedelta = CHUNK) -> List[tuple]:
+    bounds = list(pd.date_range(start, end, freq=chunk).to_pydatetime())
+    if bounds[-1] < end:
+        bounds.append(end)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def trace_and_store(sql_engine, cache: BasicDataCache, start, end, step_minutes: int = STEP_MINUTES, workers: int = None) -> int:
+    """Compute and store the consumption based intensities of [start, end) (tz-aware, or naive UTC), a chunk at a time.
+    Returns the number of rows written"""
+    count_rows = 0
+    for chunk_start, chunk_end in chunks(to_naive_utc(start), to_naive_utc(end)):
+        s = time.time()
+        with sql_engine.connect() as connection:
+            generation_df, flows_df = read_tracing_inputs(connection, chunk_start, chunk_end)
+        read_seconds = time.time() - s
+        intensity_df = trace_consumption_intensities(generation_df, flows_df, cache, chunk_start, chunk_end, step_minutes=step_minutes,
+                                                     workers=workers)
+        solve_seconds = time.time() - s - read_seconds
+        count_rows += store_consumption_intensity_frame_to_db(intensity_df, sql_engine, chunk_start, chunk_end)
+        logging.info(f'{len(intensity_df)} intensities from `{chunk_start}` to `{chunk_end}`: read in {read_seconds:.1f} s, '
+                     f'traced in {solve_seconds:.1f} s, written in {time.time() - s - read_seconds - solve_seconds:.1f} s')
+    return count_rows
+
+
+def main():
+    dotenv.load_dotenv()
+    parser = argparse.ArgumentParser(description='Compute the consumption based intensity of the regions by tracing the cross-border flows')
+    parser.add_argument('start', help='Start date, in Europe/Brussels time')
+    parser.add_argument('end', help='End date, in Europe/Brussels time')
+    parser.add_argument('--step-minutes', type=int, default=STEP_MINUTES)
+    parser.add_argument('--workers', type=int, default=None, help='Processes solving the flow tracing. Defaults to the number of cores')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(message)s')
+
+    HOST = os.getenv('ELEC_LCA_HOST')
+    DB_NAME = os.getenv('ELEC_LCA_DB_NAME')
+    USER = os.getenv('ELEC_LCA_USER')
+    PASSWORD = os.getenv('ELEC_LCA_PASSWORD')
+
+    sql_engine = sqla.create_engine(sqla.engine.url.URL.create(
+        drivername='postgresql',
+        host=HOST,
+        database=DB_NAME,
+        username=USER,
+        password=PASSWORD
+    ))
+    cache = load_common_data_from_db(sql_engine)
+    trace_and_store(sql_engine, cache, pd.Timestamp(args.start, tz='Europe/Brussels'), pd.Timestamp(args.end, tz='Europe/Brussels'),
+                    step_minutes=args.step_minutes, workers=args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Add the ResolutionMinutes and Energy columns to an existing database and fill them for the data stored before they
+existed, then recompute the rollups (which sum Energy). New data gets both columns when it is stored.
+
+The resolution of each row is inferred from its series like at ingest (see infer_resolution_minutes): the shorter of
+the steps to the previous and to the next DateStamp of the same region and generation type, or for the first and last
+rows of a series the resolution of the row next to them. Each region is updated in its own transaction.
+"""
+import logging
+import os
+
+import sqlalchemy as sqla
+from dotenv import load_dotenv
+
+from src.data.rollups import ROLLUPS, rebuild_rollups
+from src.orm.base import ElectricityGeneration
+from src.orm.bulk import quote_identifier
+
+
+def add_energy_columns(connection):
+    """Add the columns to ElectricityGeneration (and its partitions) and to the rollups, if they do not exist"""
+    table = quote_identifier(ElectricityGeneration.__tablename__)
+    connection.execute(sqla.text(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS "ResolutionMinutes" integer'))
+    connection.execute(sqla.text(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS "Energy" double precision'))
+    for rollup in ROLLUPS.values():
+        connection.execute(sqla.text(f'ALTER TABLE {quote_identifier(rollup.__tablename__)} ADD COLUMN IF NOT EXISTS "Energy" double precision'))
+
+
+def backfill_region(connection, region_id: int) -> int:
+    """Fill ResolutionMinutes and Energy of the rows of a region that have no resolution yet. Returns the number of
+    rows updated"""
+    result = connection.execute(sqla.text('''
+        WITH "Neighbours" AS (
+            SELECT "Id", "DateStamp", "GenerationTypeId",
+                   "DateStamp" - lag("DateStamp") OVER w AS "Backward",
+                   lead("DateStamp") OVER w - "DateStamp" AS "Forward"
+            FROM "ElectricityGeneration"
+            WHERE "RegionId" = :region_id
+            WINDOW w AS (PARTITION BY "GenerationTypeId" ORDER BY "DateStamp")
+        ), "Steps" AS (
+            SELECT "Id", "DateStamp", "GenerationTypeId", "Backward", "Forward", least("Backward", "Forward") AS "Step"
+            FROM "Neighbours"
+        ), "Resolutions" AS (
+            SELECT "Id", "DateStamp",
+                   round(extract(epoch FROM CASE WHEN "Backward" IS NULL THEN lead("Step") OVER w
+                                                 WHEN "Forward" IS NULL THEN lag("Step") OVER w
+                                                 ELSE "Step" END) / 60) AS "ResolutionMinutes"
+            FROM "Steps"
+            WINDOW w AS (PARTITION BY "GenerationTypeId" ORDER BY "DateStamp")
+        )
+        UPDATE "ElectricityGeneration" AS g
+        SET "ResolutionMinutes" = r."ResolutionMinutes",
+            "Energy" = g."AggregatedGeneration" * r."ResolutionMinutes" / 60.0
+        FROM "Resolutions" AS r
+        WHERE g."RegionId" = :region_id AND g."Id" = r."Id" AND g."DateStamp" = r."DateStamp"
+          AND g."ResolutionMinutes" IS NULL AND r."ResolutionMinutes" IS NOT NULL'''), {'region_id': region_id})
+    return result.rowcount
+
+
+def backfill_energy(sql_engine):
+    with sql_engine.begin() as connection:
+        add_energy_columns(connection)
+        region_ids = connection.execute(sqla.text('SELECT DISTINCT "RegionId" FROM "ElectricityGeneration"')).scalars().all()
+    for region_id in region_ids:
+        with sql_engine.begin() as connection:
+            logging.info(f'{backfill_region(connection, region_id)} rows of region {region_id} updated')
+    with sql_engine.begin() as connection:
+        rebuild_rollups(connection)
+
+
+def main():
+    load_dotenv()
+    HOST = os.getenv('ELEC_LCA_HOST')
+    DB_NAME = os.getenv('ELEC_LCA_DB_NAME')
+    USER = os.getenv('ELEC_LCA_USER')
+    PASSWORD = os.getenv('ELEC_LCA_PASSWORD')
+
+    engine = sqla.create_engine(sqla.engine.url.URL.create(
+        drivername='postgresql',
+        host=HOST,
+        database=DB_NAME,
+        username=USER,
+        password=PASSWORD
+    ))
+    backfill_energy(engine)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,34 @@
+"""
+Compute the hourly, daily and monthly rollups of ElectricityGeneration from scratch, e.g. for data stored before the
+rollup tables existed. New data updates the rollups incrementally when it is stored.
+"""
+import logging
+import os
+
+import sqlalchemy as sqla
+from dotenv import load_dotenv
+
+from src.data.rollups import rebuild_rollups
+
+
+def main():
+    load_dotenv()
+    HOST = os.getenv('ELEC_LCA_HOST')
+    DB_NAME = os.getenv('ELEC_LCA_DB_NAME')
+    USER = os.getenv('ELEC_LCA_USER')
+    PASSWORD = os.getenv('ELEC_LCA_PASSWORD')
+
+    engine = sqla.create_engine(sqla.engine.url.URL.create(
+        drivername='postgresql',
+        host=HOST,
+        database=DB_NAME,
+        username=USER,
+        password=PASSWORD
+    ))
+    with engine.begin() as connection:
+        rebuild_rollups(connection)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
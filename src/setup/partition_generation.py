@@ -0,0 +1,96 @@
+"""
+Convert an existing, unpartitioned ElectricityGeneration table to the monthly partitioned one of src.orm.base.
+
+The old table is renamed, the partitioned table is created with a partition for every month of the data, the rows are
+copied (keeping their Id) and the old table is dropped, all in one transaction. New databases created with
+create_database are partitioned from the start.
+"""
+import logging
+import os
+
+import pandas as pd
+import sqlalchemy as sqla
+from dotenv import load_dotenv
+
+from src.data.partitions import TABLE_NAME, create_partition, is_partitioned, month_starts
+from src.orm.base import ElectricityGeneration
+from src.orm.bulk import quote_identifier
+
+OLD_TABLE_NAME = f'{TABLE_NAME}_unpartitioned'
+
+
+def migrate_to_partitioned(connection, keep_old_table: bool = False, drop_null_dates: bool = False):
+    """Move the rows of an unpartitioned ElectricityGeneration table to a partitioned one. Runs in the transaction of
+    `connection`. Does nothing if the table is partitioned already
+
+    Rows without a DateStamp cannot be placed in a partition. The migration is aborted if there are any, unless
+    drop_null_dates is set.
+
+    @param keep_old_table: Keep the old table, renamed to ElectricityGeneration_unpartitioned, instead of dropping it
+    @param drop_null_dates: Leave the rows without a DateStamp behind (and log their number) instead of aborting
+    """
+    if is_partitioned(connection):
+        logging.info(f'{TABLE_NAME} is partitioned already')
+        return
+    table, old_table = quote_identifier(TABLE_NAME), quote_identifier(OLD_TABLE_NAME)
+    null_dates = connection.execute(sqla.text(f'SELECT count(*) FROM {table} WHERE "DateStamp" IS NULL')).scalar()
+    if null_dates > 0:
+        if not drop_null_dates:
+            raise ValueError(f'{null_dates} rows of {TABLE_NAME} have no DateStamp and cannot be partitioned. '
+                             f'Fix or delete them, or migrate with drop_null_dates=True')
+        logging.warning(f'{null_dates} rows of {TABLE_NAME} have no DateStamp and are not copied to the partitioned table'
+                        + (f', they are kept in {OLD_TABLE_NAME}' if keep_old_table else ''))
+    connection.execute(sqla.text(f'ALTER TABLE {table} RENAME TO {old_table}'))
+    # Constraint and index names are unique per schema, so the old ones are renamed out of the way
+    for name in connection.execute(sqla.text('''
+            SELECT conname FROM pg_constraint
+            WHERE conrelid = to_regclass(:table_name) AND contype IN ('p', 'u')'''),
+                                   {'table_name': old_table}).scalars().all():
+        connection.execute(sqla.text(f'ALTER TABLE {old_table} RENAME CONSTRAINT {quote_identifier(name)} '
+                                     f'TO {quote_identifier(name + "_unpartitioned")}'))
+
+    ElectricityGeneration.__table__.create(connection)
+    start, end = connection.execute(sqla.text(f'SELECT min("DateStamp"), max("DateStamp") FROM {old_table}')).one()
+    if start is not None:
+        for month in month_starts(start, (pd.Timestamp(end) + pd.DateOffset(months=1)).to_pydatetime()):
+            create_partition(connection, month)
+
+    # Columns added to the table since the old one was created are left NULL (see src/setup/backfill_energy.py)
+    old_columns = set(connection.execute(sqla.text('''
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = :table_name'''),
+                                         {'table_name': OLD_TABLE_NAME}).scalars())
+    columns = ', '.join(quote_identifier(column.name) for column in ElectricityGeneration.__table__.columns if column.name in old_columns)
+    result = connection.execute(sqla.text(f'''
+        INSERT INTO {table} ({columns})
+        SELECT {columns} FROM {old_table}
+        WHERE "DateStamp" IS NOT NULL'''))
+    logging.info(f'{result.rowcount} rows copied to the partitioned {TABLE_NAME}')
+    connection.execute(sqla.text(f'''
+        SELECT setval(pg_get_serial_sequence(:table_name, 'Id'), coalesce((SELECT max("Id") FROM {table}), 0) + 1, false)'''),
+                       {'table_name': table})
+    if not keep_old_table:
+        connection.execute(sqla.text(f'DROP TABLE {old_table}'))
+
+
+def main():
+    load_dotenv()
+    HOST = os.getenv('ELEC_LCA_HOST')
+    DB_NAME = os.getenv('ELEC_LCA_DB_NAME')
+    USER = os.getenv('ELEC_LCA_USER')
+    PASSWORD = os.getenv('ELEC_LCA_PASSWORD')
+
+    engine = sqla.create_engine(sqla.engine.url.URL.create(
+        drivername='postgresql',
+        host=HOST,
+        database=DB_NAME,
+        username=USER,
+        password=PASSWORD
+    ))
+    with engine.begin() as connection:
+        migrate_to_partitioned(connection)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
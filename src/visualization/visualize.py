@@ -38,8 +38,7 @@ def main():
     st.text(region_code)
 
     generation_type_name = st.selectbox(label='Generation type', options=cache.generation_types['Name'])
-    generation_type_id_result = cache.generation_types.loc[cache.generation_types['Name'] == generation_type_name]
-    generation_type_id = generation_type_id_result['Id'].iloc[0]
+    generation_type_id = cache.generation_type_id_by_name[generation_type_name]
     st.text(f'Generation type id = {generation_type_id}')
     start_date = st.date_input(label='Start date')
     st.text('Timezone: Europe (Brussels)')
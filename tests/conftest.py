@@ -0,0 +1,18 @@
+from types import SimpleNamespace
+from typing import Dict, List
+
+import pytest
+
+from src.data.get_common_data import ENTSOE_DATA_SOURCE_NAME
+
+
+@pytest.fixture
+def make_cache():
+    """Factory of stand-ins of BasicDataCache with only the GenerationMappings of the given ENTSO-E names"""
+
+    def make(generation_type_ids: Dict[str, int], region_codes: List[str] = ()):
+        return SimpleNamespace(region_id_by_code={code: i for i, code in enumerate(region_codes, start=1)},
+                               generation_type_id_by_external_name={(ENTSOE_DATA_SOURCE_NAME, name): generation_type_id
+                                                                    for name, generation_type_id in generation_type_ids.items()})
+
+    return make
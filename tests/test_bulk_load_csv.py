@@ -0,0 +1,70 @@
+import shutil
+import threading
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from src.pipelines.bulk_load_csv import MANIFEST_NAME, Manifest, bulk_load_directory
+
+NL_EXPORT = Path(__file__).resolve().parents[1] / 'data/external/entso-e/nl/Actual Generation per Production Type_202312180000-202312190000.csv'
+
+
+@pytest.fixture
+def cache(make_cache):
+    return make_cache({'Fossil Gas': 2, 'Wind Onshore': 3}, ['NL', 'BE'])
+
+
+def make_exports(root: Path):
+    for zone, name in [('nl', 'a.csv'), ('nl', 'b.csv'), ('be', 'c.csv')]:
+        (root / zone).mkdir(exist_ok=True)
+        text = NL_EXPORT.read_text(encoding='utf-8-sig')
+        (root / zone / name).write_text(text.replace('BZN|NL', 'BZN|BE') if zone == 'be' else text)
+    (root / 'nl' / 'broken.csv').write_text('"Not","An","Export"\n1,2,3\n')
+
+
+def run(root, cache, **kwargs):
+    stored = []
+    lock = threading.Lock()
+
+    def store_frames(frames, engine):
+        # Like a transaction: nothing is stored if a chunk fails to parse
+        frames = list(frames)
+        with lock:
+            stored.append(frames)
+        return sum(len(df) for df in frames)
+
+    counts = bulk_load_directory(root, cache, None, parse_workers=2, store_frames=store_frames, **kwargs)
+    return counts, [pd.concat(frames, ignore_index=True) for frames in stored], [len(frames) for frames in stored]
+
+
+def test_bulk_load_resumes_from_manifest(cache, tmp_path):
+    make_exports(tmp_path)
+    counts, stored, _ = run(tmp_path, cache)
+    assert counts == {'done': 3, 'failed': 1, 'skipped': 0}
+    assert sorted(df['RegionId'].iloc[0] for df in stored) == [1, 1, 2]
+    assert all(len(df) == 2 * 96 for df in stored)
+    manifest = Manifest(tmp_path / MANIFEST_NAME, tmp_path)
+    assert manifest.entries['nl/a.csv']['rows'] == 2 * 96
+    assert manifest.entries['nl/broken.csv']['status'] == 'failed'
+
+    # Loaded files are skipped, failed and changed files are loaded again
+    shutil.copy(tmp_path / 'nl' / 'a.csv', tmp_path / 'be' / 'c.csv')
+    counts, stored, _ = run(tmp_path, cache)
+    assert counts == {'done': 1, 'failed': 1, 'skipped': 2}
+    assert [df['RegionId'].iloc[0] for df in stored] == [1]
+
+
+def test_bulk_load_one_chunk_at_a_time(cache, tmp_path):
+    make_exports(tmp_path)
+    # A file that fails to parse after a few chunks
+    text = NL_EXPORT.read_text(encoding='utf-8-sig')
+    (tmp_path / 'nl' / 'truncated.csv').write_text(text + '"BZN|NL","not a time interval","0"\n')
+    # Every chunk is bigger than the limit, so each one is written before the next one is taken from the workers
+    counts, stored, chunks = run(tmp_path, cache, chunksize=10, max_bytes_in_flight=1)
+    assert counts == {'done': 3, 'failed': 2, 'skipped': 0}
+    assert all(len(df) == 2 * 96 for df in stored)
+    # Each file is stored in chunks, in one call
+    assert chunks == [10, 10, 10]
+    manifest = Manifest(tmp_path / MANIFEST_NAME, tmp_path)
+    assert manifest.entries['nl/truncated.csv']['status'] == 'failed'
@@ -0,0 +1,76 @@
+import threading
+import time
+
+import pandas as pd
+import pytest
+import requests
+
+from src.pipelines.concurrent_fetch import TokenBucket, retrieve_and_store_regions
+
+REGION_CODES = ['NL', 'BE', 'DE_LU', 'FR', 'AT', 'PL', 'CZ', 'DK_1']
+
+
+class StubEntsoeClient:
+    """Answers query_generation after `latency` seconds. The first call for each region in `failing` raises HTTPError"""
+
+    def __init__(self, latency: float, failing=()):
+        self.latency = latency
+        self.failing = set(failing)
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def query_generation(self, region_code, start, end, psr_type=None):
+        with self._lock:
+            self.calls.append(region_code)
+            fail = region_code in self.failing
+            self.failing.discard(region_code)
+        time.sleep(self.latency)
+        if fail:
+            raise requests.exceptions.HTTPError('503 Server Error')
+        index = pd.date_range(start, end, freq='15min', inclusive='left')
+        columns = pd.MultiIndex.from_tuples([('Fossil Gas', 'Actual Aggregated')])
+        return pd.DataFrame(1.0, index=index, columns=columns)
+
+
+@pytest.fixture
+def cache(make_cache):
+    return make_cache({'Fossil Gas': 2}, REGION_CODES)
+
+
+def run(client, cache, workers):
+    stored = []
+    rows_written = retrieve_and_store_regions(client, None, REGION_CODES,
+                                              pd.Timestamp('20231202', tz='Europe/Brussels'),
+                                              pd.Timestamp('20231203', tz='Europe/Brussels'),
+                                              cache, workers=workers,
+                                              rate_limiter=TokenBucket(rate=1000, capacity=100), backoff_seconds=0.01,
+                                              store_frame=lambda df, engine: stored.append(df) or len(df))
+    return rows_written, stored
+
+
+def test_all_regions_stored_and_time_scales_with_workers(cache):
+    s = time.monotonic()
+    rows_written, stored = run(StubEntsoeClient(latency=0.2), cache, workers=1)
+    sequential = time.monotonic() - s
+    assert rows_written == {code: 96 for code in REGION_CODES}
+    assert sorted(df['RegionId'].iloc[0] for df in stored) == list(range(1, len(REGION_CODES) + 1))
+
+    s = time.monotonic()
+    rows_written, _ = run(StubEntsoeClient(latency=0.2), cache, workers=8)
+    assert rows_written == {code: 96 for code in REGION_CODES}
+    assert time.monotonic() - s < sequential / 2
+
+
+def test_http_errors_are_retried(cache):
+    client = StubEntsoeClient(latency=0, failing=['NL', 'FR'])
+    rows_written, _ = run(client, cache, workers=4)
+    assert rows_written == {code: 96 for code in REGION_CODES}
+    assert client.calls.count('NL') == 2 and client.calls.count('FR') == 2
+
+
+def test_token_bucket_limits_rate():
+    bucket = TokenBucket(rate=50, capacity=1)
+    s = time.monotonic()
+    for _ in range(11):
+        bucket.acquire()
+    assert time.monotonic() - s >= 0.19
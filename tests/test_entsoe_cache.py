@@ -0,0 +1,109 @@
+import os
+import time
+
+import pandas as pd
+import pytest
+from entsoe.exceptions import NoMatchingDataError
+
+from src.pipelines.entsoe_cache import CacheMissError, CachingEntsoeClient, OFFLINE, READ_THROUGH, WRITE_THROUGH
+
+START = pd.Timestamp('20231202', tz='Europe/Brussels')
+END = pd.Timestamp('20231203', tz='Europe/Brussels')
+
+
+class StubEntsoeClient:
+    def __init__(self):
+        self.calls = 0
+
+    def query_generation(self, country_code, start, end, psr_type=None):
+        self.calls += 1
+        if country_code == 'XX':
+            raise NoMatchingDataError()
+        index = pd.date_range(start, end, freq='15min', inclusive='left')
+        columns = pd.MultiIndex.from_tuples([('Fossil Gas', 'Actual Aggregated'), ('Hydro Pumped Storage', 'Actual Consumption')])
+        return pd.DataFrame(float(self.calls), index=index, columns=columns)
+
+    def query_crossborder_flows(self, country_code_from, country_code_to, start, end):
+        self.calls += 1
+        index = pd.date_range(start, end, freq='h', inclusive='left')
+        return pd.Series(100.0 if country_code_to == 'BE' else 0.0, index=index)
+
+
+def test_read_through_then_offline_replay(tmp_path):
+    stub = StubEntsoeClient()
+    client = CachingEntsoeClient(stub, tmp_path, READ_THROUGH)
+    expected = client.query_generation('NL', start=START, end=END)
+    # The same instants in another time zone hit the cache
+    cached = client.query_generation('NL', start=START.tz_convert('UTC'), end=END.tz_convert('UTC'))
+    assert stub.calls == 1
+    pd.testing.assert_frame_equal(cached, expected, check_freq=False)
+
+    offline = CachingEntsoeClient(None, tmp_path, OFFLINE)
+    pd.testing.assert_frame_equal(offline.query_generation('NL', start=START, end=END), expected, check_freq=False)
+    with pytest.raises(CacheMissError):
+        offline.query_generation('BE', start=START, end=END)
+
+
+def test_no_matching_data_is_cached(tmp_path):
+    stub = StubEntsoeClient()
+    client = CachingEntsoeClient(stub, tmp_path, READ_THROUGH)
+    for _ in range(2):
+        with pytest.raises(NoMatchingDataError):
+            client.query_generation('XX', start=START, end=END)
+    assert stub.calls == 1
+
+
+def test_no_matching_data_expires(tmp_path):
+    stub = StubEntsoeClient()
+    client = CachingEntsoeClient(stub, tmp_path, READ_THROUGH, no_data_ttl=60)
+    with pytest.raises(NoMatchingDataError):
+        client.query_generation('XX', start=START, end=END)
+    markers = list(tmp_path.rglob('*.nodata'))
+    assert len(markers) == 1
+    an_hour_ago = time.time() - 60 * 60
+    os.utime(markers[0], (an_hour_ago, an_hour_ago))
+
+    # Offline, the expired marker still answers
+    with pytest.raises(NoMatchingDataError):
+        CachingEntsoeClient(None, tmp_path, OFFLINE, no_data_ttl=60).query_generation('XX', start=START, end=END)
+    with pytest.raises(NoMatchingDataError):
+        client.query_generation('XX', start=START, end=END)
+    assert stub.calls == 2
+
+
+def test_recent_data_is_queried_again(tmp_path):
+    stub = StubEntsoeClient()
+    client = CachingEntsoeClient(stub, tmp_path, READ_THROUGH, revision_horizon=2 * 24 * 60 * 60)
+    end = pd.Timestamp.now(tz='Europe/Brussels').floor('D')
+    client.query_generation('NL', start=end - pd.Timedelta(days=1), end=end)
+    latest = client.query_generation('NL', start=end - pd.Timedelta(days=1), end=end)
+    assert stub.calls == 2
+    # Older data is answered from the cache
+    client.query_generation('NL', start=end - pd.Timedelta(days=4), end=end - pd.Timedelta(days=3))
+    client.query_generation('NL', start=end - pd.Timedelta(days=4), end=end - pd.Timedelta(days=3))
+    assert stub.calls == 3
+
+    # The latest response is replayed offline
+    replayed = CachingEntsoeClient(None, tmp_path, OFFLINE).query_generation('NL', start=end - pd.Timedelta(days=1), end=end)
+    pd.testing.assert_frame_equal(replayed, latest, check_freq=False)
+
+
+def test_write_through_refreshes_the_cache(tmp_path):
+    stub = StubEntsoeClient()
+    client = CachingEntsoeClient(stub, tmp_path, WRITE_THROUGH)
+    client.query_generation('NL', start=START, end=END)
+    refreshed = client.query_generation('NL', start=START, end=END)
+    assert stub.calls == 2
+    replayed = CachingEntsoeClient(None, tmp_path, OFFLINE).query_generation('NL', start=START, end=END)
+    pd.testing.assert_frame_equal(replayed, refreshed, check_freq=False)
+
+
+def test_crossborder_flows_are_cached_per_direction(tmp_path):
+    stub = StubEntsoeClient()
+    client = CachingEntsoeClient(stub, tmp_path, READ_THROUGH)
+    expected = client.query_crossborder_flows('NL', 'BE', start=START, end=END)
+    client.query_crossborder_flows('BE', 'NL', start=START, end=END)
+    assert stub.calls == 2
+
+    replayed = CachingEntsoeClient(None, tmp_path, OFFLINE).query_crossborder_flows('NL', 'BE', start=START, end=END)
+    pd.testing.assert_series_equal(replayed, expected, check_freq=False)
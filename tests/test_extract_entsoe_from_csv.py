@@ -0,0 +1,75 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.extract.extract_entsoe_from_csv import iter_entsoe_csv
+
+NL_EXPORT = Path(__file__).resolve().parents[1] / 'data/external/entso-e/nl/Actual Generation per Production Type_202312180000-202312190000.csv'
+
+
+@pytest.fixture
+def cache(make_cache):
+    return make_cache({'Fossil Hard coal': 1,
+                       'Fossil Brown coal/Lignite': 1,  # n/e in the export
+                       'Fossil Gas': 2,
+                       'Hydro Pumped Storage': 3,  # n/e in the export
+                       }, ['NL', 'BE'])
+
+
+def read_all(filepath, cache, **kwargs):
+    long_df = pd.concat(iter_entsoe_csv(filepath, cache, **kwargs), ignore_index=True)
+    return long_df.sort_values(['GenerationTypeId', 'DateStamp']).reset_index(drop=True)
+
+
+@pytest.mark.parametrize('engine', ['c', 'pyarrow'])
+def test_nl_export(cache, engine):
+    long_df = read_all(NL_EXPORT, cache, chunksize=10, engine=engine)
+    raw = pd.read_csv(NL_EXPORT)
+
+    assert len(long_df) == 3 * 96
+    assert (long_df['RegionId'] == 1).all()
+    assert (long_df['ResolutionMinutes'] == 15).all()
+    hard_coal = long_df[long_df['GenerationTypeId'] == 1]
+    assert hard_coal['DateStamp'].iloc[0] == pd.Timestamp('2023-12-17 23:00', tz='UTC')
+    assert hard_coal['DateStamp'].iloc[-1] == pd.Timestamp('2023-12-18 22:45', tz='UTC')
+    # n/e values of a generation type mapped to the same id do not hide the values of the others
+    np.testing.assert_allclose(hard_coal['AggregatedGeneration'], raw['Fossil Hard coal  - Actual Aggregated [MW]'])
+    gas = long_df[long_df['GenerationTypeId'] == 2]
+    np.testing.assert_allclose(gas['AggregatedGeneration'], raw['Fossil Gas  - Actual Aggregated [MW]'])
+    assert long_df.loc[long_df['GenerationTypeId'] == 3, 'AggregatedGeneration'].isna().all()
+
+
+FALL_BACK_LOCAL_STARTS = ['29.10.2023 01:45', '29.10.2023 02:00', '29.10.2023 02:15', '29.10.2023 02:30', '29.10.2023 02:45',
+                          '29.10.2023 02:00', '29.10.2023 02:15', '29.10.2023 02:30', '29.10.2023 02:45', '29.10.2023 03:00']
+
+
+def write_export(export: Path, areas):
+    rows = [f'"{area}","{start} - {start} (CET/CEST)","{i}","n/e"' for area in areas for i, start in enumerate(FALL_BACK_LOCAL_STARTS)]
+    export.write_text('\n'.join(['"Area","MTU","Fossil Gas  - Actual Aggregated [MW]","Fossil Gas  - Actual Consumption [MW]"',
+                                 *rows]))
+
+
+def test_end_of_daylight_saving_time(cache, tmp_path):
+    export = tmp_path / 'export.csv'
+    write_export(export, ['BZN|NL'])
+
+    # Chunks of 3 rows split the repeated hour across chunks
+    long_df = read_all(export, cache, chunksize=3)
+    expected = pd.date_range('2023-10-28 23:45', periods=10, freq='15min', tz='UTC')
+    assert (long_df['DateStamp'] == expected).all()
+    np.testing.assert_allclose(long_df['AggregatedGeneration'], np.arange(10))
+
+
+@pytest.mark.parametrize('chunksize', [3, 100])
+def test_end_of_daylight_saving_time_of_several_areas(cache, tmp_path, chunksize):
+    export = tmp_path / 'export.csv'
+    write_export(export, ['BZN|NL', 'BZN|BE'])
+
+    long_df = read_all(export, cache, chunksize=chunksize).sort_values(['RegionId', 'DateStamp'])
+    expected = pd.date_range('2023-10-28 23:45', periods=10, freq='15min', tz='UTC')
+    for region_id in [1, 2]:
+        region_df = long_df[long_df['RegionId'] == region_id]
+        assert (region_df['DateStamp'] == expected).all()
+        np.testing.assert_allclose(region_df['AggregatedGeneration'], np.arange(10))
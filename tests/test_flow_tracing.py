@@ -0,0 +1,61 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from src.data.get_common_data import build_common_data
+from src.microservice.flow_tracing import trace_batch, trace_flows
+from src.pipelines.trace_crossborder_flows import trace_consumption_intensities
+
+
+def test_imports_mix_with_the_generation_of_the_region():
+    # A generates 100 at 1000 per unit and exports 30 to B, which generates 50 at 0. C has nothing at all
+    generation = np.array([[100.0, 50.0, 0.0]])
+    flows = np.array([[30.0]])
+    borders = np.array([[0, 1]])
+    impacts = np.array([[[100 * 1000.0], [0.0], [0.0]]])
+
+    intensities = trace_batch(generation, flows, borders, impacts)
+
+    np.testing.assert_allclose(intensities[0, :2, 0], [1000.0, 30 * 1000.0 / 80])
+    assert np.isnan(intensities[0, 2, 0])
+
+
+def test_batches_in_a_process_pool_match_one_solve_per_interval():
+    rng = np.random.default_rng(0)
+    n_intervals, n_regions = 50, 6
+    borders = np.array([(i, j) for i in range(n_regions) for j in range(n_regions) if i != j and (i + j) % 3 == 0])
+    generation = rng.uniform(10, 100, (n_intervals, n_regions))
+    flows = rng.uniform(0, 5, (n_intervals, len(borders)))
+    impacts = generation[:, :, np.newaxis] * rng.uniform(0, 1000, (n_intervals, n_regions, 2))
+
+    intensities = trace_flows(generation, flows, borders, impacts, batch_size=16, workers=2)
+
+    for t in range(n_intervals):
+        system = np.diag(generation[t] + np.bincount(borders[:, 1], weights=flows[t], minlength=n_regions))
+        system[borders[:, 1], borders[:, 0]] -= flows[t]
+        np.testing.assert_allclose(intensities[t], np.linalg.solve(system, impacts[t]))
+
+
+def test_hourly_and_quarter_hourly_data_are_traced_on_one_grid():
+    cache = build_common_data(
+        generation_types=pd.DataFrame({'Id': [1, 2], 'Name': ['Coal', 'Wind']}),
+        generation_type_mappings=pd.DataFrame({'Id': [1], 'DataSourceName': ['ENTSO-E'], 'ElectricityGenerationTypeId': [1],
+                                               'ExternalName': ['Fossil Hard coal'], 'Comment': ['']}),
+        regions=pd.DataFrame({'Id': [1, 2], 'Code': ['NL', 'BE'], 'Type': 'Country', 'Description': None}),
+        impact_categories=pd.DataFrame({'Id': [1], 'Name': ['CLIMATE CHANGE'], 'Unit': ['g CO2 eq.']}),
+        environmental_impacts=pd.DataFrame({'Id': [1, 2], 'ElectricityGenerationTypeId': [1, 2], 'ImpactCategoryId': [1, 1],
+                                            'ImpactValue': [1000.0, 10.0], 'ImpactCategoryUnit': 'g CO2 eq.', 'PerUnit': 'kWh'}))
+    start, end = datetime.datetime(2023, 12, 1), datetime.datetime(2023, 12, 1, 1)
+    quarters = pd.date_range(start, end, freq='15min', inclusive='left')
+    # Region 1: hourly coal. Region 2: quarter hourly wind, importing from region 1 in the second half hour only
+    generation_df = pd.DataFrame({'RegionId': [1] + [2] * 4, 'GenerationTypeId': [1] + [2] * 4, 'DateStamp': [start, *quarters],
+                                  'AggregatedGeneration': [100.0] + [50.0] * 4, 'ResolutionMinutes': [60] + [15] * 4})
+    flows_df = pd.DataFrame({'FromRegionId': [1], 'ToRegionId': [2], 'DateStamp': [quarters[2]], 'Flow': [50.0], 'ResolutionMinutes': [30]})
+
+    intensity_df = trace_consumption_intensities(generation_df, flows_df, cache, start, end, workers=1)
+
+    assert intensity_df['DateStamp'].tolist() == [stamp for stamp in quarters for _ in range(2)]
+    by_region = intensity_df.pivot(index='DateStamp', columns='RegionId', values='Intensity')
+    np.testing.assert_allclose(by_region[1], 1000.0)
+    np.testing.assert_allclose(by_region[2], [10.0, 10.0, 505.0, 505.0])
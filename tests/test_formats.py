@@ -0,0 +1,57 @@
+import io
+import json
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from src.microservice.formats import ARROW, HEADER_METADATA_KEY, JSON, MEDIA_TYPES, NDJSON, PARQUET, binary_response, \
+    negotiate_response_format
+
+
+@pytest.mark.parametrize('response_format, accept, expected', [
+    (None, None, JSON),
+    (None, '*/*', JSON),
+    (None, 'text/html, application/vnd.apache.arrow.stream;q=0.9', ARROW),
+    (None, 'Application/Vnd.Apache.Parquet', PARQUET),
+    (None, 'application/x-ndjson, application/json', NDJSON),
+    (PARQUET, 'application/vnd.apache.arrow.stream', PARQUET),  # The format parameter wins over the Accept header
+])
+def test_response_format_is_negotiated(response_format, accept, expected):
+    assert negotiate_response_format(response_format, accept) == expected
+
+
+def test_unknown_format_parameter_is_rejected():
+    with pytest.raises(TypeError):
+        negotiate_response_format('csv', 'application/json')
+
+
+def read_body(response) -> pa.Table:
+    if response.media_type == MEDIA_TYPES[ARROW]:
+        return pa.ipc.open_stream(response.body).read_all()
+    return pq.read_table(io.BytesIO(response.body))
+
+
+@pytest.mark.parametrize('response_format', [ARROW, PARQUET])
+def test_binary_bodies_have_utc_dates_and_the_header(response_format):
+    df = pd.DataFrame({'RegionId': [1, 1], 'DateStamp': pd.to_datetime(['2023-12-01 23:00', '2023-12-02 00:00']),
+                       'AggregatedGeneration': [10.0, None]})
+    header = {'ImpactCategories': [{'Id': 1, 'Name': 'CLIMATE CHANGE'}]}
+
+    response = binary_response(df, response_format, headers={'X-Next-Cursor': 'cursor'}, metadata=header)
+
+    assert response.media_type == MEDIA_TYPES[response_format]
+    assert response.headers['X-Next-Cursor'] == 'cursor'
+    table = read_body(response)
+    assert json.loads(table.schema.metadata[HEADER_METADATA_KEY]) == header
+    result = table.to_pandas()
+    assert result['DateStamp'].tolist() == [pd.Timestamp('2023-12-01 23:00', tz='UTC'), pd.Timestamp('2023-12-02 00:00', tz='UTC')]
+    pd.testing.assert_frame_equal(result.drop(columns='DateStamp'), df.drop(columns='DateStamp'))
+
+
+def test_binary_bodies_without_header():
+    table = read_body(binary_response(pd.DataFrame({'RegionId': [1]}), ARROW))
+    assert HEADER_METADATA_KEY not in (table.schema.metadata or {})
+    with pytest.raises(TypeError):
+        binary_response(pd.DataFrame({'RegionId': [1]}), JSON)
@@ -0,0 +1,123 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+from src.microservice.constants import conversion_factors
+from src.microservice.formats import wide_json
+from src.microservice.impact_engine import build_impact_factors, calculate_impacts, impact_category_metadata, to_intensity_df, to_long_df, \
+    to_wide_df
+
+
+def make_environmental_impacts_df():
+    return pd.DataFrame({
+        'Id': [1, 2, 3, 4, 5],
+        'ElectricityGenerationTypeId': [1, 1, 2, 2, 4],
+        'ImpactCategoryId': [1, 2, 1, 2, 1],
+        'ImpactValue': [1000.0, 490.0, 430.0, 20.0, 12.0],
+        'ImpactCategoryUnit': ['g CO2 eq.', 'mg P eq.', 'g CO2 eq.', 'mg P eq.', 'g CO2 eq.'],
+        'PerUnit': ['kWh'] * 5,
+    })
+
+
+def make_generation_df():
+    date_stamps = pd.date_range('2023-12-02', periods=3, freq='15min', tz='Europe/Brussels')
+    return pd.DataFrame({
+        'RegionId': [7] * 9,
+        'DateStamp': list(date_stamps) * 3,
+        'GenerationTypeId': [1] * 3 + [2] * 3 + [3] * 3,  # Type 3 has no impact factors
+        'AggregatedGeneration': np.arange(9, dtype=float),
+        'GenerationUnit': 'MJ',
+    })
+
+
+def test_totals_match_sum_over_generation_types():
+    factors = build_impact_factors(make_environmental_impacts_df(), generation_unit='MJ')
+    result = calculate_impacts(make_generation_df(), factors)
+
+    assert result.totals.shape == (3, 2)
+    # Climate change: 3.6 * (1000 * type 1 + 430 * type 2)
+    expected = 3.6 * (1000 * np.arange(3) + 430 * np.arange(3, 6))
+    np.testing.assert_allclose(result.totals[:, 0], expected)
+
+
+def test_long_format_matches_merge_and_apply():
+    generation_df = make_generation_df()
+    impacts_df = make_environmental_impacts_df().drop(['Id'], axis=1)
+
+    expected = generation_df.merge(impacts_df, left_on='GenerationTypeId', right_on='ElectricityGenerationTypeId')
+    expected['ConversionFactor'] = expected[['GenerationUnit', 'PerUnit']].apply(
+        lambda x: conversion_factors[(x['GenerationUnit'], x['PerUnit'])], axis=1)
+    expected['AggregatedGenerationConverted'] = expected['AggregatedGeneration'] * expected['ConversionFactor']
+    expected['EnvironmentalImpact'] = expected['AggregatedGenerationConverted'] * expected['ImpactValue']
+
+    factors = build_impact_factors(impacts_df, generation_unit='MJ')
+    actual = to_long_df(calculate_impacts(generation_df, factors), generation_df)
+
+    sort_keys = ['GenerationTypeId', 'DateStamp', 'ImpactCategoryId']
+    expected = expected.sort_values(sort_keys).reset_index(drop=True)
+    actual = actual.sort_values(sort_keys).reset_index(drop=True)[expected.columns]
+    pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
+
+
+def test_wide_format_has_a_column_per_impact_category():
+    generation_df = make_generation_df()
+    factors = build_impact_factors(make_environmental_impacts_df(), generation_unit='MJ')
+
+    wide_df = to_wide_df(generation_df, factors)
+    long_df = to_long_df(calculate_impacts(generation_df, factors), generation_df)
+
+    # Rows of type 3, which has no impact factors, are left out like in the long format
+    assert list(wide_df.columns) == ['RegionId', 'GenerationTypeId', 'DateStamp', 'AggregatedGeneration', '1', '2']
+    assert len(wide_df) == 6
+    expected = long_df.pivot_table(index=['GenerationTypeId', 'DateStamp'], columns='ImpactCategoryId', values='EnvironmentalImpact')
+    np.testing.assert_allclose(wide_df[['1', '2']].to_numpy(), expected.to_numpy())
+
+    metadata_df = impact_category_metadata(factors, [2])
+    assert metadata_df.to_dict(orient='records') == [{'ImpactCategoryId': 2, 'ImpactCategoryUnit': 'mg P eq.', 'PerUnit': 'kWh',
+                                                       'ConversionFactor': 3.6}]
+
+    payload = json.loads(wide_json(wide_df, {'GenerationUnit': 'MJ'}))
+    assert payload['columns'] == ['DateStamp', 'AggregatedGeneration', '1', '2']
+    assert payload['data'][1][1:] == [1.0, 3600.0, 1764.0]
+
+
+def test_intensity_is_weighted_by_the_generation_of_all_types():
+    generation_df = make_generation_df()
+    generation_df.loc[generation_df['DateStamp'] == generation_df['DateStamp'].iloc[0], 'AggregatedGeneration'] = 0.0
+    factors = build_impact_factors(make_environmental_impacts_df(), generation_unit='MJ')
+
+    intensity_df = to_intensity_df(calculate_impacts(generation_df, factors))
+
+    assert list(intensity_df.columns) == ['RegionId', 'DateStamp', 'AggregatedGeneration', '1', '2']
+    # Type 3 has no impact factors but is part of the mix
+    generation = np.array([[1.0, 4.0, 7.0], [2.0, 5.0, 8.0]])
+    np.testing.assert_allclose(intensity_df['AggregatedGeneration'].iloc[1:], generation.sum(axis=1))
+    np.testing.assert_allclose(intensity_df['1'].iloc[1:], (1000 * generation[:, 0] + 430 * generation[:, 1]) / generation.sum(axis=1))
+    np.testing.assert_allclose(intensity_df['2'].iloc[1:], (490 * generation[:, 0] + 20 * generation[:, 1]) / generation.sum(axis=1))
+    # No generation at all
+    assert intensity_df[['1', '2']].iloc[0].isna().all()
+
+
+def test_missing_generation_gives_missing_impacts_in_every_layout():
+    generation_df = make_generation_df()
+    generation_df.loc[1, 'AggregatedGeneration'] = np.nan  # Type 1 at the second timestamp
+    factors = build_impact_factors(make_environmental_impacts_df(), generation_unit='MJ')
+    result = calculate_impacts(generation_df, factors)
+
+    long_df = to_long_df(result, generation_df)
+    missing = long_df['AggregatedGeneration'].isna()
+    assert missing.sum() == 2
+    assert long_df.loc[missing, 'EnvironmentalImpact'].isna().all()
+    assert long_df.loc[~missing, 'EnvironmentalImpact'].notna().all()
+
+    wide_df = to_wide_df(generation_df, factors)
+    missing = wide_df['AggregatedGeneration'].isna()
+    assert missing.sum() == 1
+    assert wide_df.loc[missing, ['1', '2']].isna().all(axis=None)
+    assert wide_df.loc[~missing, ['1', '2']].notna().all(axis=None)
+
+    intensity_df = to_intensity_df(result)
+    assert intensity_df[['AggregatedGeneration', '1', '2']].isna().to_numpy().tolist() == [[False] * 3, [True] * 3, [False] * 3]
+    assert np.isnan(result.totals[1]).all()
+    assert not np.isnan(result.totals[[0, 2]]).any()
@@ -0,0 +1,73 @@
+import pandas as pd
+
+from src.pipelines.entsoe_cache import OFFLINE, READ_THROUGH, WRITE_THROUGH, CachingEntsoeClient
+from src.pipelines.incremental_ingest import bypass_cache, merge_intervals, overlaps_gaps, plan_fetches, prune_gap_attempts, \
+    select_regions, split_interval
+
+
+def dt(value):
+    return pd.Timestamp(value).to_pydatetime()
+
+
+def test_merge_intervals():
+    intervals = [(dt('2023-12-02 10:00'), dt('2023-12-02 12:00')),
+                 (dt('2023-12-01'), dt('2023-12-01 01:00')),
+                 (dt('2023-12-02 11:00'), dt('2023-12-02 13:00')),
+                 (dt('2023-12-02 13:00'), dt('2023-12-02 14:00')),
+                 (dt('2023-12-03'), dt('2023-12-03'))]
+    assert merge_intervals(intervals) == [(dt('2023-12-01'), dt('2023-12-01 01:00')),
+                                          (dt('2023-12-02 10:00'), dt('2023-12-02 14:00'))]
+
+
+def test_split_interval():
+    chunks = split_interval(dt('2023-01-01'), dt('2023-03-01'), pd.Timedelta(days=31))
+    assert chunks == [(dt('2023-01-01'), dt('2023-02-01')), (dt('2023-02-01'), dt('2023-03-01'))]
+    assert split_interval(dt('2023-01-01'), dt('2023-01-01')) == []
+
+
+def test_plan_fetches():
+    now = dt('2023-12-10 12:00')
+    watermarks_df = pd.DataFrame({'RegionId': [1, 1, 1],
+                                  'GenerationTypeId': [1, 2, 3],
+                                  'Watermark': pd.to_datetime(['2023-12-10 11:45', '2023-12-10 10:00',
+                                                               '2023-10-01 00:00'])})  # Type 3 not reported anymore
+    gaps_df = pd.DataFrame({'RegionId': [1, 1],
+                            'GenerationTypeId': [1, 2],
+                            'GapStart': pd.to_datetime(['2023-12-05 00:00', '2023-12-10 09:00']),
+                            'GapEnd': pd.to_datetime(['2023-12-05 02:00', '2023-12-10 09:30'])})
+    plan = plan_fetches([1, 2], watermarks_df, gaps_df, now, backfill_start=dt('2023-11-01'),
+                        overlap=pd.Timedelta(hours=1), max_chunk=pd.Timedelta(days=20))
+
+    # Region 1: the hole of the 5th, then from the oldest high-water mark (minus the overlap), which includes the
+    # second hole
+    assert plan[1] == [(dt('2023-12-05 00:00'), dt('2023-12-05 02:00')), (dt('2023-12-10 09:00'), now)]
+    # Region 2 has no data yet: it is backfilled in chunks
+    assert plan[2] == [(dt('2023-11-01'), dt('2023-11-21')), (dt('2023-11-21'), now)]
+
+
+def test_regions_without_data_that_returned_nothing_are_retried_later():
+    now = dt('2023-12-10 12:00')
+    watermarks_df = pd.DataFrame({'RegionId': [1], 'GenerationTypeId': [1], 'Watermark': [now]})
+    # Region 1 has data again, region 2 returned nothing an hour ago, region 3 two days ago, region 4 was never fetched
+    empty_regions = {1: dt('2023-12-10 11:00'), 2: dt('2023-12-10 11:00'), 3: dt('2023-12-08 12:00')}
+
+    assert select_regions([1, 2, 3, 4], watermarks_df, empty_regions, now, retry_interval=pd.Timedelta(days=1)) == [1, 3, 4]
+    assert list(empty_regions) == [2, 3]
+
+
+def test_prune_gap_attempts():
+    gap_attempts = {(1, dt('2023-12-01 00:00'), dt('2023-12-01 01:00')): dt('2023-12-01 12:00'),
+                    (1, dt('2023-12-09 00:00'), dt('2023-12-09 01:00')): dt('2023-12-09 12:00')}
+    prune_gap_attempts(gap_attempts, since=dt('2023-12-03'))
+    assert list(gap_attempts) == [(1, dt('2023-12-09 00:00'), dt('2023-12-09 01:00'))]
+
+
+def test_intervals_with_holes_bypass_the_cache(tmp_path):
+    gaps_df = pd.DataFrame({'RegionId': [1], 'GenerationTypeId': [1],
+                            'GapStart': pd.to_datetime(['2023-12-05 00:00']), 'GapEnd': pd.to_datetime(['2023-12-05 02:00'])})
+    assert overlaps_gaps(1, dt('2023-12-04'), dt('2023-12-05 01:00'), gaps_df)
+    assert not overlaps_gaps(1, dt('2023-12-05 02:00'), dt('2023-12-06'), gaps_df)
+    assert not overlaps_gaps(2, dt('2023-12-04'), dt('2023-12-06'), gaps_df)
+
+    assert bypass_cache(CachingEntsoeClient(object(), tmp_path, READ_THROUGH)).mode == WRITE_THROUGH
+    assert bypass_cache(CachingEntsoeClient(None, tmp_path, OFFLINE)).mode == OFFLINE
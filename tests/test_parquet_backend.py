@@ -0,0 +1,197 @@
+import asyncio
+import datetime
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.data.get_common_data import load_common_data_from_parquet
+from src.data.parquet_store import generation_files, generation_months, generation_region_ids, remove_generation_month, table_path, \
+    write_generation_month, write_parquet
+from src.microservice.generation import encode_cursor, get_electricity_generation_batch_df, get_electricity_generation_df, next_cursor, \
+    stream_electricity_generation, to_keyed_json
+from src.microservice.parquet_backend import ParquetBackend
+
+
+def write_export(root) -> pd.DataFrame:
+    """Write a small export: two regions, two generation types, hourly data from October to November 2023"""
+    write_parquet(pd.DataFrame({'Id': [1, 2], 'Code': ['NL', 'BE'], 'Type': 'Country', 'Description': None}), table_path(root, 'Regions'))
+    write_parquet(pd.DataFrame({'Id': [1, 2], 'Name': ['Coal', 'Wind']}), table_path(root, 'ElectricityGenerationTypes'))
+    write_parquet(pd.DataFrame({'Id': [1], 'DataSourceName': ['ENTSO-E'], 'ElectricityGenerationTypeId': [1], 'ExternalName': ['Fossil Hard coal'],
+                                'Comment': ['']}), table_path(root, 'ElectricityGenerationTypesMapping'))
+    write_parquet(pd.DataFrame({'Id': [1], 'Name': ['CLIMATE CHANGE'], 'Unit': ['g CO2 eq.']}), table_path(root, 'ImpactCategories'))
+    write_parquet(pd.DataFrame({'Id': [1, 2], 'ElectricityGenerationTypeId': [1, 2], 'ImpactCategoryId': [1, 1], 'ImpactValue': [1000.0, 12.0],
+                                'ImpactCategoryUnit': 'g CO2 eq.', 'PerUnit': 'kWh', 'ReferenceYear': datetime.datetime(2021, 1, 1)}),
+                  table_path(root, 'EnvironmentalImpacts'))
+
+    date_stamps = pd.date_range('2023-10-01', '2023-12-01', freq='h', inclusive='left')
+    generation_df = pd.concat([pd.DataFrame({'RegionId': region_id, 'GenerationTypeId': generation_type_id, 'DateStamp': date_stamps,
+                                             'AggregatedGeneration': np.arange(len(date_stamps), dtype=float) * region_id * generation_type_id})
+                               for region_id in (1, 2) for generation_type_id in (1, 2)], ignore_index=True)
+    generation_df['Id'] = np.arange(len(generation_df))
+    generation_df['ResolutionMinutes'] = 60
+    generation_df['Energy'] = generation_df['AggregatedGeneration']
+    for (region_id, month), month_df in generation_df.groupby(['RegionId', generation_df['DateStamp'].dt.to_period('M')]):
+        write_generation_month(root, region_id, month.to_timestamp().to_pydatetime(), month_df)
+    return generation_df
+
+
+def test_files_are_pruned_by_region_and_month(tmp_path):
+    write_export(tmp_path)
+    files = generation_files(tmp_path, [2], datetime.datetime(2023, 11, 2), datetime.datetime(2023, 11, 3))
+    assert [path.relative_to(tmp_path).as_posix() for path in files] == ['ElectricityGeneration/RegionId=2/Month=2023-11/data.parquet']
+
+
+def test_removed_months_are_not_served(tmp_path):
+    write_export(tmp_path)
+    cache = load_common_data_from_parquet(tmp_path)
+    backend = ParquetBackend(tmp_path)
+    assert remove_generation_month(tmp_path, 2, datetime.datetime(2023, 10, 1))
+    assert not remove_generation_month(tmp_path, 2, datetime.datetime(2023, 10, 1))
+    assert generation_months(tmp_path, 2) == [datetime.datetime(2023, 11, 1)]
+
+    df = asyncio.run(get_electricity_generation_df('2023-10-10', '2023-10-11', 'BE', 2, backend=backend, cache=cache))
+    assert len(df) == 0
+    # The directory of a region is removed with its last month
+    remove_generation_month(tmp_path, 2, datetime.datetime(2023, 11, 1))
+    assert generation_region_ids(tmp_path) == [1]
+
+
+def test_rows_and_pages_match_the_export(tmp_path):
+    generation_df = write_export(tmp_path)
+    cache = load_common_data_from_parquet(tmp_path)
+    backend = ParquetBackend(tmp_path)
+
+    async def run():
+        first = await get_electricity_generation_df('2023-10-31', '2023-11-02', 'BE', 2, backend=backend, cache=cache, limit=30)
+        cursor = encode_cursor(first['DateStamp'].iloc[-1])
+        second = await get_electricity_generation_df('2023-10-31', '2023-11-02', 'BE', 2, backend=backend, cache=cache, limit=30, after=cursor)
+        return first, second
+
+    first, second = asyncio.run(run())
+    # Naive dates are in Europe/Brussels time, one hour ahead of UTC in winter
+    expected = generation_df[(generation_df['RegionId'] == 2) & (generation_df['GenerationTypeId'] == 2)
+                             & (generation_df['DateStamp'] >= '2023-10-30 23:00') & (generation_df['DateStamp'] < '2023-11-01 23:00')]
+    assert list(first.columns) == ['Id', 'RegionId', 'DateStamp', 'GenerationTypeId', 'AggregatedGeneration', 'ResolutionMinutes', 'Energy']
+    pages = pd.concat([first, second], ignore_index=True)
+    assert pages['DateStamp'].tolist() == expected['DateStamp'].iloc[:60].tolist()
+    assert pages['AggregatedGeneration'].tolist() == expected['AggregatedGeneration'].iloc[:60].tolist()
+
+
+@pytest.mark.parametrize('limit', [10, 73, 500])
+def test_next_cursors_page_through_the_end_of_dst(tmp_path, limit):
+    generation_df = write_export(tmp_path)
+    cache = load_common_data_from_parquet(tmp_path)
+    backend = ParquetBackend(tmp_path)
+
+    async def run():
+        pages, cursor = [], None
+        while True:
+            page = await get_electricity_generation_df('2023-10-28', '2023-10-31', 'NL', 1, backend=backend, cache=cache, limit=limit,
+                                                       after=cursor)
+            pages.append(page)
+            cursor = next_cursor(page, limit)
+            if cursor is None:
+                return pages
+
+    pages = asyncio.run(run())
+    # 73 hours, the 29th lasting 25 hours. A last page that is full is followed by an empty one
+    assert [len(page) for page in pages] == {10: [10] * 7 + [3], 73: [73, 0], 500: [73]}[limit]
+    rows = (generation_df['RegionId'] == 1) & (generation_df['GenerationTypeId'] == 1)
+    expected = generation_df[rows & (generation_df['DateStamp'] >= '2023-10-27 22:00') & (generation_df['DateStamp'] < '2023-10-30 23:00')]
+    assert pd.concat(pages)['DateStamp'].tolist() == expected['DateStamp'].tolist()
+
+
+def test_totals_are_per_local_day_across_the_end_of_dst(tmp_path):
+    generation_df = write_export(tmp_path)
+    cache = load_common_data_from_parquet(tmp_path)
+    backend = ParquetBackend(tmp_path)
+
+    df = asyncio.run(get_electricity_generation_df('2023-10-28', '2023-10-31', 'NL', 1, backend=backend, cache=cache, resolution='day'))
+
+    local = generation_df['DateStamp'].dt.tz_localize('UTC').dt.tz_convert('Europe/Brussels')
+    rows = (generation_df['RegionId'] == 1) & (generation_df['GenerationTypeId'] == 1)
+    days = generation_df[rows].groupby(local[rows].dt.date)
+    assert df['DateStamp'].tolist() == [pd.Timestamp('2023-10-27 22:00'), pd.Timestamp('2023-10-28 22:00'), pd.Timestamp('2023-10-29 23:00')]
+    # Mean power (MW) and energy (MWh) of each day. The 29th lasts 25 hours
+    expected_days = [datetime.date(2023, 10, day) for day in (28, 29, 30)]
+    assert df['AggregatedGeneration'].tolist() == days['AggregatedGeneration'].mean()[expected_days].tolist()
+    assert df['Energy'].tolist() == days['Energy'].sum()[expected_days].tolist()
+    assert days.size()[expected_days].tolist() == [24, 25, 24]
+
+
+def test_batch_stream_and_common_data(tmp_path):
+    write_export(tmp_path)
+    cache = load_common_data_from_parquet(tmp_path)
+    backend = ParquetBackend(tmp_path)
+
+    async def run():
+        batch = await get_electricity_generation_batch_df('2023-10-01', '2023-12-01', ['NL', 'BE'], [1, 2], backend=backend, cache=cache,
+                                                          resolution='month')
+        chunks = [chunk async for chunk in stream_electricity_generation('2023-10-01', None, 'NL', 2, backend=backend, cache=cache,
+                                                                         chunk_size=500)]
+        impacts = await backend.read_table_df('EnvironmentalImpacts')
+        return batch, chunks, impacts
+
+    batch, chunks, impacts = asyncio.run(run())
+    assert list(zip(batch['RegionId'], batch['GenerationTypeId'])) == [(1, 1), (1, 1), (1, 2), (1, 2), (2, 1), (2, 1), (2, 2), (2, 2)]
+    assert sum(len(chunk) for chunk in chunks) == 61 * 24
+    assert max(len(chunk) for chunk in chunks) <= 500
+    assert impacts['ImpactValue'].tolist() == [1000.0, 12.0]
+
+
+def test_batch_is_keyed_by_region_code_and_generation_type(tmp_path):
+    write_export(tmp_path)
+    cache = load_common_data_from_parquet(tmp_path)
+    backend = ParquetBackend(tmp_path)
+    batch = asyncio.run(get_electricity_generation_batch_df('2023-10-01', '2023-12-01', ['NL', 'BE'], [1, 2], backend=backend, cache=cache,
+                                                            resolution='month'))
+    batch = batch[(batch['RegionId'] != 1) | (batch['GenerationTypeId'] != 2)]  # As if NL had no data of type 2
+
+    # Keys follow the order of the request, without duplicates
+    keyed = json.loads(to_keyed_json(batch, ['BE', 'NL', 'BE'], [2, 1], cache))
+    assert list(keyed) == ['BE', 'NL'] and list(keyed['BE']) == ['2', '1']
+    assert keyed['NL']['2'] == []
+    assert [row['AggregatedGeneration'] for row in keyed['BE']['2']] == batch.loc[(batch['RegionId'] == 2) & (batch['GenerationTypeId'] == 2),
+                                                                                  'AggregatedGeneration'].tolist()
+    assert {row['RegionId'] for row in keyed['BE']['1']} == {2}
+
+    # Rows of values without the keys: DateStamp, AggregatedGeneration and Energy
+    values = json.loads(to_keyed_json(batch, ['BE', 'NL'], [2, 1], cache, orient='values'))
+    nl_1 = batch[(batch['RegionId'] == 1) & (batch['GenerationTypeId'] == 1)]
+    assert [row[1:] for row in values['NL']['1']] == nl_1[['AggregatedGeneration', 'Energy']].to_numpy().tolist()
+
+
+class ReadCountingBackend(ParquetBackend):
+    def __init__(self, root):
+        super().__init__(root)
+        self.reads = 0
+
+    async def read_generation(self, *args, **kwargs):
+        self.reads += 1
+        return await super().read_generation(*args, **kwargs)
+
+
+def test_oversized_batches_are_rejected_before_reading(tmp_path):
+    write_export(tmp_path)
+    cache = load_common_data_from_parquet(tmp_path)
+    backend = ReadCountingBackend(tmp_path)
+    start, end = datetime.datetime(2023, 10, 1), datetime.datetime(2023, 11, 1)
+
+    async def run():
+        counts = [await backend.count_generation([1, 2], [1, 2], start, end, resolution=resolution) for resolution in (None, 'day')]
+        limited = await backend.count_generation([1, 2], [1, 2], start, end, limit=100)
+        with pytest.raises(ValueError):
+            await get_electricity_generation_batch_df('2023-10-01', '2023-11-01', ['NL', 'BE'], [1, 2], backend=backend, cache=cache,
+                                                      row_limit=4 * 743 - 1)
+        batch = await get_electricity_generation_batch_df('2023-10-01', '2023-11-01', ['NL', 'BE'], [1, 2], backend=backend, cache=cache,
+                                                          row_limit=4 * 743)
+        return counts, limited, batch
+
+    counts, limited, batch = asyncio.run(run())
+    # 744 hours of October in UTC, over 32 days in Europe/Brussels time. The batch in Europe/Brussels time ends an hour
+    # earlier, and the export starts on the 1st in UTC
+    assert counts == [4 * 744, 4 * 32] and limited == 100
+    assert len(batch) == 4 * 743
+    assert backend.reads == 1
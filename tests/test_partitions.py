@@ -0,0 +1,13 @@
+import datetime
+
+from src.data.partitions import PARTITION_NAME_PATTERN, month_starts, partition_name
+
+
+def test_month_starts_and_names():
+    months = month_starts(datetime.datetime(2023, 11, 30, 23, 45), datetime.datetime(2024, 1, 1))
+    assert months == [datetime.datetime(2023, 11, 1), datetime.datetime(2023, 12, 1), datetime.datetime(2024, 1, 1)]
+    assert [partition_name(month) for month in months] == ['ElectricityGeneration_2023_11',
+                                                           'ElectricityGeneration_2023_12',
+                                                           'ElectricityGeneration_2024_01']
+    assert PARTITION_NAME_PATTERN.match('ElectricityGeneration_2023_11').group('month') == '11'
+    assert PARTITION_NAME_PATTERN.match('ElectricityGeneration_unpartitioned') is None
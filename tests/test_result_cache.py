@@ -0,0 +1,104 @@
+import asyncio
+
+import pandas as pd
+
+from src.microservice.backend import GenerationBackend
+from src.microservice.result_cache import ResultCache
+
+
+def calculation(value, calls):
+    async def calculate():
+        calls.append(value)
+        return pd.DataFrame({'EnvironmentalImpact': [value] * 10})
+    return calculate
+
+
+class VersionsBackend(GenerationBackend):
+    """Backend serving only data versions, set by the test"""
+
+    def __init__(self):
+        self.versions = {}
+
+    async def read_generation(self, *args, **kwargs):
+        raise NotImplementedError
+
+    async def count_generation(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def stream_generation(self, *args, **kwargs):
+        raise NotImplementedError
+
+    async def read_data_versions(self) -> pd.DataFrame:
+        return pd.DataFrame([(r, g, v) for (r, g), v in self.versions.items()], columns=['RegionId', 'GenerationTypeId', 'Version'])
+
+    async def close(self):
+        pass
+
+
+def test_repeat_requests_are_served_from_cache():
+    result_cache = ResultCache()
+    calls = []
+    key = result_cache.make_key('calculate', [(1, 2)], date_start='2023-12-02', resolution=None)
+
+    async def run():
+        first = await result_cache.get_or_calculate(key, calculation(1.0, calls))
+        second = await result_cache.get_or_calculate(key, calculation(1.0, calls))
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert second is first
+    assert calls == [1.0]
+    assert result_cache.stats()['hits'] == 1
+    assert result_cache.stats()['misses'] == 1
+
+
+def test_invalidation_only_drops_entries_of_changed_data():
+    result_cache = ResultCache()
+    calls = []
+    key_1 = result_cache.make_key('calculate', [(1, 2)])
+    key_2 = result_cache.make_key('calculate', [(1, 3)])
+
+    async def run():
+        await result_cache.get_or_calculate(key_1, calculation(1.0, calls))
+        await result_cache.get_or_calculate(key_2, calculation(2.0, calls))
+        result_cache.invalidate([(1, 2)])
+        await result_cache.get_or_calculate(key_1, calculation(1.0, calls))
+        await result_cache.get_or_calculate(key_2, calculation(2.0, calls))
+
+    asyncio.run(run())
+    assert calls == [1.0, 2.0, 1.0]
+    assert result_cache.stats()['invalidations'] == 1
+
+
+def test_least_recently_used_entries_are_evicted_when_full():
+    size = int(pd.DataFrame({'EnvironmentalImpact': [1.0] * 10}).memory_usage(index=True, deep=True).sum())
+    result_cache = ResultCache(max_bytes=2 * size)
+    calls = []
+    keys = [result_cache.make_key('calculate', [(1, i)]) for i in range(3)]
+
+    async def run():
+        for i, key in enumerate(keys):
+            await result_cache.get_or_calculate(key, calculation(float(i), calls))
+        await result_cache.get_or_calculate(keys[0], calculation(0.0, calls))
+
+    asyncio.run(run())
+    assert calls == [0.0, 1.0, 2.0, 0.0]
+    assert result_cache.stats()['evictions'] >= 1
+
+
+def test_new_data_versions_from_the_backend_invalidate_entries():
+    backend = VersionsBackend()
+    result_cache = ResultCache(poll_interval=0)
+    calls = []
+
+    async def run():
+        for versions in ({(1, 2): 1, (1, 3): 1}, {(1, 2): 2, (1, 3): 1}):
+            backend.versions = versions
+            await result_cache.refresh_versions(backend)
+            for generation_type_id in (2, 3):
+                key = result_cache.make_key('calculate', [(1, generation_type_id)])
+                await result_cache.get_or_calculate(key, calculation(float(generation_type_id), calls))
+
+    asyncio.run(run())
+    assert calls == [2.0, 3.0, 2.0]
+    assert result_cache.stats()['invalidations'] == 1
@@ -0,0 +1,26 @@
+import datetime
+
+from src.data.rollups import choose_generation_source, floor_to_period, next_period_start
+from src.orm.base import ElectricityGeneration, ElectricityGenerationDaily, ElectricityGenerationHourly, ElectricityGenerationMonthly
+
+
+def test_periods_follow_brussels_time():
+    # 2023-10-29 is the end of summer time in Brussels, so the day lasts 25 hours
+    date_stamp = datetime.datetime(2023, 10, 29, 12, 15)
+    assert floor_to_period(date_stamp, 'day') == datetime.datetime(2023, 10, 28, 22)
+    assert next_period_start(date_stamp, 'day') == datetime.datetime(2023, 10, 29, 23)
+    assert floor_to_period(date_stamp, 'month') == datetime.datetime(2023, 9, 30, 22)
+    assert floor_to_period(date_stamp, 'hour') == datetime.datetime(2023, 10, 29, 12)
+
+
+def test_coarse_resolutions_read_from_the_smallest_aligned_rollup():
+    year_start = datetime.datetime(2022, 12, 31, 23)
+    year_end = datetime.datetime(2023, 12, 31, 23)
+    assert choose_generation_source('month', year_start, year_end) is ElectricityGenerationMonthly
+    assert choose_generation_source('year', None, None) is ElectricityGenerationMonthly
+    assert choose_generation_source('week', datetime.datetime(2023, 12, 3, 23), None) is ElectricityGenerationDaily
+    # Not aligned with days, but with hours
+    assert choose_generation_source('month', datetime.datetime(2023, 12, 2, 10), None) is ElectricityGenerationHourly
+    # Not aligned with any rollup
+    assert choose_generation_source('day', datetime.datetime(2023, 12, 2, 10, 15), None) is ElectricityGeneration
+    assert choose_generation_source(None, year_start, year_end) is ElectricityGeneration
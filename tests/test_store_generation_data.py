@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.data.store_generation_data import entsoe_generation_to_long_df, infer_resolution_minutes
+
+
+@pytest.fixture
+def cache(make_cache):
+    return make_cache({'Fossil Hard coal': 1, 'Fossil Brown coal/Lignite': 1, 'Wind Onshore': 3})
+
+
+def make_generation():
+    index = pd.date_range('2023-12-02', periods=4, freq='15min', tz='Europe/Brussels')
+    columns = pd.MultiIndex.from_tuples([('Fossil Hard coal', 'Actual Aggregated'),
+                                         ('Fossil Brown coal/Lignite', 'Actual Aggregated'),
+                                         ('Wind Onshore', 'Actual Aggregated'),
+                                         ('Hydro Pumped Storage', 'Actual Aggregated'),  # No mapping
+                                         ('Wind Onshore', 'Actual Consumption')])
+    return pd.DataFrame(np.arange(20, dtype=float).reshape(4, 5), index=index, columns=columns)
+
+
+def test_long_format_sums_generation_types_mapped_to_the_same_id(cache):
+    generation = make_generation()
+    long_df = entsoe_generation_to_long_df(generation, 7, cache)
+
+    assert list(long_df.columns) == ['RegionId', 'GenerationTypeId', 'DateStamp', 'AggregatedGeneration', 'ResolutionMinutes']
+    assert (long_df['ResolutionMinutes'] == 15).all()
+    assert len(long_df) == 8
+    assert (long_df['RegionId'] == 7).all()
+    coal = long_df[long_df['GenerationTypeId'] == 1].sort_values('DateStamp')
+    expected = generation[('Fossil Hard coal', 'Actual Aggregated')] + generation[('Fossil Brown coal/Lignite', 'Actual Aggregated')]
+    np.testing.assert_allclose(coal['AggregatedGeneration'], expected)
+    assert (coal['DateStamp'].to_numpy() == generation.index.to_numpy()).all()
+    wind = long_df[long_df['GenerationTypeId'] == 3].sort_values('DateStamp')
+    np.testing.assert_allclose(wind['AggregatedGeneration'], generation[('Wind Onshore', 'Actual Aggregated')])
+
+
+def test_generation_type_filter(cache):
+    long_df = entsoe_generation_to_long_df(make_generation(), 7, cache,
+                                           generation_type_filter=[('Wind Onshore', 'Actual Aggregated')])
+    assert set(long_df['GenerationTypeId']) == {3}
+    assert len(long_df) == 4
+
+
+def test_resolution_is_inferred_per_series_across_holes_and_changes():
+    quarter_hours = pd.date_range('2023-12-02 00:00', periods=4, freq='15min')
+    long_df = pd.DataFrame({
+        'RegionId': [1] * 7 + [2] * 3 + [3],
+        'GenerationTypeId': 1,
+        # Region 1 moves from hourly to quarter-hourly data, region 2 has a hole, region 3 a single value
+        'DateStamp': [pd.Timestamp('2023-12-01 22:00'), pd.Timestamp('2023-12-01 23:00'), *quarter_hours, pd.Timestamp('2023-12-02 01:00'),
+                      pd.Timestamp('2023-12-02 00:00'), pd.Timestamp('2023-12-02 00:30'), pd.Timestamp('2023-12-02 02:30'),
+                      pd.Timestamp('2023-12-02 00:00')],
+        'AggregatedGeneration': 1.0,
+    }).sample(frac=1, random_state=0)  # The order of the rows does not matter
+
+    resolution_minutes = infer_resolution_minutes(long_df)
+
+    expected = [60, 60, 15, 15, 15, 15, 15, 30, 30, 30, pd.NA]
+    assert resolution_minutes.sort_index().tolist() == expected
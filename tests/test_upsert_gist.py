@@ -0,0 +1,63 @@
+import os
+
+import pandas as pd
+import pytest
+import sqlalchemy
+from dotenv import load_dotenv
+from sqlalchemy import text
+
+from src.orm.upsert_gist import UpsertResult, upsert_df
+
+TABLE_NAME = 'test_upsert_df'
+INDEX = ['id1', 'id2']
+
+
+@pytest.fixture
+def engine():
+    load_dotenv()
+    engine = sqlalchemy.create_engine(sqlalchemy.engine.url.URL.create(
+        drivername='postgresql',
+        host=os.getenv('ELEC_LCA_HOST'),
+        database=os.getenv('ELEC_LCA_DB_NAME'),
+        username=os.getenv('ELEC_LCA_USER'),
+        password=os.getenv('ELEC_LCA_PASSWORD')
+    ))
+    try:
+        with engine.begin() as connection:
+            connection.execute(text(f'DROP TABLE IF EXISTS "{TABLE_NAME}"'))
+    except sqlalchemy.exc.OperationalError:
+        pytest.skip('No database to connect to')
+    yield engine
+    with engine.begin() as connection:
+        connection.execute(text(f'DROP TABLE IF EXISTS "{TABLE_NAME}"'))
+    engine.dispose()
+
+
+def make_df(id1, id2, name, age):
+    return pd.DataFrame({'id1': id1, 'id2': id2, 'name': name, 'age': age}).set_index(INDEX)
+
+
+def test_counts_of_inserted_and_updated_rows(engine):
+    with engine.begin() as connection:
+        connection.execute(text(f'CREATE TABLE "{TABLE_NAME}" ("id1" bigint, "id2" text, "name" text, "age" bigint, UNIQUE ("id1", "id2"))'))
+
+    df = make_df([1, 2, 3, 3], ['a', 'a', 'b', 'c'], ['name1', 'name2', 'name3', 'name4'], [20, 32, 29, 68])
+    assert upsert_df(df, TABLE_NAME, engine) == UpsertResult(inserted=4, updated=0)
+    df_update = make_df([1, 2, 3], ['a', 'a', 'b'], ['surname1', 'surname2', 'surname3'], [13, 44, 29])
+    assert upsert_df(df_update, TABLE_NAME, engine) == UpsertResult(inserted=0, updated=3)
+    # The last of duplicate rows is kept
+    df_insert = make_df([1, 1], ['d', 'd'], ['skipped', 'dname'], [0, 100])
+    assert upsert_df(df_insert, TABLE_NAME, engine) == UpsertResult(inserted=1, updated=0)
+
+    result = pd.read_sql_table(TABLE_NAME, engine).set_index(INDEX).sort_index()
+    expected = make_df([1, 1, 2, 3, 3], ['a', 'd', 'a', 'b', 'c'], ['surname1', 'dname', 'surname2', 'surname3', 'name4'],
+                       [13, 100, 44, 29, 68])
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_missing_table_is_not_created(engine):
+    df = make_df([1, 2], ['a', 'a'], ['name1', 'name2'], [20, 32])
+    with pytest.raises(ValueError, match='does not exist'):
+        upsert_df(df, TABLE_NAME, engine)
+    with engine.connect() as connection:
+        assert not sqlalchemy.inspect(connection).has_table(TABLE_NAME)